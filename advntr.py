@@ -1,6 +1,6 @@
 import argparse
 
-from src.commands import genotype, not_implemented_command
+from src.commands import build_models, genotype, index_database, not_implemented_command
 from src import settings
 
 
@@ -14,7 +14,9 @@ def run_advntr():
     help = 'Command: genotype\tfind RU counts and mutations in VNTRs\n' \
            '         viewmodel\tview existing models in database\n' \
            '         addmodel\tadd custom VNTR to the database\n' \
-           '         delmodel\tremove a model from database\n'
+           '         delmodel\tremove a model from database\n' \
+           '         buildmodels\tprecompute the read matcher models of the database\n' \
+           '         indexdb\tindex the database to quickly load a few VNTRs\n'
 
     usage = '\r{}\nusage: %(prog)s <command> [options]\n\n\r{}\r{}'.format(description.ljust(len('usage:')), help, '\n')
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, usage=usage, add_help=False)
@@ -33,10 +35,17 @@ def run_advntr():
                                  help='Set this flag if input file contains Nanopore MinION reads instead of Illumina')
     genotype_parser.add_argument('-wd', '--working_directory', type=str, metavar='DIRECTORY',
                                  help='Working directory for creating temporary files needed for computation')
+    genotype_parser.add_argument('-cd', '--cache_directory', type=str, metavar='DIRECTORY', default=None,
+                                 help='Directory to keep the unmapped reads and selected reads of each sample for '
+                                      'later runs on the same sample [sample_cache/ in the working directory]')
+    genotype_parser.add_argument('-ms', '--model_store', type=str, metavar='FILE', default=None,
+                                 help='Model store made by buildmodels to load the read matcher models from '
+                                      '[%s]' % settings.MODEL_STORE_FILE)
     genotype_parser.add_argument('-t', '--threads', type=int, metavar='<nthreads>', default=4,
                                  help='Run the tool on <nthreads> parallel threads which will run on separate processors/cores [%(default)s]')
     genotype_parser.add_argument('-vid', '--vntr_id', type=str, metavar='<VNTR ID>', default=None,
-                                 help='Comma-separated list of VNTR IDs')
+                                 help='Comma-separated list of VNTR IDs. Only these VNTRs are read from the '
+                                      'database, which is fast once it is indexed with the indexdb command')
     genotype_parser.add_argument('-naive', '--naive', action='store_true', default=False,
                                  help='Use naive approach for PacBio reads')
 
@@ -44,6 +53,22 @@ def run_advntr():
     addmodel_parser = subparsers.add_parser('addmodel', usage='python advntr.py addmodel [options]')
     delmodel_parser = subparsers.add_parser('delmodel', usage='python advntr.py delmodel [options]')
 
+    buildmodels_parser = subparsers.add_parser('buildmodels', usage='python advntr.py buildmodels [options]')
+    buildmodels_parser.add_argument('-rl', '--read_lengths', type=str, metavar='<lengths>', default='150',
+                                    help='Comma-separated list of read lengths to build models for [%(default)s]')
+    buildmodels_parser.add_argument('-o', '--output', type=str, metavar='FILE', default=settings.MODEL_STORE_FILE,
+                                    help='Model store to add the models to [%(default)s]')
+    buildmodels_parser.add_argument('-a', '--alignment_file', type=str, metavar='FILE', default=None,
+                                    help='Alignment file to also calibrate the score thresholds of the models on')
+    buildmodels_parser.add_argument('-t', '--threads', type=int, metavar='<nthreads>', default=4,
+                                    help='Build models on <nthreads> parallel processes [%(default)s]')
+    buildmodels_parser.add_argument('-vid', '--vntr_id', type=str, metavar='<VNTR ID>', default=None,
+                                    help='Comma-separated list of VNTR IDs, all VNTRs of the database by default')
+
+    indexdb_parser = subparsers.add_parser('indexdb', usage='python advntr.py indexdb [options]')
+    indexdb_parser.add_argument('-db', '--database', type=str, metavar='FILE', default='vntr_data/hg19_VNTRs.db',
+                                help='VNTR database to index [%(default)s]')
+
     args = parser.parse_args()
     if args.command == 'genotype':
         genotype(args, genotype_parser)
@@ -53,6 +78,10 @@ def run_advntr():
         not_implemented_command(parser, args.command)
     elif args.command == 'delmodel':
         not_implemented_command(parser, args.command)
+    elif args.command == 'buildmodels':
+        build_models(args, buildmodels_parser)
+    elif args.command == 'indexdb':
+        index_database(args, indexdb_parser)
 
 if __name__ == '__main__':
     run_advntr()
@@ -1,5 +1,14 @@
+import itertools
+import logging
+
+import numpy
+
 from distance import *
 from Bio import SeqIO, Seq
+from kmer_recruiter import KmerIndex, get_bases_of_sequences, get_kmer_codes, get_rolling_kmer_codes, \
+    process_reads_in_chunks
+import settings
+from utils import get_reverse_complement
 
 
 def match_query_by_sliding_windows(query, query_acgt_content, rc_query_acgt_content, number_of_copies, read_segment):
@@ -56,3 +65,138 @@ def get_candid_reads_by_kmer_method(query, number_of_copies, k, fastq_files):
             read_counter += 1
         print('total reads: ', read_counter)
     return candid_reads
+
+
+def get_window_compositions(bases, window_size):
+    """Return the A, C, G and T counts of the window that starts at each position of bases, and whether the window
+    only has A, C, G or T
+    """
+    positions = len(bases) - window_size + 1
+    counts = []
+    for code in range(5):
+        cumulative_counts = numpy.concatenate(([0], numpy.cumsum(bases == code)))
+        counts.append(cumulative_counts[window_size:window_size + positions] - cumulative_counts[:positions])
+    return numpy.array(counts[:4]).T, counts[4] == 0
+
+
+def get_composition_keys(compositions, window_size):
+    return (compositions[:, 0] * (window_size + 1) + compositions[:, 1]) * (window_size + 1) + compositions[:, 2]
+
+
+class ReadPrefilter:
+    """Discard reads that cannot belong to any of the VNTRs before the reads are searched for each VNTR
+
+    A read passes for a VNTR if one of its windows has a nucleotide composition within max_distance (L1 distance of
+    A, C, G and T counts) of a window of the repeats of the VNTR, or of their reverse complement, and it has at least
+    min_kmer_hits k-mers of the repeats of the same VNTR. Both checks look up chunks of reads in indices of all VNTRs.
+    The windows of each VNTR are as long as window_size, or as its repeats if they are shorter.
+    """
+
+    def __init__(self, reference_vntrs, window_size=None, max_distance=None, k=None, min_kmer_hits=None):
+        window_size = window_size if window_size is not None else settings.PREFILTER_WINDOW_SIZE
+        max_distance = max_distance if max_distance is not None else settings.PREFILTER_MAX_COMPOSITION_DISTANCE
+        self.k = k if k is not None else settings.PREFILTER_KMER_SIZE
+        self.min_kmer_hits = min_kmer_hits if min_kmer_hits is not None else settings.PREFILTER_MIN_KMER_HITS
+        self.vntr_ids = [reference_vntr.id for reference_vntr in reference_vntrs]
+        self.total_reads = 0
+        self.total_bases = 0
+        self.passed_reads = 0
+
+        offsets = [offset + (-sum(offset),) for offset in itertools.product(range(-max_distance, max_distance + 1),
+                                                                             repeat=3)]
+        offsets = numpy.array([offset for offset in offsets if sum([abs(e) for e in offset]) <= max_distance])
+        composition_keys = {}
+        composition_vntrs = {}
+        kmer_codes = [numpy.array([], dtype=numpy.int64)]
+        kmer_vntrs = [numpy.array([], dtype=numpy.int64)]
+        for vntr_index, reference_vntr in enumerate(reference_vntrs):
+            repeats = ''.join(reference_vntr.get_repeat_segments()).upper()
+            if not len(repeats):
+                continue
+            vntr_window_size = min(window_size, len(repeats))
+            sequences = []
+            for sequence in [repeats, get_reverse_complement(repeats)]:
+                sequences.append(sequence + (sequence * self.k)[:max(vntr_window_size, self.k) - 1])
+                codes = get_kmer_codes(sequences[-1], self.k)
+                kmer_codes.append(codes)
+                kmer_vntrs.append(numpy.full(len(codes), vntr_index, dtype=numpy.int64))
+
+            bases, _ = get_bases_of_sequences(sequences)
+            compositions, valid = get_window_compositions(bases, vntr_window_size)
+            compositions = numpy.unique(compositions[valid], axis=0)
+            neighbours = (compositions[:, None, :] + offsets[None, :, :]).reshape(-1, 4)
+            neighbours = neighbours[numpy.all(neighbours >= 0, axis=1)]
+            keys = numpy.unique(get_composition_keys(neighbours, vntr_window_size))
+            composition_keys.setdefault(vntr_window_size, []).append(keys)
+            composition_vntrs.setdefault(vntr_window_size, []).append(numpy.full(len(keys), vntr_index,
+                                                                                  dtype=numpy.int64))
+
+        vntr_count = max(len(self.vntr_ids), 1)
+        self.kmer_index = KmerIndex(self.k, numpy.concatenate(kmer_codes), numpy.concatenate(kmer_vntrs), vntr_count)
+        self.composition_indices = {}
+        for vntr_window_size in composition_keys.keys():
+            self.composition_indices[vntr_window_size] = KmerIndex(
+                vntr_window_size, numpy.concatenate(composition_keys[vntr_window_size]),
+                numpy.concatenate(composition_vntrs[vntr_window_size]), vntr_count, (vntr_window_size + 1) ** 3)
+
+    def find_vntrs_of_sequences(self, sequences):
+        """Return the ids of the VNTRs that each sequence passes the prefilter for
+
+        K-mers are looked up first, and the compositions of a sequence are only looked up if it has enough k-mers of
+        a VNTR.
+        """
+        result = [[] for _ in sequences]
+        if not len(sequences) or not len(self.vntr_ids):
+            return result
+        bases, sequence_of_position = get_bases_of_sequences(sequences)
+        vntr_count = len(self.vntr_ids)
+        if len(bases) < self.k:
+            return result
+
+        codes, valid = get_rolling_kmer_codes(bases, self.k)
+        positions = numpy.flatnonzero(valid)
+        hit_positions, vntrs = self.kmer_index.find_groups(codes[positions])
+        kmer_hits, hit_counts = numpy.unique(sequence_of_position[positions[hit_positions]] * vntr_count + vntrs,
+                                             return_counts=True)
+        kmer_hits = kmer_hits[hit_counts >= self.min_kmer_hits]
+        candidates = numpy.unique(kmer_hits // vntr_count)
+        if not len(candidates):
+            return result
+        bases, sequence_of_position = get_bases_of_sequences([sequences[i] for i in candidates])
+        sequence_of_position = candidates[sequence_of_position]
+
+        composition_hits = [numpy.array([], dtype=numpy.int64)]
+        for window_size, index in self.composition_indices.items():
+            if len(bases) < window_size:
+                continue
+            compositions, valid = get_window_compositions(bases, window_size)
+            positions = numpy.flatnonzero(valid)
+            key_count = (window_size + 1) ** 3
+            sequence_keys = numpy.unique(sequence_of_position[positions] * key_count +
+                                         get_composition_keys(compositions[positions], window_size))
+            hit_keys, vntrs = index.find_groups(sequence_keys % key_count)
+            composition_hits.append(sequence_keys[hit_keys] // key_count * vntr_count + vntrs)
+        sequence_vntrs = numpy.intersect1d(numpy.unique(numpy.concatenate(composition_hits)), kmer_hits,
+                                           assume_unique=True)
+        for sequence_index, vntr_index in zip(*divmod(sequence_vntrs, vntr_count)):
+            result[sequence_index].append(self.vntr_ids[vntr_index])
+        return result
+
+    def filter_sequences(self, sequences):
+        """Return whether each sequence passes the prefilter"""
+        return numpy.array([len(vntr_ids) > 0 for vntr_ids in self.find_vntrs_of_sequences(sequences)], dtype=bool)
+
+    def filter_reads(self, reads, chunk_size=None):
+        """Yield the reads that pass the prefilter, counting the checked reads and bases and the passed reads"""
+        return process_reads_in_chunks(reads, self.filter_chunk, chunk_size)
+
+    def filter_chunk(self, reads):
+        passed = self.filter_sequences([read.seq for read in reads])
+        self.total_reads += len(reads)
+        self.total_bases += sum([len(read.seq) for read in reads])
+        self.passed_reads += int(numpy.sum(passed))
+        return [read for read, read_passed in zip(reads, passed) if read_passed]
+
+    def log_pass_rate(self):
+        pass_rate = 100.0 * self.passed_reads / self.total_reads if self.total_reads else 0
+        logging.info('Prefilter passed %s of %s reads (%.2f%%)' % (self.passed_reads, self.total_reads, pass_rate))
@@ -18,6 +18,18 @@ def make_blast_database(fasta_file, db_name):
     return empty_db
 
 
+def get_blast_database(working_directory, fasta_file):
+    """Return the name of the BLAST database of fasta_file in working_directory, and whether it is empty
+
+    The database is only made if it is not in working_directory yet.
+    """
+    blast_db_name = working_directory + 'blast_db__' + os.path.basename(fasta_file)
+    empty_db = False
+    if not os.path.exists(blast_db_name + '.nsq') and not os.path.exists(blast_db_name + '.nal'):
+        empty_db = make_blast_database(fasta_file, blast_db_name)
+    return blast_db_name, empty_db
+
+
 def make_blast_database_of_multiple_files(fasta_files, db_name):
     for file_name in fasta_files:
         make_db_args = '-in %s -parse_seqids -max_file_size 8GB -dbtype nucl -out %s' % (file_name, db_name)
@@ -31,10 +43,14 @@ def make_blast_database_of_multiple_files(fasta_files, db_name):
     call(['blastdb_aliastool'] + merge_db_args)
 
 
-def run_blast_search(query_file, db, result_file, num_threads, word_size, max_seq, evalue, task, identity_cutoff):
-    blastn_cline = NcbiblastnCommandline(query=query_file, db=db, outfmt='"6 sallseqid"', dust='no', out=result_file,
-                                         num_threads=num_threads, word_size=word_size, max_target_seqs=max_seq,
-                                         evalue=evalue, task=task, perc_identity=identity_cutoff)
+def run_blast_search(query_file, db, result_file, num_threads, word_size, max_seq, evalue, task, identity_cutoff,
+                     output_columns='sallseqid', db_size=None):
+    """Run blastn, with db_size as the effective database length if the database only has a subset of the reads"""
+    options = {'dbsize': db_size} if db_size is not None else {}
+    blastn_cline = NcbiblastnCommandline(query=query_file, db=db, outfmt='"6 %s"' % output_columns, dust='no',
+                                         out=result_file, num_threads=num_threads, word_size=word_size,
+                                         max_target_seqs=max_seq, evalue=evalue, task=task,
+                                         perc_identity=identity_cutoff, **options)
     blastn_cline()
     with open(result_file) as result_input:
         ids = result_input.readlines()
@@ -51,11 +67,7 @@ def get_blast_matched_ids(query, blast_db_name, word_size='5', max_seq='6000', e
         my_rec = SeqRecord.SeqRecord(seq=Seq.Seq(query), id='query', description='')
         SeqIO.write([my_rec], output_handle, 'fasta')
 
-    if len(query) <= 15:
-        task = 'blastn-short'
-    else:
-        task = 'blastn'
-
+    task = get_blast_task(query)
     if not threads:
         threads = settings.CORES
 
@@ -66,3 +78,38 @@ def get_blast_matched_ids(query, blast_db_name, word_size='5', max_seq='6000', e
     os.remove(query_file) if os.path.exists(query_file) else None
 
     return matched_ids
+
+
+def get_blast_task(query):
+    if len(query) <= 15:
+        return 'blastn-short'
+    return 'blastn'
+
+
+def get_blast_matched_ids_of_queries(queries, blast_db_name, word_size='5', max_seq='6000', evalue=10.0, search_id='',
+                                     threads=None, identity_cutoff='0', task='blastn', db_size=None):
+    """Search all queries with one blastn run and return the ids of the sequences that each query matched
+
+    queries maps query ids, which must not have whitespace, to query sequences.
+    """
+    query_file = settings.BLAST_TMP_DIR + search_id + '_queries.fasta'
+    result_file = settings.BLAST_TMP_DIR + search_id + '_blast_results.txt'
+    with open(query_file, "w") as output_handle:
+        records = [SeqRecord.SeqRecord(seq=Seq.Seq(query), id=query_id, description='')
+                   for query_id, query in queries.items()]
+        SeqIO.write(records, output_handle, 'fasta')
+
+    if not threads:
+        threads = settings.CORES
+
+    matches = run_blast_search(query_file, blast_db_name, result_file, threads, word_size, max_seq, evalue, task,
+                               identity_cutoff, 'qseqid sallseqid', db_size)
+    matched_ids = {query_id: set([]) for query_id in queries.keys()}
+    for match in matches:
+        query_id, seq_id = match.split('\t')
+        matched_ids[query_id].add(seq_id)
+
+    os.remove(result_file) if os.path.exists(result_file) else None
+    os.remove(query_file) if os.path.exists(query_file) else None
+
+    return matched_ids
@@ -1,9 +1,14 @@
 import logging
 import os
 import sys
+from multiprocessing import Pool
 
 from genome_analyzer import GenomeAnalyzer
-from reference_vntr import load_unique_vntrs_data
+from model_store import ModelStore, get_model_archive
+from reference_vntr import add_vntr_database_indices, load_vntrs_from_catalog
+from sam_utils import get_read_length_of_alignment_file
+from utils import get_read_length_bucket
+from vntr_finder import VNTRFinder
 import settings
 
 
@@ -33,6 +38,12 @@ def genotype(args, genotype_parser):
     if args.threads < 1:
         print_error(genotype_parser, 'ERROR: threads cannot be less than 1')
     settings.CORES = args.threads
+    if args.cache_directory is not None:
+        settings.SAMPLE_CACHE_DIR = args.cache_directory.rstrip('/') + '/'
+    if args.model_store is not None:
+        if not os.path.isfile(args.model_store):
+            print_error(genotype_parser, 'ERROR: model store %s does not exist' % args.model_store)
+        settings.MODEL_STORE_FILE = args.model_store
 
     input_file = args.alignment_file if args.alignment_file else args.fasta
     input_is_alignment_file = input_file.endswith('bam') or input_file.endswith('sam')
@@ -42,21 +53,14 @@ def genotype(args, genotype_parser):
     log_format = '%(asctime)s %(levelname)s:%(message)s'
     logging.basicConfig(format=log_format, filename=log_file, level=logging.DEBUG, filemode='w')
 
-    reference_vntrs = load_unique_vntrs_data()
-    # reference_vntrs = identify_homologous_vntrs(reference_vntrs, 'chr15')
     # illumina_targets = [1214, 1220, 1221, 1222, 1223, 1224, 377, 378, 809]
     illumina_targets = [532789, 188871, 301645, 600000]
 
-    target_vntrs = []
-    for i in range(len(reference_vntrs)):
-        if not reference_vntrs[i].is_non_overlapping() or reference_vntrs[i].has_homologous_vntr():
-            continue
-        target_vntrs.append(i)
-
     if args.vntr_id is not None:
         target_vntrs = [int(vid) for vid in args.vntr_id.split(',')]
     else:
         target_vntrs = illumina_targets
+    reference_vntrs = load_vntrs_from_catalog(target_vntrs)
     genome_analyzier = GenomeAnalyzer(reference_vntrs, target_vntrs, working_directory)
     if args.pacbio:
         if input_is_alignment_file:
@@ -75,5 +79,58 @@ def genotype(args, genotype_parser):
             genome_analyzier.find_repeat_counts_from_short_reads(input_file)
 
 
+def build_model_archive(job):
+    reference_vntr, read_length = job
+    vntr_matcher = VNTRFinder(reference_vntr).build_vntr_matcher_hmm_for_read_length(read_length)
+    return reference_vntr.id, read_length, get_model_archive(vntr_matcher)
+
+
+def build_models(args, buildmodels_parser):
+    if args.threads < 1:
+        print_error(buildmodels_parser, 'ERROR: threads cannot be less than 1')
+    try:
+        read_lengths = sorted(set([get_read_length_bucket(int(length)) for length in args.read_lengths.split(',')]))
+    except ValueError:
+        print_error(buildmodels_parser, 'ERROR: read lengths must be comma-separated integers')
+    settings.CORES = args.threads
+
+    log_format = '%(asctime)s %(levelname)s:%(message)s'
+    logging.basicConfig(format=log_format, level=logging.INFO)
+
+    target_vntrs = [int(vid) for vid in args.vntr_id.split(',')] if args.vntr_id is not None else None
+    reference_vntrs = load_vntrs_from_catalog(target_vntrs)
+
+    cyclic = settings.USE_CYCLIC_REPEAT_MATCHER
+    model_store = ModelStore(args.output, read_only=False)
+    jobs = [(reference_vntr, read_length) for reference_vntr in reference_vntrs for read_length in read_lengths
+            if not model_store.has_model(reference_vntr.id, read_length, cyclic)]
+    logging.info('Building %s models for read lengths %s in %s' % (len(jobs), read_lengths, args.output))
+    pool = Pool(args.threads)
+    for i, (vntr_id, read_length, archive) in enumerate(pool.imap_unordered(build_model_archive, jobs)):
+        model_store.save_model_archive(vntr_id, read_length, cyclic, archive)
+        logging.info('Built model %s/%s: VNTR %s, read length %s' % (i + 1, len(jobs), vntr_id, read_length))
+    pool.close()
+    pool.join()
+
+    if args.alignment_file is not None:
+        # Scores are calibrated on the reads of the alignment file, so they are stored for the length of its reads
+        sample_read_length = get_read_length_of_alignment_file(args.alignment_file)
+        model_read_lengths = [length for length in read_lengths if length >= sample_read_length]
+        if not len(model_read_lengths):
+            logging.warning('No model is long enough for the %sbp reads of %s to calibrate score thresholds' %
+                            (sample_read_length, args.alignment_file))
+            return
+        for reference_vntr in reference_vntrs:
+            hmm = model_store.load_model(reference_vntr.id, model_read_lengths[0], cyclic)
+            VNTRFinder(reference_vntr).get_min_score_to_select_a_read(hmm, args.alignment_file, sample_read_length)
+
+
+def index_database(args, indexdb_parser):
+    if not os.path.isfile(args.database):
+        print_error(indexdb_parser, 'ERROR: database %s does not exist' % args.database)
+    add_vntr_database_indices(args.database)
+    print('Indexed %s' % args.database)
+
+
 def not_implemented_command(parser, command):
     parser.error('%s command has not been implemented yet. Sorry for inconvenience.' % command)
@@ -0,0 +1,74 @@
+import sys
+
+import numpy
+
+from hmm_utils import DNA_COMPLEMENT, StateTable, VpathSummary, get_reverse_complement
+from reference_vntr import load_unique_vntrs_data
+from vntr_finder import VNTRFinder
+
+
+def get_reads_of_reference_haplotype(reference_vntr, read_length, step=10):
+    haplotype = reference_vntr.left_flanking_region[-read_length:] + ''.join(reference_vntr.get_repeat_segments()) + \
+                reference_vntr.right_flanking_region[:read_length]
+    haplotype = haplotype.upper()
+    reads = []
+    for start in range(0, len(haplotype) - read_length + 1, step):
+        read = haplotype[start:start + read_length]
+        if 'N' in read:
+            continue
+        reads.append(read)
+        reads.append(get_reverse_complement(read))
+    return reads
+
+
+def decode_reads(hmm, state_table, reads):
+    logps, paths, reverse = hmm.viterbi_batch(reads, complement=DNA_COMPLEMENT)
+    strands = VNTRFinder.get_better_strands(reads, reverse)
+    repeats = [VpathSummary(path, state_table, strand).repeats for path, strand in zip(paths, strands)]
+    return logps, repeats
+
+
+def compare_dp_precisions_of_vntr(reference_vntr, read_length, tolerance):
+    """Decode reads of the reference haplotype with float64 and float32 DP tables
+    and return the largest relative logp difference and the number of reads with a different repeat count
+    """
+    vntr_finder = VNTRFinder(reference_vntr)
+    copies = int(round(float(read_length) / len(reference_vntr.pattern) + 0.5))
+    hmm = vntr_finder.build_vntr_matcher_hmm(copies, read_length)
+    state_table = StateTable(hmm)
+    reads = get_reads_of_reference_haplotype(reference_vntr, read_length)
+    if not len(reads):
+        return 0, 0
+
+    hmm.single_precision = False
+    double_logps, double_repeats = decode_reads(hmm, state_table, reads)
+    hmm.single_precision = True
+    single_logps, single_repeats = decode_reads(hmm, state_table, reads)
+
+    relative_errors = numpy.abs(single_logps - double_logps) / numpy.abs(double_logps)
+    different_repeats = sum([1 for a, b in zip(double_repeats, single_repeats) if a != b])
+    for i in numpy.flatnonzero(relative_errors > tolerance):
+        print('%s: logp %s with float64 and %s with float32 for %s' % (reference_vntr.id, double_logps[i],
+                                                                      single_logps[i], reads[i]))
+    return numpy.max(relative_errors), different_repeats
+
+
+def compare_dp_precisions(read_length=150, tolerance=1e-4, vntr_ids=None):
+    reference_vntrs = load_unique_vntrs_data()
+    failed_vntrs = []
+    for reference_vntr in reference_vntrs:
+        if not reference_vntr.is_non_overlapping() or reference_vntr.has_homologous_vntr():
+            continue
+        if vntr_ids is not None and reference_vntr.id not in vntr_ids:
+            continue
+        max_error, different_repeats = compare_dp_precisions_of_vntr(reference_vntr, read_length, tolerance)
+        print('%s %s %s' % (reference_vntr.id, max_error, different_repeats))
+        if max_error > tolerance or different_repeats:
+            failed_vntrs.append(reference_vntr.id)
+    print('VNTRs where float32 does not match float64: %s' % failed_vntrs)
+    return failed_vntrs
+
+
+if __name__ == '__main__':
+    ids = [int(vntr_id) for vntr_id in sys.argv[1:]] if len(sys.argv) > 1 else None
+    compare_dp_precisions(vntr_ids=ids)
@@ -4,8 +4,11 @@ import pysam
 
 from Bio import SeqIO
 
+from acgt_filter import ReadPrefilter
+from genome_analyzer import GenomeAnalyzer
 from reference_vntr import load_unique_vntrs_data
 from sam_utils import get_id_of_reads_mapped_to_vntr_in_bamfile, make_bam_and_index
+from utils import read_fasta_file
 from vntr_finder import VNTRFinder
 
 
@@ -97,6 +100,48 @@ def get_out_pacbio_filtered_counts(fq_file, vntr_finder):
     return len(vntr_finder.get_spanning_reads_of_unaligned_pacbio_reads(filtered_reads))
 
 
+def compare_kmer_recruitment_with_blast(read_file, reference_vntrs, vntr_ids, illumina=True):
+    """Return the ids of the reads that the BLAST keyword matching selects for each VNTR and k-mer recruitment misses
+
+    K-mer recruitment can replace the BLAST searches when no read is missed for any VNTR.
+    """
+    genome_analyzer = GenomeAnalyzer(reference_vntrs, vntr_ids, 'working_directory/')
+    blast_read_ids = genome_analyzer.get_vntr_blast_read_ids(read_file, illumina)
+    recruited_reads = genome_analyzer.get_vntr_recruited_reads_map(read_fasta_file(read_file), illumina)
+    missed_read_ids = {}
+    for vntr_id in vntr_ids:
+        recruited_ids = set([read.id for read in recruited_reads[vntr_id]])
+        missed_read_ids[vntr_id] = blast_read_ids[vntr_id] - recruited_ids
+        print('%s blast: %s k-mer: %s missed: %s' % (vntr_id, len(blast_read_ids[vntr_id]), len(recruited_ids),
+                                                     len(missed_read_ids[vntr_id])))
+    return missed_read_ids
+
+
+def compare_prefilter_with_blast(read_file, reference_vntrs, vntr_ids):
+    """Return the ids of the short reads that the BLAST keyword matching selects for each VNTR and the read prefilter
+    of that VNTR rejects
+
+    The read prefilter can be enabled when no read is missed for any VNTR.
+    """
+    genome_analyzer = GenomeAnalyzer(reference_vntrs, vntr_ids, 'working_directory/')
+    blast_read_ids = genome_analyzer.get_vntr_blast_read_ids(read_file)
+    blast_ids = set([])
+    for vntr_id in vntr_ids:
+        blast_ids |= blast_read_ids[vntr_id]
+    reads = [read for read in read_fasta_file(read_file) if read.id in blast_ids]
+    prefilter = ReadPrefilter([genome_analyzer.vntr_finder[vntr_id].reference_vntr for vntr_id in vntr_ids])
+    passed_read_ids = {vntr_id: set([]) for vntr_id in vntr_ids}
+    for read, passed_vntr_ids in zip(reads, prefilter.find_vntrs_of_sequences([read.seq for read in reads])):
+        for vntr_id in passed_vntr_ids:
+            passed_read_ids[vntr_id].add(read.id)
+    missed_read_ids = {}
+    for vntr_id in vntr_ids:
+        missed_read_ids[vntr_id] = blast_read_ids[vntr_id] - passed_read_ids[vntr_id]
+        print('%s blast: %s missed by prefilter: %s' % (vntr_id, len(blast_read_ids[vntr_id]),
+                                                         len(missed_read_ids[vntr_id])))
+    return missed_read_ids
+
+
 def get_pacbio_comparison_result():
     reference_vntrs = load_unique_vntrs_data()
     id_to_gene = {1221: 'CSTB', 1216: 'HIC1', 1215: 'INS'}
@@ -1,8 +1,18 @@
-from Bio import SeqIO
+import hashlib
+import json
+import logging
+import os
+from uuid import uuid4
 
+from acgt_filter import ReadPrefilter
+from blast_wrapper import get_blast_database, get_blast_matched_ids_of_queries, get_blast_task
+from kmer_recruiter import KmerRecruiter
 from profiler import time_usage
-from sam_utils import extract_unmapped_reads_to_fasta_file
+from sample_cache import SampleCache
+from threshold_store import get_threshold_store
+from utils import read_fasta_file, write_file_atomically
 from vntr_finder import VNTRFinder
+import settings
 
 
 class GenomeAnalyzer:
@@ -23,29 +33,220 @@ class GenomeAnalyzer:
         else:
             print('None')
 
+    def get_sample_cache(self, input_file):
+        cache_dir = settings.SAMPLE_CACHE_DIR
+        if cache_dir is None:
+            cache_dir = self.working_dir + 'sample_cache/'
+        return SampleCache(input_file, cache_dir)
+
+    @staticmethod
+    def get_prefilter_parameters(illumina=True):
+        """Return the parameters of the read prefilter, or None if reads are not prefiltered"""
+        if not illumina or not settings.USE_READ_PREFILTER:
+            return None
+        return {'window_size': settings.PREFILTER_WINDOW_SIZE,
+                'max_distance': settings.PREFILTER_MAX_COMPOSITION_DISTANCE, 'k': settings.PREFILTER_KMER_SIZE,
+                'min_kmer_hits': settings.PREFILTER_MIN_KMER_HITS}
+
+    @staticmethod
+    def get_recruitment_parameters(illumina=True):
+        if settings.USE_KMER_RECRUITMENT:
+            return {'method': 'kmer', 'short_reads': illumina, 'min_hits': settings.RECRUITMENT_MIN_KMER_HITS,
+                    'min_kmer_size': settings.RECRUITMENT_MIN_KMER_SIZE}
+        recruitment = {'method': 'blast', 'short_reads': illumina}
+        prefilter = GenomeAnalyzer.get_prefilter_parameters(illumina)
+        if prefilter is not None:
+            recruitment['prefilter'] = prefilter
+        return recruitment
+
+    def get_read_prefilter(self, vntr_ids, illumina=True):
+        prefilter = self.get_prefilter_parameters(illumina)
+        if prefilter is None:
+            return None
+        return ReadPrefilter([self.vntr_finder[vid].reference_vntr for vid in vntr_ids], **prefilter)
+
+    def get_prefiltered_read_file(self, read_file, vntr_ids, prefilter):
+        """Return a fasta file next to read_file with the reads that pass the prefilter of these VNTRs, and the number
+        of bases of all reads of read_file
+
+        The file is named by the VNTRs and the prefilter parameters, so it is only written once for them. The number
+        of bases is kept next to it, as BLAST searches of the prefiltered reads use it as the database size.
+        """
+        key = json.dumps([sorted(vntr_ids), self.get_prefilter_parameters()], sort_keys=True)
+        prefiltered_file = os.path.splitext(read_file)[0] + '.prefiltered_%s.fasta' % hashlib.sha1(key).hexdigest()[:12]
+        summary_file = prefiltered_file + '.json'
+        if not os.path.isfile(prefiltered_file) or not os.path.isfile(summary_file):
+            def write_reads(outfile):
+                for read in prefilter.filter_reads(read_fasta_file(read_file)):
+                    outfile.write('>%s\n%s\n' % (read.id, read.seq))
+            write_file_atomically(prefiltered_file, write_reads)
+            summary = {'reads': prefilter.total_reads, 'bases': prefilter.total_bases,
+                       'passed_reads': prefilter.passed_reads}
+            write_file_atomically(summary_file, lambda outfile: json.dump(summary, outfile))
+            prefilter.log_pass_rate()
+        with open(summary_file) as infile:
+            total_bases = json.load(infile)['bases']
+        return prefiltered_file, total_bases
+
+    def get_read_ids_passing_vntr_prefilters(self, read_file, vntr_read_ids):
+        """Keep the reads of each VNTR that pass the prefilter of that VNTR alone
+
+        Other reads in the prefiltered reads only passed for another VNTR searched in the same run, so without this
+        the selected reads would depend on which VNTRs are searched together.
+        """
+        vntrs_of_reads = self.get_vntrs_of_reads(vntr_read_ids)
+        reads = [read for read in read_fasta_file(read_file) if read.id in vntrs_of_reads]
+        prefilter = self.get_read_prefilter(vntr_read_ids.keys())
+        result = {vntr_id: set([]) for vntr_id in vntr_read_ids.keys()}
+        for read, passed_vntr_ids in zip(reads, prefilter.find_vntrs_of_sequences([read.seq for read in reads])):
+            for vntr_id in passed_vntr_ids:
+                if vntr_id in vntrs_of_reads[read.id]:
+                    result[vntr_id].add(read.id)
+        return result
+
     @time_usage
-    def get_vntr_filtered_reads_map(self, read_file, illumina=True):
-        vntr_reads = {}
+    def get_vntr_filtered_reads_map(self, read_file, illumina=True, sample_cache=None, reads=None):
+        """Return the reads of each target VNTR
+
+        Reads that an earlier run on the same sample selected for a VNTR are reused from the sample cache, and only
+        the other VNTRs are searched. With k-mer recruitment, the reads can be given as an iterator instead of
+        read_file.
+        """
+        reads = reads if reads is not None else read_fasta_file(read_file)
+        recruitment = self.get_recruitment_parameters(illumina)
         vntr_read_ids = {}
-        empty_set = True
-        for vid in self.target_vntr_ids:
-            vntr_reads[vid] = []
-            read_ids = self.vntr_finder[vid].filter_reads_with_keyword_matching(self.working_dir, read_file, illumina)
-            vntr_read_ids[vid] = read_ids
-            if len(read_ids) > 0:
-                empty_set = False
-
-        if not empty_set:
-            unmapped_reads = SeqIO.parse(read_file, 'fasta')
-            for read in unmapped_reads:
-                for vntr_id in vntr_read_ids.keys():
-                    if read.id in vntr_read_ids[vntr_id]:
+        if sample_cache is not None:
+            vntr_read_ids = sample_cache.load_read_ids(recruitment, self.vntr_finder, illumina)
+            logging.info('Reusing selected reads of %s VNTRs from %s' % (len(vntr_read_ids), sample_cache.directory))
+        new_vntr_ids = [vid for vid in self.target_vntr_ids if vid not in vntr_read_ids]
+
+        if settings.USE_KMER_RECRUITMENT:
+            vntr_reads = self.get_vntr_recruited_reads_map(reads, illumina, new_vntr_ids, vntr_read_ids)
+            new_vntr_read_ids = {vid: set([read.id for read in vntr_reads[vid]]) for vid in new_vntr_ids}
+        else:
+            new_vntr_read_ids = self.get_vntr_blast_read_ids(read_file, illumina, new_vntr_ids, sample_cache)
+            vntr_read_ids.update(new_vntr_read_ids)
+            vntr_reads = self.get_reads_by_ids(reads, vntr_read_ids)
+        if sample_cache is not None:
+            sample_cache.save_read_ids(recruitment, self.vntr_finder, new_vntr_read_ids, illumina)
+        return vntr_reads
+
+    @staticmethod
+    def get_vntrs_of_reads(vntr_read_ids):
+        vntrs_of_reads = {}
+        for vntr_id, read_ids in vntr_read_ids.items():
+            for read_id in read_ids:
+                vntrs_of_reads.setdefault(read_id, []).append(vntr_id)
+        return vntrs_of_reads
+
+    def get_reads_by_ids(self, reads, vntr_read_ids):
+        vntr_reads = {vid: [] for vid in self.target_vntr_ids}
+        vntrs_of_reads = self.get_vntrs_of_reads(vntr_read_ids)
+        if len(vntrs_of_reads):
+            for read in reads:
+                if read.id in vntrs_of_reads:
+                    for vntr_id in vntrs_of_reads[read.id]:
                         vntr_reads[vntr_id].append(read)
         return vntr_reads
 
+    def get_vntr_blast_read_ids(self, read_file, illumina=True, vntr_ids=None, sample_cache=None):
+        """Search the keyword matching queries of the VNTRs together and return the read ids of each VNTR
+
+        Identical queries are searched once, and all queries with the same BLAST parameters are searched with one
+        blastn run. Short reads are selected by any repeat segment of a VNTR and long reads by both flanking regions.
+        """
+        vntr_ids = vntr_ids if vntr_ids is not None else self.target_vntr_ids
+        vntr_read_ids = {vid: set([]) for vid in vntr_ids}
+        if not len(vntr_ids):
+            return vntr_read_ids
+        db_size = None
+        prefilter = self.get_read_prefilter(vntr_ids, illumina)
+        if prefilter is not None:
+            prefiltered_file, db_size = self.get_prefiltered_read_file(read_file, vntr_ids, prefilter)
+            blast_db_name, empty_db = get_blast_database(os.path.dirname(prefiltered_file) + '/', prefiltered_file)
+        elif sample_cache is not None:
+            blast_db_name, empty_db = sample_cache.get_blast_database(read_file)
+        else:
+            blast_db_name, empty_db = get_blast_database(self.working_dir, read_file)
+        if empty_db:
+            return vntr_read_ids
+
+        searches = {}
+        query_groups = {}
+        for vid in vntr_ids:
+            queries, word_size, identity_cutoff = self.vntr_finder[vid].get_keyword_matching_queries(illumina)
+            for i, query in enumerate(queries):
+                search_queries = searches.setdefault((word_size, get_blast_task(query), identity_cutoff), {})
+                if query not in search_queries:
+                    search_queries[query] = '%s_%s' % (vid, len(query_groups))
+                    query_groups[search_queries[query]] = set([])
+                query_groups[search_queries[query]].add((vid, 0 if illumina else i))
+
+        group_read_ids = {}
+        max_seq = 50000
+        search_id = str(uuid4())
+        for (word_size, task, identity_cutoff), search_queries in searches.items():
+            queries = {query_id: query for query, query_id in search_queries.items()}
+            matched_ids = get_blast_matched_ids_of_queries(queries, blast_db_name, str(word_size), str(max_seq), 10,
+                                                           search_id, task=task, identity_cutoff=str(identity_cutoff),
+                                                           db_size=db_size)
+            for query_id, read_ids in matched_ids.items():
+                if len(read_ids) == max_seq:
+                    vntrs_of_query = sorted(set([vid for vid, group in query_groups[query_id]]))
+                    logging.error('maximum number of read selected in filtering for pattern %s' %
+                                  ','.join([str(vid) for vid in vntrs_of_query]))
+                for vntr_group in query_groups[query_id]:
+                    group_read_ids.setdefault(vntr_group, set([])).update(read_ids)
+
+        for vid in vntr_ids:
+            vntr_read_ids[vid] = group_read_ids.get((vid, 0), set([]))
+            if not illumina:
+                vntr_read_ids[vid] = vntr_read_ids[vid] & group_read_ids.get((vid, 1), set([]))
+        if prefilter is not None:
+            vntr_read_ids = self.get_read_ids_passing_vntr_prefilters(prefiltered_file, vntr_read_ids)
+        for vid in vntr_ids:
+            logging.info('blast selected %s reads for %s' % (len(vntr_read_ids[vid]), vid))
+        return vntr_read_ids
+
+    def get_vntr_recruited_reads_map(self, reads, illumina=True, vntr_ids=None, vntr_read_ids=None):
+        """Select the reads of the VNTRs with one pass over the reads
+
+        The same pass collects the reads with the given ids of the other VNTRs.
+        """
+        vntr_ids = vntr_ids if vntr_ids is not None else self.target_vntr_ids
+        if not len(vntr_ids):
+            return self.get_reads_by_ids(reads, vntr_read_ids)
+        vntr_reads = {vid: [] for vid in self.target_vntr_ids}
+        vntrs_of_reads = self.get_vntrs_of_reads(vntr_read_ids or {})
+
+        def collect_reads_by_ids(reads):
+            for read in reads:
+                for vntr_id in vntrs_of_reads.get(read.id, []):
+                    vntr_reads[vntr_id].append(read)
+                yield read
+
+        recruiter = KmerRecruiter({vid: self.vntr_finder[vid] for vid in vntr_ids}, illumina)
+        for read, recruited_vntr_ids in recruiter.recruit_reads(collect_reads_by_ids(reads)):
+            for vntr_id in recruited_vntr_ids:
+                vntr_reads[vntr_id].append(read)
+        for vid in vntr_ids:
+            logging.info('k-mer index selected %s reads for %s' % (len(vntr_reads[vid]), vid))
+        return vntr_reads
+
+    def get_vntr_unmapped_reads_map(self, alignment_file, illumina=True):
+        """Return the unmapped reads of each target VNTR
+
+        With k-mer recruitment, unmapped reads are streamed from the alignment file into recruitment, unless an
+        earlier run has extracted them. BLAST searches need the unmapped reads in a fasta file.
+        """
+        sample_cache = self.get_sample_cache(alignment_file)
+        if settings.USE_KMER_RECRUITMENT:
+            return self.get_vntr_filtered_reads_map(None, illumina, sample_cache, sample_cache.get_unmapped_reads())
+        unmapped_reads_file = sample_cache.get_unmapped_reads_file()
+        return self.get_vntr_filtered_reads_map(unmapped_reads_file, illumina, sample_cache)
+
     def find_repeat_counts_from_pacbio_alignment_file(self, alignment_file):
-        unmapped_reads_file = extract_unmapped_reads_to_fasta_file(alignment_file, self.working_dir)
-        vntr_reads = self.get_vntr_filtered_reads_map(unmapped_reads_file, False)
+        vntr_reads = self.get_vntr_unmapped_reads_map(alignment_file, False)
 
         for vid in self.target_vntr_ids:
             reads = vntr_reads[vid]
@@ -54,7 +255,7 @@ class GenomeAnalyzer:
             self.print_genotype(copy_numbers)
 
     def find_repeat_counts_from_pacbio_reads(self, read_file, naive=False):
-        vntr_reads = self.get_vntr_filtered_reads_map(read_file, False)
+        vntr_reads = self.get_vntr_filtered_reads_map(read_file, False, self.get_sample_cache(read_file))
         for vid in self.target_vntr_ids:
             copy_numbers = self.vntr_finder[vid].find_repeat_count_from_pacbio_reads(vntr_reads[vid], naive)
             print(vid)
@@ -67,8 +268,8 @@ class GenomeAnalyzer:
             print(result)
 
     def find_repeat_counts_from_alignment_file(self, alignment_file):
-        unmapped_reads_file = extract_unmapped_reads_to_fasta_file(alignment_file, self.working_dir)
-        vntr_reads = self.get_vntr_filtered_reads_map(unmapped_reads_file)
+        get_threshold_store().load_thresholds(self.target_vntr_ids)
+        vntr_reads = self.get_vntr_unmapped_reads_map(alignment_file, True)
         for vid in self.target_vntr_ids:
             unmapped_reads = vntr_reads[vid]
             copy_number = self.vntr_finder[vid].find_repeat_count_from_alignment_file(alignment_file, unmapped_reads)
@@ -4,6 +4,7 @@ import numpy as np
 
 from profile_hmm import build_profile_hmm_for_repeats
 from profiler import time_usage
+from utils import COMPLEMENT_TRANSLATION, get_reverse_complement
 import settings
 
 
@@ -19,14 +20,65 @@ def path_to_alignment(x, y, path):
     return x, y
 
 
-def get_emitted_basepair_from_visited_states(state, visited_states, sequence):
-    base_pair_idx = 0
-    for visited_state in visited_states:
-        if visited_state == state:
-            return sequence[base_pair_idx]
-        if is_matching_state(visited_state):
-            base_pair_idx += 1
-    return None
+DNA_COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+
+MATCH_STATE, INSERT_STATE, DELETE_STATE, UNIT_START_STATE, UNIT_END_STATE, OTHER_STATE = range(6)
+REPEAT_REGION, PREFIX_REGION, SUFFIX_REGION = range(3)
+
+
+def get_state_category(state_name):
+    if state_name.startswith('unit_start'):
+        return UNIT_START_STATE
+    if state_name.startswith('unit_end'):
+        return UNIT_END_STATE
+    if state_name.startswith('M'):
+        return MATCH_STATE
+    if state_name.startswith('I'):
+        return INSERT_STATE
+    if state_name.startswith('D'):
+        return DELETE_STATE
+    return OTHER_STATE
+
+
+def get_state_region(state_name):
+    if state_name.endswith('prefix'):
+        return PREFIX_REGION
+    if state_name.endswith('suffix'):
+        return SUFFIX_REGION
+    return REPEAT_REGION
+
+
+class StateTable:
+    """Category, region and position of each state of a model, indexed by state index
+
+    It is built once per model, so Viterbi paths can be kept as arrays of state indices and summarized with numpy
+    instead of comparing the state names along each path.
+    """
+    def __init__(self, model):
+        self.names = [state.name for state in model.states]
+        self.categories = np.array([get_state_category(name) for name in self.names], dtype=np.int8)
+        self.regions = np.array([get_state_region(name) for name in self.names], dtype=np.int8)
+        self.emitting = np.array([is_matching_state(name) for name in self.names], dtype=bool)
+        self.positions = np.full(len(self.names), -1, dtype=np.int32)
+        self.units = np.full(len(self.names), -1, dtype=np.int32)
+        for i, name in enumerate(self.names):
+            if self.categories[i] in (MATCH_STATE, INSERT_STATE, DELETE_STATE):
+                self.positions[i] = int(name.split('_')[0][1:])
+            if self.categories[i] != OTHER_STATE and self.regions[i] == REPEAT_REGION:
+                self.units[i] = int(name.split('_')[-1])
+
+
+def get_state_indices_from_vpath(vpath):
+    return np.array([idx for idx, state in vpath], dtype=np.int32)
+
+
+def get_emitted_basepair_from_vpath(state_index, vpath, state_table, sequence):
+    visited_states = vpath[1:-1]
+    occurrences = np.flatnonzero(visited_states == state_index)
+    if not len(occurrences):
+        return None
+    return sequence[np.count_nonzero(state_table.emitting[visited_states[:occurrences[0]]])]
 
 
 def is_matching_state(state_name):
@@ -36,23 +88,23 @@ def is_matching_state(state_name):
     return False
 
 
-def get_repeating_pattern_lengths(visited_states):
-    lengths = []
-    prev_start = None
-    for i in range(len(visited_states)):
-        if visited_states[i].startswith('unit_end') and prev_start is not None:
-            current_len = 0
-            for j in range(prev_start, i):
-                if is_matching_state(visited_states[j]):
-                    current_len += 1
-            lengths.append(current_len)
-        if visited_states[i].startswith('unit_start'):
-            prev_start = i
-    return lengths
+def get_repeating_pattern_lengths_of_visited_states(categories, current_bp):
+    starts = np.flatnonzero(categories == UNIT_START_STATE)
+    ends = np.flatnonzero(categories == UNIT_END_STATE)
+    ends = ends[ends > starts[0]] if len(starts) else ends[:0]
+    prev_starts = starts[np.searchsorted(starts, ends) - 1]
+    return list(current_bp[ends] - current_bp[prev_starts])
+
 
+def get_repeating_pattern_lengths(vpath, state_table):
+    visited_states = vpath[1:-1]
+    categories = state_table.categories[visited_states]
+    current_bp = np.cumsum(state_table.emitting[visited_states])
+    return get_repeating_pattern_lengths_of_visited_states(categories, current_bp)
 
-def get_repeat_segments_from_visited_states_and_region(visited_states, region):
-    lengths = get_repeating_pattern_lengths(visited_states)
+
+def get_repeat_segments_from_vpath_and_region(vpath, state_table, region):
+    lengths = get_repeating_pattern_lengths(vpath, state_table)
 
     repeat_segments = []
     added = 0
@@ -62,72 +114,91 @@ def get_repeat_segments_from_visited_states_and_region(visited_states, region):
     return repeat_segments
 
 
-def get_number_of_repeats_in_vpath(vpath):
-    starts = 0
-    ends = 0
-    visited_states = [state.name for idx, state in vpath[1:-1]]
-
-    read_length = 0
-    for vs in visited_states:
-        if is_matching_state(vs):
-            read_length += 1
+def get_number_of_repeats_in_visited_states(categories, current_bp):
+    read_length = current_bp[-1] if len(current_bp) else 0
 
     minimum_required_bp_in_repeat = 3
-    current_bp = 0
-    first_end = None
-    last_end = None
-    first_start = None
-    last_start = None
-    for i in range(len(visited_states)):
-        if is_matching_state(visited_states[i]):
-            current_bp += 1
-        if visited_states[i].startswith('unit_start') and read_length - current_bp >= minimum_required_bp_in_repeat:
-            if first_start is None:
-                first_start = current_bp
-            last_start = current_bp
-            starts += 1
-        if visited_states[i].startswith('unit_end') and current_bp >= minimum_required_bp_in_repeat:
-            if first_end is None:
-                first_end = current_bp
-            last_end = current_bp
-            ends += 1
+    start_bps = current_bp[(categories == UNIT_START_STATE) &
+                           (read_length - current_bp >= minimum_required_bp_in_repeat)]
+    end_bps = current_bp[(categories == UNIT_END_STATE) & (current_bp >= minimum_required_bp_in_repeat)]
     delta = 0
-    if last_start is not None and first_start is not None and last_end is not None and first_end is not None:
-        if first_end < first_start and last_start > last_end:
+    if len(start_bps) and len(end_bps):
+        if end_bps[0] < start_bps[0] and start_bps[-1] > end_bps[-1]:
             delta = 1
-    return max(starts, ends) + delta
-
-
-def get_number_of_repeat_bp_matches_in_vpath(vpath):
-    visited_states = [state.name for idx, state in vpath[1:-1]]
-    result = 0
-    for i in range(len(visited_states)):
-        if is_matching_state(visited_states[i]) and not visited_states[i].endswith('fix'):
-            result += 1
-    return result
-
-
-def get_left_flanking_region_size_in_vpath(vpath):
-    visited_states = [state.name for idx, state in vpath[1:-1]]
-    result = 0
-    for i in range(len(visited_states)):
-        if is_matching_state(visited_states[i]) and visited_states[i].endswith('suffix'):
-            result += 1
-    return result
-
-
-def get_right_flanking_region_size_in_vpath(vpath):
-    visited_states = [state.name for idx, state in vpath[1:-1]]
-    result = 0
-    for i in range(len(visited_states)):
-        if is_matching_state(visited_states[i]) and visited_states[i].endswith('prefix'):
-            result += 1
-    return result
-
-
-@time_usage
-def get_prefix_matcher_hmm(pattern):
-    model = Model(name="Prefix Matcher HMM Model")
+    return max(len(start_bps), len(end_bps)) + delta
+
+
+def get_number_of_repeats_in_vpath(vpath, state_table):
+    visited_states = vpath[1:-1]
+    categories = state_table.categories[visited_states]
+    current_bp = np.cumsum(state_table.emitting[visited_states])
+    return get_number_of_repeats_in_visited_states(categories, current_bp)
+
+
+def get_number_of_repeat_bp_matches_in_vpath(vpath, state_table):
+    visited_states = vpath[1:-1]
+    repeat_states = state_table.emitting & (state_table.regions == REPEAT_REGION)
+    return int(np.count_nonzero(repeat_states[visited_states]))
+
+
+def get_left_flanking_region_size_in_vpath(vpath, state_table):
+    visited_states = vpath[1:-1]
+    left_flanking_states = state_table.emitting & (state_table.regions == SUFFIX_REGION)
+    return int(np.count_nonzero(left_flanking_states[visited_states]))
+
+
+def get_right_flanking_region_size_in_vpath(vpath, state_table):
+    visited_states = vpath[1:-1]
+    right_flanking_states = state_table.emitting & (state_table.regions == PREFIX_REGION)
+    return int(np.count_nonzero(right_flanking_states[visited_states]))
+
+
+class VpathSummary:
+    """What genotyping and frameshift calling need from the Viterbi path of a read
+
+    The path is looked up in the state table once and every value is computed from the same arrays. indels holds a
+    (repeat unit index, mutation) pair for each insertion or deletion in the repeats, where mutation is the state
+    name without the unit, followed by the inserted base pair for insertions, e.g. D3 or I5T.
+    """
+    def __init__(self, vpath, state_table, sequence):
+        visited_states = vpath[1:-1]
+        categories = state_table.categories[visited_states]
+        regions = state_table.regions[visited_states]
+        emitting = state_table.emitting[visited_states]
+        current_bp = np.cumsum(emitting)
+        emitted_bps = np.bincount(regions[emitting], minlength=3)
+
+        self.repeats = get_number_of_repeats_in_visited_states(categories, current_bp)
+        self.repeat_bps = int(emitted_bps[REPEAT_REGION])
+        self.left_flanking_size = int(emitted_bps[SUFFIX_REGION])
+        self.right_flanking_size = int(emitted_bps[PREFIX_REGION])
+        self.unit_lengths = get_repeating_pattern_lengths_of_visited_states(categories, current_bp)
+
+        units = np.cumsum(categories == UNIT_START_STATE) - 1
+        indels = (categories == INSERT_STATE) | (categories == DELETE_STATE)
+        indels &= (regions == REPEAT_REGION) & (units >= 0) & (units < len(self.unit_lengths))
+        # The cyclic topology visits the same insert states in every unit, so first visits are found per unit
+        unit_states = units * len(state_table.names) + visited_states
+        first_visits = {}
+        if np.any(indels & (categories == INSERT_STATE)):
+            unique_unit_states, first_indices = np.unique(unit_states, return_index=True)
+            first_visits = dict(zip(unique_unit_states, first_indices))
+        self.indels = []
+        for i in np.flatnonzero(indels):
+            state = visited_states[i]
+            if categories[i] == INSERT_STATE:
+                # current_bp at the first visit of this insert state in the unit includes the base pair it emitted
+                first_visit = first_visits[unit_states[i]]
+                mutation = 'I%s%s' % (state_table.positions[state], sequence[current_bp[first_visit] - 1])
+            else:
+                mutation = 'D%s' % state_table.positions[state]
+            self.indels.append((units[i], mutation))
+
+
+def add_prefix_matcher_to_model(model, pattern):
+    """Add the states that align the end of a read to a prefix of the pattern and return the silent states to enter
+    and to leave them
+    """
     insert_distribution = DiscreteDistribution({'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25})
     insert_states = []
     match_states = []
@@ -149,10 +220,6 @@ def get_prefix_matcher_hmm(pattern):
     model.add_states(insert_states + match_states + delete_states + [unit_start, unit_end])
     last = len(delete_states)-1
 
-    model.add_transition(model.start, unit_start, 1)
-
-    model.add_transition(unit_end, model.end, 1)
-
     model.add_transition(unit_start, match_states[0], 0.98)
     model.add_transition(unit_start, delete_states[0], 0.01)
     model.add_transition(unit_start, insert_states[0], 0.01)
@@ -185,14 +252,13 @@ def get_prefix_matcher_hmm(pattern):
             model.add_transition(delete_states[i], delete_states[i+1], 0.01)
             model.add_transition(delete_states[i], match_states[i+1], 0.98)
 
-    model.bake(merge=None)
+    return unit_start, unit_end
 
-    return model
 
-
-@time_usage
-def get_suffix_matcher_hmm(pattern):
-    model = Model(name="Suffix Matcher HMM Model")
+def add_suffix_matcher_to_model(model, pattern):
+    """Add the states that align the start of a read to a suffix of the pattern and return the silent states to enter
+    and to leave them
+    """
     insert_distribution = DiscreteDistribution({'A': 0.25, 'C': 0.25, 'G': 0.25, 'T': 0.25})
     insert_states = []
     match_states = []
@@ -214,10 +280,6 @@ def get_suffix_matcher_hmm(pattern):
     model.add_states(insert_states + match_states + delete_states + [unit_start, unit_end])
     last = len(delete_states)-1
 
-    model.add_transition(model.start, unit_start, 1)
-
-    model.add_transition(unit_end, model.end, 1)
-
     model.add_transition(unit_start, delete_states[0], 0.01)
     model.add_transition(unit_start, insert_states[0], 0.01)
     for i in range(len(pattern)):
@@ -250,180 +312,160 @@ def get_suffix_matcher_hmm(pattern):
             model.add_transition(delete_states[i], delete_states[i+1], 0.01)
             model.add_transition(delete_states[i], match_states[i+1], 0.98)
 
-    model.bake(merge=None)
+    return unit_start, unit_end
 
-    return model
 
+def add_repeat_unit_profile_to_model(model, transitions, emissions, repeat, read_end=None, read_end_probability=0):
+    """Add the states of one repeat unit profile and return its silent start and end, insert states and match states
 
-@time_usage
-def get_constant_number_of_repeats_matcher_hmm(patterns, copies):
-    model = Model(name="Repeating Pattern Matcher HMM Model")
-
-    transitions, emissions = build_profile_hmm_for_repeats(patterns, settings.MAX_ERROR_RATE)
+    If read_end is given, each match state can also end the read in it with read_end_probability, and the other
+    transitions of the match states are divided so they still sum to one.
+    """
+    insert_states = []
+    match_states = []
+    delete_states = []
     matches = [m for m in emissions.keys() if m.startswith('M')]
+    for i in range(len(matches) + 1):
+        insert_distribution = DiscreteDistribution(emissions['I%s' % i])
+        insert_states.append(State(insert_distribution, name='I%s_%s' % (i, repeat)))
 
-    last_end = None
-    for repeat in range(copies):
-        insert_states = []
-        match_states = []
-        delete_states = []
-        for i in range(len(matches) + 1):
-            insert_distribution = DiscreteDistribution(emissions['I%s' % i])
-            insert_states.append(State(insert_distribution, name='I%s_%s' % (i, repeat)))
+    for i in range(1, len(matches) + 1):
+        match_distribution = DiscreteDistribution(emissions['M%s' % i])
+        match_states.append(State(match_distribution, name='M%s_%s' % (str(i), repeat)))
 
-        for i in range(1, len(matches) + 1):
-            match_distribution = DiscreteDistribution(emissions['M%s' % i])
-            match_states.append(State(match_distribution, name='M%s_%s' % (str(i), repeat)))
+    for i in range(1, len(matches) + 1):
+        delete_states.append(State(None, name='D%s_%s' % (str(i), repeat)))
 
-        for i in range(1, len(matches) + 1):
-            delete_states.append(State(None, name='D%s_%s' % (str(i), repeat)))
+    unit_start = State(None, name='unit_start_%s' % repeat)
+    unit_end = State(None, name='unit_end_%s' % repeat)
+    model.add_states(insert_states + match_states + delete_states + [unit_start, unit_end])
+    n = len(delete_states)-1
+    match_total = 1 + read_end_probability
 
-        unit_start = State(None, name='unit_start_%s' % repeat)
-        unit_end = State(None, name='unit_end_%s' % repeat)
-        model.add_states(insert_states + match_states + delete_states + [unit_start, unit_end])
-        n = len(delete_states)-1
+    model.add_transition(unit_start, match_states[0], transitions['unit_start']['M1'])
+    model.add_transition(unit_start, delete_states[0], transitions['unit_start']['D1'])
+    model.add_transition(unit_start, insert_states[0], transitions['unit_start']['I0'])
 
-        if repeat > 0:
-            model.add_transition(last_end, unit_start, 1)
-        else:
-            model.add_transition(model.start, unit_start, 1)
+    model.add_transition(insert_states[0], insert_states[0], transitions['I0']['I0'])
+    model.add_transition(insert_states[0], delete_states[0], transitions['I0']['D1'])
+    model.add_transition(insert_states[0], match_states[0], transitions['I0']['M1'])
 
-        if repeat == copies - 1:
-            model.add_transition(unit_end, model.end, 1)
+    model.add_transition(delete_states[n], unit_end, transitions['D%s' % (n+1)]['unit_end'])
+    model.add_transition(delete_states[n], insert_states[n+1], transitions['D%s' % (n+1)]['I%s' % (n+1)])
+
+    model.add_transition(match_states[n], unit_end, transitions['M%s' % (n+1)]['unit_end'] / match_total)
+    model.add_transition(match_states[n], insert_states[n+1],
+                         transitions['M%s' % (n+1)]['I%s' % (n+1)] / match_total)
+
+    model.add_transition(insert_states[n+1], insert_states[n+1], transitions['I%s' % (n+1)]['I%s' % (n+1)])
+    model.add_transition(insert_states[n+1], unit_end, transitions['I%s' % (n+1)]['unit_end'])
 
-        model.add_transition(unit_start, match_states[0], transitions['unit_start']['M1'])
-        model.add_transition(unit_start, delete_states[0], transitions['unit_start']['D1'])
-        model.add_transition(unit_start, insert_states[0], transitions['unit_start']['I0'])
+    for i in range(1, len(matches)+1):
+        model.add_transition(match_states[i-1], insert_states[i], transitions['M%s' % i]['I%s' % i] / match_total)
+        model.add_transition(delete_states[i-1], insert_states[i], transitions['D%s' % i]['I%s' % i])
+        model.add_transition(insert_states[i], insert_states[i], transitions['I%s' % i]['I%s' % i])
+        if i < len(matches):
+            model.add_transition(insert_states[i], match_states[i], transitions['I%s' % i]['M%s' % (i+1)])
+            model.add_transition(insert_states[i], delete_states[i], transitions['I%s' % i]['D%s' % (i+1)])
 
-        model.add_transition(insert_states[0], insert_states[0], transitions['I0']['I0'])
-        model.add_transition(insert_states[0], delete_states[0], transitions['I0']['D1'])
-        model.add_transition(insert_states[0], match_states[0], transitions['I0']['M1'])
+            model.add_transition(match_states[i-1], match_states[i],
+                                 transitions['M%s' % i]['M%s' % (i+1)] / match_total)
+            model.add_transition(match_states[i-1], delete_states[i],
+                                 transitions['M%s' % i]['D%s' % (i+1)] / match_total)
 
-        model.add_transition(delete_states[n], unit_end, transitions['D%s' % (n+1)]['unit_end'])
-        model.add_transition(delete_states[n], insert_states[n+1], transitions['D%s' % (n+1)]['I%s' % (n+1)])
+            model.add_transition(delete_states[i-1], match_states[i], transitions['D%s' % i]['M%s' % (i+1)])
+            model.add_transition(delete_states[i-1], delete_states[i], transitions['D%s' % i]['D%s' % (i+1)])
 
-        model.add_transition(match_states[n], unit_end, transitions['M%s' % (n+1)]['unit_end'])
-        model.add_transition(match_states[n], insert_states[n+1], transitions['M%s' % (n+1)]['I%s' % (n+1)])
+    if read_end is not None:
+        for match_state in match_states:
+            model.add_transition(match_state, read_end, read_end_probability)
 
-        model.add_transition(insert_states[n+1], insert_states[n+1], transitions['I%s' % (n+1)]['I%s' % (n+1)])
-        model.add_transition(insert_states[n+1], unit_end, transitions['I%s' % (n+1)]['unit_end'])
+    return unit_start, unit_end, insert_states, match_states
 
-        for i in range(1, len(matches)+1):
-            model.add_transition(match_states[i-1], insert_states[i], transitions['M%s' % i]['I%s' % i])
-            model.add_transition(delete_states[i-1], insert_states[i], transitions['D%s' % i]['I%s' % i])
-            model.add_transition(insert_states[i], insert_states[i], transitions['I%s' % i]['I%s' % i])
-            if i < len(matches):
-                model.add_transition(insert_states[i], match_states[i], transitions['I%s' % i]['M%s' % (i+1)])
-                model.add_transition(insert_states[i], delete_states[i], transitions['I%s' % i]['D%s' % (i+1)])
 
-                model.add_transition(match_states[i-1], match_states[i], transitions['M%s' % i]['M%s' % (i+1)])
-                model.add_transition(match_states[i-1], delete_states[i], transitions['M%s' % i]['D%s' % (i+1)])
+def add_repeats_matcher_to_model(model, transitions, emissions, copies, read_end, read_end_probability):
+    """Add copies repeat unit profiles in a row, where the repeats can end after each unit
 
-                model.add_transition(delete_states[i-1], match_states[i], transitions['D%s' % i]['M%s' % (i+1)])
-                model.add_transition(delete_states[i-1], delete_states[i], transitions['D%s' % i]['D%s' % (i+1)])
+    Return the silent states to enter and to leave the repeats, and the match states of the first unit.
+    """
+    start_repeats_matches = State(None, name='start_repeating_pattern_match')
+    end_repeats_matches = State(None, name='end_repeating_pattern_match')
+    model.add_states([start_repeats_matches, end_repeats_matches])
 
+    last_end = start_repeats_matches
+    first_unit_match_states = None
+    for repeat in range(copies):
+        unit_start, unit_end, _, match_states = add_repeat_unit_profile_to_model(model, transitions, emissions, repeat,
+                                                                                 read_end, read_end_probability)
+        model.add_transition(last_end, unit_start, 1 if repeat == 0 else 0.5)
+        model.add_transition(unit_end, end_repeats_matches, 0.5)
+        if repeat == 0:
+            first_unit_match_states = match_states
         last_end = unit_end
 
-    model.bake(merge=None)
-    return model
+    return start_repeats_matches, end_repeats_matches, first_unit_match_states
 
 
-@time_usage
-def get_variable_number_of_repeats_matcher_hmm(patterns, copies=1):
-    model = get_constant_number_of_repeats_matcher_hmm(patterns, copies)
+def add_repeat_unit_loop_matcher_to_model(model, transitions, emissions, read_end, read_end_probability):
+    """Add a repeats matcher that loops back over a single repeat unit profile instead of unrolling it for each copy
+
+    Each pass over the profile visits unit_start_0 (or unit_start_loop_0 after the first unit) and unit_end_0, so the
+    number of repeat units in a path is counted in the same way as in add_repeats_matcher_to_model.
+    The loop can not enter the unit through the delete states, as the model can not have a cycle of silent states.
+    Return the silent states to enter and to leave the repeats, and the match states of the unit.
+    """
+    unit_start, unit_end, insert_states, match_states = add_repeat_unit_profile_to_model(model, transitions,
+                                                                                         emissions, 0, read_end,
+                                                                                         read_end_probability)
 
     start_repeats_matches = State(None, name='start_repeating_pattern_match')
     end_repeats_matches = State(None, name='end_repeating_pattern_match')
-    mat = model.dense_transition_matrix()
-    states = model.states
-    states.append(start_repeats_matches)
-    states.append(end_repeats_matches)
-    states_count = len(mat)
-    start_repeats_ind = states_count
-    end_repeats_ind = states_count + 1
-    mat = np.c_[mat, np.zeros(states_count), np.zeros(states_count)]
-    mat = np.r_[mat, [np.zeros(states_count + 2)]]
-    mat = np.r_[mat, [np.zeros(states_count + 2)]]
-
-    unit_ends = []
-    for i, state in enumerate(model.states):
-        if state.name.startswith('unit_end'):
-            unit_ends.append(i)
-
-    first_unit_start = None
-    for i in range(len(mat[model.start_index])):
-        if mat[model.start_index][i] != 0:
-            first_unit_start = i
-    mat[model.start_index][first_unit_start] = 0.0
-    mat[model.start_index][start_repeats_ind] = 1
-    mat[start_repeats_ind][first_unit_start] = 1
-
-    for unit_end in unit_ends:
-        next_state = None
-        for j in range(len(mat[unit_end])):
-            if mat[unit_end][j] != 0:
-                next_state = j
-        mat[unit_end][next_state] = 0.5
-        mat[unit_end][end_repeats_ind] = 0.5
-
-    mat[end_repeats_ind][model.end_index] = 1
-
-    starts = np.zeros(states_count + 2)
-    starts[model.start_index] = 1.0
-    ends = np.zeros(states_count + 2)
-    ends[model.end_index] = 1.0
-    state_names = [state.name for state in states]
-    distributions = [state.distribution for state in states]
-    name = 'Repeat Matcher HMM Model'
-    new_model = Model.from_matrix(mat, distributions, starts, ends, name=name, state_names=state_names, merge=None)
-    new_model.bake(merge=None)
-    return new_model
+    loop_start = State(None, name='unit_start_loop_0')
+    model.add_states([start_repeats_matches, end_repeats_matches, loop_start])
+
+    model.add_transition(start_repeats_matches, unit_start, 1)
+
+    model.add_transition(unit_end, loop_start, 0.5)
+    model.add_transition(unit_end, end_repeats_matches, 0.5)
+    loop_total = transitions['unit_start']['M1'] + transitions['unit_start']['I0']
+    model.add_transition(loop_start, match_states[0], transitions['unit_start']['M1'] / loop_total)
+    model.add_transition(loop_start, insert_states[0], transitions['unit_start']['I0'] / loop_total)
+
+    return start_repeats_matches, end_repeats_matches, match_states
 
 
 @time_usage
-def get_read_matcher_model(left_flanking_region, right_flanking_region, patterns, copies=1):
-    model = get_suffix_matcher_hmm(left_flanking_region)
-    repeats_matcher = get_variable_number_of_repeats_matcher_hmm(patterns, copies)
-    right_flanking_matcher = get_prefix_matcher_hmm(right_flanking_region)
-    model.concatenate(repeats_matcher)
-    model.concatenate(right_flanking_matcher)
-    model.bake(merge=None)
+def get_read_matcher_model(left_flanking_region, right_flanking_region, patterns, copies=1, cyclic=False):
+    """Build the HMM that aligns a read to the flanking regions and the repeats
+
+    A read starts in the left flanking region or in the first repeat unit, and it can end in the repeats from any match
+    state. If cyclic is True, the repeats are matched by looping over a single repeat unit profile, so the number of
+    states does not grow with copies. The probability of a read ending in the repeats is still divided over copies
+    units. All states and edges are added to one model, which is baked once.
+    """
+    model = Model(name='Read Matcher')
+    transitions, emissions = build_profile_hmm_for_repeats(patterns, settings.MAX_ERROR_RATE)
+    unit_match_states = len([name for name in emissions.keys() if name.startswith('M')])
+    read_end_probability = 0.7 / (unit_match_states * copies)
+
+    suffix_start, suffix_end = add_suffix_matcher_to_model(model, left_flanking_region)
+    if cyclic:
+        repeats_start, repeats_end, first_unit_match_states = add_repeat_unit_loop_matcher_to_model(
+            model, transitions, emissions, model.end, read_end_probability)
+    else:
+        repeats_start, repeats_end, first_unit_match_states = add_repeats_matcher_to_model(
+            model, transitions, emissions, copies, model.end, read_end_probability)
+    prefix_start, prefix_end = add_prefix_matcher_to_model(model, right_flanking_region)
+
+    model.add_transition(model.start, suffix_start, 0.3)
+    for match_state in first_unit_match_states:
+        model.add_transition(model.start, match_state, 0.7 / len(first_unit_match_states))
+    model.add_transition(suffix_end, repeats_start, 1)
+    model.add_transition(repeats_end, prefix_start, 1)
+    model.add_transition(prefix_end, model.end, 1)
 
-    mat = model.dense_transition_matrix()
-
-    first_repeat_matches = []
-    repeat_match_states = []
-    suffix_start = None
-    for i, state in enumerate(model.states):
-        if state.name[0] == 'M' and state.name.split('_')[-1] == '0':
-            first_repeat_matches.append(i)
-        if state.name[0] == 'M' and state.name.split('_')[-1] not in ['prefix', 'suffix']:
-            repeat_match_states.append(i)
-        if state.name == 'suffix_start_suffix':
-            suffix_start = i
-
-    mat[model.start_index][suffix_start] = 0.3
-    for first_repeat_match in first_repeat_matches:
-        mat[model.start_index][first_repeat_match] = 0.7 / len(first_repeat_matches)
-
-    for match_state in repeat_match_states:
-        to_end = 0.7 / len(repeat_match_states)
-        total = 1 + to_end
-        for next_state in range(len(mat[match_state])):
-            if mat[match_state][next_state] != 0:
-                mat[match_state][next_state] /= total
-        mat[match_state][model.end_index] = to_end
-
-    starts = np.zeros(len(model.states))
-    starts[model.start_index] = 1.0
-    ends = np.zeros(len(model.states))
-    ends[model.end_index] = 1.0
-    state_names = [state.name for state in model.states]
-    distributions = [state.distribution for state in model.states]
-    name = 'Read Matcher'
-    new_model = Model.from_matrix(mat, distributions, starts, ends, name=name, state_names=state_names, merge=None)
-    new_model.bake(merge=None)
-    return new_model
+    model.bake(merge=None)
+    return model
 
 
 def build_reference_repeat_finder_hmm(patterns, copies=1):
@@ -0,0 +1,203 @@
+import numpy
+
+import settings
+from utils import get_reverse_complement
+
+
+# k-mers up to this size are found with a table of all 4^k k-mers instead of a binary search
+MAX_KMER_SIZE_OF_LOOKUP_TABLE = 11
+
+BASE_CODES = numpy.full(256, 4, dtype=numpy.int64)
+for code, bases in enumerate(['Aa', 'Cc', 'Gg', 'Tt']):
+    for base in bases:
+        BASE_CODES[ord(base)] = code
+
+
+class KmerIndex:
+    """Sorted codes of the k-mers of one size, and the groups that contain each k-mer
+
+    Other keys can be indexed the same way by giving the number of possible keys as code_count.
+    """
+
+    def __init__(self, k, codes, groups, group_count, code_count=None):
+        self.k = k
+        code_count = code_count if code_count is not None else 4 ** k
+        pairs = numpy.unique(codes * group_count + groups)
+        self.groups = pairs % group_count
+        self.codes, starts = numpy.unique(pairs // group_count, return_index=True)
+        self.offsets = numpy.append(starts, len(pairs))
+        self.table = None
+        self.prefixes = None
+        if code_count <= 4 ** MAX_KMER_SIZE_OF_LOOKUP_TABLE:
+            self.table = numpy.full(code_count, -1, dtype=numpy.int32)
+            self.table[self.codes] = numpy.arange(len(self.codes))
+        else:
+            self.prefix_shift = 2 * (k - MAX_KMER_SIZE_OF_LOOKUP_TABLE)
+            self.prefixes = numpy.zeros(4 ** MAX_KMER_SIZE_OF_LOOKUP_TABLE, dtype=bool)
+            self.prefixes[self.codes >> self.prefix_shift] = True
+
+    def find_kmers(self, codes):
+        """Return the index of each k-mer code in the sorted codes, or -1 if it is not in the index
+
+        Larger k-mers are only searched if their prefix is the prefix of a k-mer in the index.
+        """
+        if self.table is not None:
+            return self.table[codes]
+        kmers = numpy.full(len(codes), -1, dtype=numpy.int64)
+        candidates = numpy.flatnonzero(self.prefixes[codes >> self.prefix_shift])
+        found = numpy.minimum(numpy.searchsorted(self.codes, codes[candidates]), len(self.codes) - 1)
+        found[self.codes[found] != codes[candidates]] = -1
+        kmers[candidates] = found
+        return kmers
+
+    def find_groups(self, codes):
+        """Return the index in codes and the group of each hit of the k-mer codes in the index"""
+        kmers = self.find_kmers(codes)
+        positions = numpy.flatnonzero(kmers >= 0)
+        kmers = kmers[positions]
+        starts = self.offsets[kmers]
+        counts = self.offsets[kmers + 1] - starts
+        first_hits = numpy.cumsum(counts) - counts
+        groups = self.groups[numpy.repeat(starts - first_hits, counts) + numpy.arange(counts.sum())]
+        return numpy.repeat(positions, counts), groups
+
+
+def get_bases_of_sequences(sequences):
+    """Return the base codes of the sequences joined by N, and the index of the sequence of each position"""
+    joined_sequences = 'N'.join([str(sequence) for sequence in sequences])
+    bases = BASE_CODES[numpy.frombuffer(joined_sequences, dtype=numpy.uint8)]
+    lengths = numpy.array([len(sequence) + 1 for sequence in sequences])
+    sequence_of_position = numpy.repeat(numpy.arange(len(sequences)), lengths)[:len(bases)]
+    return bases, sequence_of_position
+
+
+def process_reads_in_chunks(reads, process_chunk, chunk_size=None):
+    """Yield the results of process_chunk on consecutive chunks of reads, so only one chunk of reads is kept in memory"""
+    chunk_size = chunk_size if chunk_size is not None else settings.RECRUITMENT_CHUNK_SIZE
+    chunk = []
+    for read in reads:
+        chunk.append(read)
+        if len(chunk) == chunk_size:
+            for result in process_chunk(chunk):
+                yield result
+            chunk = []
+    for result in process_chunk(chunk):
+        yield result
+
+
+def get_kmer_codes(sequence, k):
+    """Return the codes of the k-mers of sequence that only have A, C, G or T"""
+    bases = BASE_CODES[numpy.frombuffer(sequence, dtype=numpy.uint8)]
+    if len(bases) < k:
+        return numpy.array([], dtype=numpy.int64)
+    codes, valid = get_rolling_kmer_codes(bases, k)
+    return codes[valid]
+
+
+def get_rolling_kmer_codes(bases, k):
+    """Return the code of the k-mer that starts at each position of bases and whether it only has A, C, G or T"""
+    positions = len(bases) - k + 1
+    codes = numpy.zeros(positions, dtype=numpy.int64)
+    for j in range(k):
+        codes = (codes << 2) | bases[j:j + positions]
+    invalid_bases = numpy.concatenate(([0], numpy.cumsum(bases == 4)))
+    valid = invalid_bases[k:k + positions] == invalid_bases[:positions]
+    return codes, valid
+
+
+def get_kmer_hits_at_identity(query_length, k, identity_cutoff):
+    """Return the number of k-mers of a query that a read with identity_cutoff percent identity is expected to share
+
+    Each k-mer is shared when all of its k bases match, so a read shares (identity_cutoff / 100) ** k of the k-mers.
+    """
+    return max(1, int((query_length - k + 1) * (identity_cutoff / 100.0) ** k))
+
+
+class KmerRecruiter:
+    """Select the reads of many VNTRs in one pass over the reads
+
+    The k-mers of the keyword matching queries of all VNTRs, and of their reverse complements, are kept in one index
+    per word size. A read is selected for a VNTR when it shares at least min_hits k-mers with its repeat segments, or
+    for long reads with each of its two flanking regions, like the BLAST searches of the keyword matching. K-mers
+    have the word size of the keyword matching, unless min_kmer_size raises it. Flanking regions with an identity
+    cutoff need as many k-mers as a read with that identity is expected to share, like the identity cutoff of BLAST.
+    Repeat segments are read cyclically so that segments shorter than the word size still have k-mers.
+    """
+
+    def __init__(self, vntr_finders, short_reads=True, min_hits=None, min_kmer_size=None):
+        min_hits = min_hits if min_hits is not None else settings.RECRUITMENT_MIN_KMER_HITS
+        min_kmer_size = min_kmer_size if min_kmer_size is not None else settings.RECRUITMENT_MIN_KMER_SIZE
+        self.vntr_ids = []
+        self.vntr_of_group = []
+        self.min_hits_of_group = []
+        self.required_groups = []
+        kmer_codes = {}
+        kmer_groups = {}
+        for vntr_id in sorted(vntr_finders.keys()):
+            queries, word_size, identity_cutoff = vntr_finders[vntr_id].get_keyword_matching_queries(short_reads)
+            if min_kmer_size is not None:
+                word_size = max(word_size, min_kmer_size)
+            query_groups = [[query] for query in queries] if not short_reads else [queries]
+            for group_queries in query_groups:
+                group = len(self.vntr_of_group)
+                self.vntr_of_group.append(len(self.vntr_ids))
+                if identity_cutoff:
+                    self.min_hits_of_group.append(get_kmer_hits_at_identity(len(group_queries[0]), word_size,
+                                                                            identity_cutoff))
+                else:
+                    self.min_hits_of_group.append(min_hits)
+                for query in group_queries:
+                    query = query.upper()
+                    if short_reads:
+                        query += (query * word_size)[:word_size - 1]
+                    for sequence in [query, get_reverse_complement(query)]:
+                        codes = get_kmer_codes(sequence, word_size)
+                        kmer_codes.setdefault(word_size, []).append(codes)
+                        kmer_groups.setdefault(word_size, []).append(numpy.full(len(codes), group, dtype=numpy.int64))
+            self.vntr_ids.append(vntr_id)
+            self.required_groups.append(len(query_groups))
+        self.vntr_of_group = numpy.array(self.vntr_of_group, dtype=numpy.int64)
+        self.min_hits_of_group = numpy.array(self.min_hits_of_group, dtype=numpy.int64)
+        self.required_groups = numpy.array(self.required_groups, dtype=numpy.int64)
+        self.indices = [KmerIndex(k, numpy.concatenate(kmer_codes[k]), numpy.concatenate(kmer_groups[k]),
+                                  len(self.vntr_of_group)) for k in sorted(kmer_codes.keys())]
+
+    def find_vntrs_of_sequences(self, sequences):
+        """Return the ids of the VNTRs that each sequence is selected for"""
+        result = [[] for _ in sequences]
+        if not len(sequences) or not len(self.vntr_ids):
+            return result
+        bases, sequence_of_position = get_bases_of_sequences(sequences)
+
+        group_count = len(self.vntr_of_group)
+        hits = []
+        for index in self.indices:
+            if len(bases) < index.k:
+                continue
+            codes, valid = get_rolling_kmer_codes(bases, index.k)
+            positions = numpy.flatnonzero(valid)
+            hit_positions, groups = index.find_groups(codes[positions])
+            hits.append(sequence_of_position[positions[hit_positions]] * group_count + groups)
+        if not len(hits):
+            return result
+
+        sequence_groups, group_hits = numpy.unique(numpy.concatenate(hits), return_counts=True)
+        sequence_groups = sequence_groups[group_hits >= self.min_hits_of_group[sequence_groups % group_count]]
+        sequence_vntrs = sequence_groups // group_count * len(self.vntr_ids) + \
+            self.vntr_of_group[sequence_groups % group_count]
+        sequence_vntrs, matched_groups = numpy.unique(sequence_vntrs, return_counts=True)
+        sequence_vntrs = sequence_vntrs[matched_groups == self.required_groups[sequence_vntrs % len(self.vntr_ids)]]
+        for sequence_index, vntr_index in zip(*divmod(sequence_vntrs, len(self.vntr_ids))):
+            result[sequence_index].append(self.vntr_ids[vntr_index])
+        return result
+
+    def recruit_reads(self, reads, chunk_size=None):
+        """Yield each read that is selected for a VNTR, with the ids of its VNTRs
+
+        Reads are streamed in chunks, so only one chunk of reads is kept in memory.
+        """
+        return process_reads_in_chunks(reads, self.recruit_chunk, chunk_size)
+
+    def recruit_chunk(self, reads):
+        vntrs_of_reads = self.find_vntrs_of_sequences([read.seq for read in reads])
+        return [(read, vntr_ids) for read, vntr_ids in zip(reads, vntrs_of_reads) if len(vntr_ids)]
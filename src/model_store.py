@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import io
+import os
+import sqlite3
+
+from pomegranate import HiddenMarkovModel as Model
+import settings
+
+
+class ModelStore:
+    """Read matcher models of many VNTRs in one sqlite database
+
+    Each model is stored as the npz archive written by Model.to_npz, keyed by VNTR id, read length and whether the
+    repeats are matched by the cyclic repeat unit matcher. Genotyping opens the store read-only, so one prebuilt store
+    can be shared by many runs.
+    """
+
+    def __init__(self, db_file, read_only=True):
+        self.db_file = db_file
+        self.db = sqlite3.connect(db_file)
+        if read_only:
+            self.db.execute('PRAGMA query_only = 1')
+        else:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS models (vntr_id INTEGER, read_length INTEGER,
+            cyclic INTEGER, model BLOB, PRIMARY KEY (vntr_id, read_length, cyclic))''')
+            self.db.commit()
+
+    def get_read_lengths(self, vntr_id, cyclic=False):
+        cursor = self.db.execute('SELECT read_length FROM models WHERE vntr_id = ? AND cyclic = ?',
+                                 (vntr_id, int(cyclic)))
+        return sorted([row[0] for row in cursor])
+
+    def has_model(self, vntr_id, read_length, cyclic=False):
+        return read_length in self.get_read_lengths(vntr_id, cyclic)
+
+    def load_model(self, vntr_id, read_length, cyclic=False):
+        """Return the stored model, or None if it is not in the store"""
+        cursor = self.db.execute('SELECT model FROM models WHERE vntr_id = ? AND read_length = ? AND cyclic = ?',
+                                 (vntr_id, read_length, int(cyclic)))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return Model.from_npz(io.BytesIO(row[0]))
+
+    def save_model_archive(self, vntr_id, read_length, cyclic, archive):
+        self.db.execute('INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?)',
+                        (vntr_id, read_length, int(cyclic), sqlite3.Binary(archive)))
+        self.db.commit()
+
+    def save_model(self, vntr_id, read_length, cyclic, model):
+        self.save_model_archive(vntr_id, read_length, cyclic, get_model_archive(model))
+
+
+def get_model_archive(model):
+    archive = io.BytesIO()
+    model.to_npz(archive)
+    return archive.getvalue()
+
+
+opened_model_stores = {}
+
+
+def get_model_store():
+    """Return the model store of this process opened read-only, or None if there is no prebuilt store"""
+    db_file = settings.MODEL_STORE_FILE
+    if db_file not in opened_model_stores:
+        opened_model_stores[db_file] = ModelStore(db_file) if os.path.isfile(db_file) else None
+    return opened_model_stores[db_file]
+
+
+class ModelCache:
+    """Read matcher models built in this process, evicted least recently used first
+
+    Models are keyed by VNTR id, copies, flanking region size and topology, and the cache is bounded by the total
+    number of states of its models. Only a model with the requested copies is returned, as the probability of a read
+    ending in the repeats depends on copies, so a model with more copies scores reads differently.
+    """
+
+    def __init__(self):
+        self.models = OrderedDict()
+        self.states = 0
+
+    def get_model(self, vntr_id, copies, flanking_region_size, cyclic=False):
+        key = (vntr_id, copies, flanking_region_size, cyclic)
+        if key not in self.models:
+            return None
+        model = self.models.pop(key)
+        self.models[key] = model
+        return model
+
+    def add_model(self, vntr_id, copies, flanking_region_size, cyclic, model):
+        key = (vntr_id, copies, flanking_region_size, cyclic)
+        if key in self.models:
+            self.states -= len(self.models.pop(key).states)
+        self.models[key] = model
+        self.states += len(model.states)
+        while self.states > settings.MAX_CACHED_MODEL_STATES and len(self.models) > 1:
+            key, evicted_model = self.models.popitem(last=False)
+            self.states -= len(evicted_model.states)
+
+
+read_matcher_cache = ModelCache()
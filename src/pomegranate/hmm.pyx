@@ -8,6 +8,7 @@ from __future__ import print_function
 
 from cython.view cimport array as cvarray
 from libc.math cimport exp as cexp
+from libc.math cimport fabs, sqrt
 from operator import attrgetter
 import math, random, itertools as it, sys, json
 import networkx
@@ -23,6 +24,7 @@ from .distributions cimport IndependentComponentsDistribution
 
 from .utils cimport _log
 from .utils cimport pair_lse
+from .utils cimport pair_lse_float
 
 from libc.stdlib cimport calloc
 from libc.stdlib cimport free
@@ -53,6 +55,7 @@ except ImportError:
 DEF NEGINF = float("-inf")
 DEF INF = float("inf")
 DEF SQRT_2_PI = 2.50662827463
+DEF ABANDON_MARGIN = 1e-9
 
 def _check_input(sequence, model):
     n = len(sequence)
@@ -70,6 +73,19 @@ def _check_input(sequence, model):
                         sequence_ndarray[i, j] = model.keymap[j][sequence[i][j]]
                     except:
                         raise ValueError("Symbol '{}' is not defined in a distribution".format(sequence[i][j]))
+    elif model.byte_keymap is not None and (isinstance(sequence, (bytes, bytearray)) or
+            (isinstance(sequence, numpy.ndarray) and sequence.dtype == numpy.uint8)):
+        # Encode byte strings (e.g. reads from pysam) with a single table
+        # lookup instead of going through the keymap one symbol at a time.
+        if isinstance(sequence, numpy.ndarray):
+            sequence_ndarray = model.byte_keymap[sequence]
+        else:
+            sequence_ndarray = model.byte_keymap[numpy.frombuffer(sequence, dtype=numpy.uint8)]
+
+        undefined = numpy.flatnonzero(numpy.isnan(sequence_ndarray))
+        if len(undefined) > 0:
+            raise ValueError("Symbol '{}' is not defined in a distribution".format(
+                sequence[undefined[0]]))
     else:
         sequence_ndarray = numpy.empty(n, dtype=numpy.float64)
         for i in range(n):
@@ -91,6 +107,20 @@ def log(value):
         return to_return
     return _log( value )
 
+ctypedef fused dp_t:
+    float
+    double
+
+cdef void* _npz_copy( numpy.ndarray array, dtype ):
+    """Copy an array read from an npz archive into a new C buffer."""
+
+    cdef void* buffer
+    array = numpy.ascontiguousarray( array, dtype=dtype )
+    buffer = calloc( max(array.nbytes, 1), 1 )
+    memcpy( buffer, array.data, array.nbytes )
+    return buffer
+
+
 cdef class HiddenMarkovModel( GraphModel ):
     """A Hidden Markov Model
 
@@ -131,6 +161,15 @@ cdef class HiddenMarkovModel( GraphModel ):
     states : list
         The list of all states in the model, with silent states at the end
 
+    single_precision : bool
+        Whether `viterbi`, `forward` and `log_probability` keep their DP
+        tables in float32 instead of float64, which halves their memory
+        traffic at the cost of precision. Training always uses float64, and
+        so do `viterbi_score`, the checkpointed Viterbi algorithm and the
+        scores that `viterbi_strands` and `viterbi_batch` use to pick a strand
+        or to abandon a sequence, as they keep O(m) columns only. Default is
+        False.
+
     Examples
     --------
     >>> from pomegranate import *
@@ -176,6 +215,7 @@ cdef class HiddenMarkovModel( GraphModel ):
     cdef int* tied_edges_starts
     cdef int* tied_edges_ends
     cdef double* in_transition_log_probabilities
+    cdef float* in_transition_log_probabilities_float
     cdef double* out_transition_log_probabilities
     cdef double* expected_transitions
     cdef int* in_edge_count
@@ -184,6 +224,10 @@ cdef class HiddenMarkovModel( GraphModel ):
     cdef int* out_transitions
     cdef int finite, n_tied_edge_groups
     cdef public list keymap
+    cdef public bint single_precision
+    cdef public numpy.ndarray byte_keymap
+    cdef numpy.ndarray max_emissions
+    cdef double* max_emissions_ptr
     cdef object state_names
     cdef numpy.ndarray distributions
     cdef void** distributions_ptr
@@ -216,6 +260,7 @@ cdef class HiddenMarkovModel( GraphModel ):
         self.in_transitions = NULL
         self.in_transition_pseudocounts = NULL
         self.in_transition_log_probabilities = NULL
+        self.in_transition_log_probabilities_float = NULL
         self.out_edge_count = NULL
         self.out_transitions = NULL
         self.out_transition_pseudocounts = NULL
@@ -230,6 +275,10 @@ cdef class HiddenMarkovModel( GraphModel ):
         self.tied_edges_ends = NULL
 
         self.state_names = set()
+        self.byte_keymap = None
+        self.max_emissions = None
+        self.max_emissions_ptr = NULL
+        self.single_precision = 0
 
     def __dealloc__(self):
         self.free_bake_buffers()
@@ -338,6 +387,7 @@ cdef class HiddenMarkovModel( GraphModel ):
         free(self.tied_edges_starts)
         free(self.tied_edges_ends)
         free(self.in_transition_log_probabilities)
+        free(self.in_transition_log_probabilities_float)
         free(self.out_transition_log_probabilities)
         free(self.expected_transitions)
         free(self.in_edge_count)
@@ -938,6 +988,8 @@ cdef class HiddenMarkovModel( GraphModel ):
             sizeof(double) )
         self.in_transition_log_probabilities = <double*> calloc( m,
             sizeof(double) )
+        self.in_transition_log_probabilities_float = <float*> calloc( m,
+            sizeof(float) )
 
         self.out_transitions = <int*> calloc( m, sizeof(int) )
         self.out_edge_count = <int*> calloc( n+1, sizeof(int) )
@@ -1109,6 +1161,8 @@ cdef class HiddenMarkovModel( GraphModel ):
 
         self.distributions_ptr = <void**> self.distributions.data
 
+        self._update_derived_tables()
+
         # This holds the index of the start state
         try:
             self.start_index = indices[self.start]
@@ -1123,6 +1177,46 @@ cdef class HiddenMarkovModel( GraphModel ):
                 model with no end. Please ensure it has an end." )
 
 
+    def _update_derived_tables( self ):
+        """Recompute the tables derived from the model parameters.
+
+        This is called by `bake` and again whenever training changes the
+        transitions or the distributions.
+        """
+
+        cdef int k
+
+        for k in range( self.n_edges ):
+            self.in_transition_log_probabilities_float[k] = \
+                <float> self.in_transition_log_probabilities[k]
+
+        # For univariate discrete models, store the best emission log
+        # probability of each symbol over all states. Since transition log
+        # probabilities are at most 0, summing these over the rest of a
+        # sequence bounds how much a Viterbi path can still gain.
+        self.max_emissions = None
+        self.max_emissions_ptr = NULL
+        if self.discrete and not self.multivariate:
+            # Also map every byte value to the encoded symbol, so sequences
+            # of single character symbols can be encoded in one lookup.
+            self.byte_keymap = numpy.empty(256, dtype=numpy.float64)
+            self.byte_keymap[:] = numpy.nan
+            for key, i in self.keymap[0].items():
+                try:
+                    self.byte_keymap[ord(key)] = i
+                except (TypeError, IndexError):
+                    self.byte_keymap = None
+                    break
+
+            self.max_emissions = numpy.empty(len(self.keymap[0]), dtype=numpy.float64)
+            self.max_emissions[:] = NEGINF
+            for key, i in self.keymap[0].items():
+                i = int(i)
+                for l in range(self.silent_start):
+                    self.max_emissions[i] = max(self.max_emissions[i],
+                        self.distributions[l].log_probability(key) + self.state_weights[l])
+            self.max_emissions_ptr = <double*> self.max_emissions.data
+
     def sample( self, length=0, path=False ):
         """Generate a sequence from the model.
 
@@ -1298,10 +1392,24 @@ cdef class HiddenMarkovModel( GraphModel ):
         return log_probability
 
     cdef double _vl_log_probability(self, double* sequence, int n) nogil:
-        cdef double* f = self._forward(sequence, n, NULL)
+        cdef double* f
+        cdef float* f_float
         cdef double log_probability
         cdef int i, m = self.n_states
 
+        if self.single_precision:
+            f_float = _forward_table(self, sequence, n, <float*> NULL)
+            if self.finite == 1:
+                log_probability = f_float[n*m + self.end_index]
+            else:
+                log_probability = NEGINF
+                for i in range( self.silent_start ):
+                    log_probability = pair_lse( log_probability, f_float[n*m + i] )
+
+            free(f_float)
+            return log_probability
+
+        f = self._forward(sequence, n, NULL)
         if self.finite == 1:
             log_probability = f[n*m + self.end_index]
         else:
@@ -1354,10 +1462,22 @@ cdef class HiddenMarkovModel( GraphModel ):
         cdef void** distributions = <void**> self.distributions.data
         cdef numpy.ndarray f_ndarray = numpy.zeros( (n+1, m), dtype=numpy.float64 )
         cdef double* f
+        cdef float* f_float
 
         sequence_ndarray = _check_input(sequence, self)
         sequence_data = <double*> sequence_ndarray.data
 
+        if self.single_precision:
+            with nogil:
+                f_float = _forward_table( self, sequence_data, n, <float*> NULL )
+
+            for i in range(n+1):
+                for j in range(m):
+                    f_ndarray[i, j] = f_float[i*m + j]
+
+            free(f_float)
+            return f_ndarray
+
         with nogil:
             f = <double*> self._forward( sequence_data, n, NULL )
 
@@ -1369,119 +1489,7 @@ cdef class HiddenMarkovModel( GraphModel ):
         return f_ndarray
 
     cdef double* _forward( self, double* sequence, int n, double* emissions ) nogil:
-        cdef int i, k, ki, l, li
-        cdef int p = self.silent_start, m = self.n_states
-        cdef int dim = self.d
-
-        cdef void** distributions = <void**> self.distributions_ptr
-
-        cdef double log_probability
-        cdef int* in_edges = self.in_edge_count
-
-        cdef double* e = NULL
-        cdef double* f = <double*> calloc( m*(n+1), sizeof(double) )
-
-        # Either fill in a new emissions matrix, or use the one which has
-        # been provided from a previous call.
-        if emissions is NULL:
-            e = <double*> calloc( n*self.silent_start, sizeof(double) )
-            for l in range( self.silent_start ):
-                for i in range( n ):
-                    if self.multivariate:
-                        e[l*n + i] = (( <Model> distributions[l] )._mv_log_probability( sequence+i*dim ) +
-                            self.state_weights[l] )
-                    else:
-                        e[l*n + i] = (( <Model> distributions[l] )._log_probability( sequence[i] ) +
-                            self.state_weights[l] )
-        else:
-            e = emissions
-
-        # We must start in the start state, having emitted 0 symbols
-        for i in range(m):
-            f[i] = NEGINF
-        f[self.start_index] = 0.
-
-        for l in range( self.silent_start, m ):
-            # Handle transitions between silent states before the first symbol
-            # is emitted. No non-silent states have non-zero probability yet, so
-            # we can ignore them.
-            if l == self.start_index:
-                # Start state log-probability is already right. Don't touch it.
-                continue
-
-            # This holds the log total transition probability in from
-            # all current-step silent states that can have transitions into
-            # this state.
-            log_probability = NEGINF
-            for k in range( in_edges[l], in_edges[l+1] ):
-                ki = self.in_transitions[k]
-                if ki < self.silent_start or ki >= l:
-                    continue
-
-                # For each current-step preceeding silent state k
-                log_probability = pair_lse( log_probability,
-                    f[ki] + self.in_transition_log_probabilities[k] )
-
-            # Update the table entry
-            f[l] = log_probability
-
-        for i in range( n ):
-            for l in range( self.silent_start ):
-                # Do the recurrence for non-silent states l
-                # This holds the log total transition probability in from
-                # all previous states
-
-                log_probability = NEGINF
-                for k in range( in_edges[l], in_edges[l+1] ):
-                    ki = self.in_transitions[k]
-
-                    # For each previous state k
-                    log_probability = pair_lse( log_probability,
-                        f[i*m + ki] + self.in_transition_log_probabilities[k] )
-
-                # Now set the table entry for log probability of emitting
-                # index+1 characters and ending in state l
-                f[(i+1)*m + l] = log_probability + e[i + l*n]
-
-            for l in range( self.silent_start, m ):
-                # Now do the first pass over the silent states
-                # This holds the log total transition probability in from
-                # all current-step non-silent states
-                log_probability = NEGINF
-                for k in range( in_edges[l], in_edges[l+1] ):
-                    ki = self.in_transitions[k]
-                    if ki >= self.silent_start:
-                        continue
-
-                    # For each current-step non-silent state k
-                    log_probability = pair_lse( log_probability,
-                        f[(i+1)*m + ki] + self.in_transition_log_probabilities[k] )
-
-                # Set the table entry to the partial result.
-                f[(i+1)*m + l] = log_probability
-
-            for l in range( self.silent_start, m ):
-                # Now the second pass through silent states, where we account
-                # for transitions between silent states.
-
-                # This holds the log total transition probability in from
-                # all current-step silent states that can have transitions into
-                # this state.
-                log_probability = NEGINF
-                for k in range( in_edges[l], in_edges[l+1] ):
-                    ki = self.in_transitions[k]
-                    if ki < self.silent_start or ki >= l:
-                        continue
-                    # For each current-step preceeding silent state k
-                    log_probability = pair_lse( log_probability,
-                        f[(i+1)*m + ki] + self.in_transition_log_probabilities[k] )
-
-                # Add the previous partial result and update the table entry
-                f[(i+1)*m + l] = pair_lse( f[(i+1)*m + l], log_probability )
-
-        if emissions is NULL:
-            free(e)
-        return f
+        return _forward_table( self, sequence, n, emissions )
 
     cpdef numpy.ndarray backward( self, sequence ):
         """Run the backward algorithm on the sequence.
@@ -1908,7 +1916,7 @@ cdef class HiddenMarkovModel( GraphModel ):
 
         return expected_transitions_ndarray, emission_weights_ndarray
 
-    cpdef tuple viterbi( self, sequence ):
+    cpdef tuple viterbi( self, sequence, bint checkpoint=False ):
         """Run the Viteri algorithm on the sequence.
 
         Run the Viterbi algorithm on the sequence given the model. This finds
@@ -1931,6 +1939,13 @@ cdef class HiddenMarkovModel( GraphModel ):
         sequence : array-like
             An array (or list) of observations.
 
+        checkpoint : bool, optional
+            Whether to use the checkpointed Viterbi algorithm, which returns
+            the same path using O(m*sqrt(n)) instead of O(nm) memory, at the
+            cost of computing the DP table twice. Use it for long sequences on
+            large models. It always uses float64, see `single_precision`.
+            Default is False.
+
         Returns
         -------
         logp : double
@@ -1955,7 +1970,11 @@ cdef class HiddenMarkovModel( GraphModel ):
 
         sequence_ndarray = _check_input(sequence, self)
         sequence_data = <double*> sequence_ndarray.data
-        logp = self._viterbi(sequence_data, path, n, m)
+        if checkpoint:
+            with nogil:
+                logp = self._viterbi_checkpoint(sequence_data, path, n, m)
+        else:
+            logp = self._viterbi(sequence_data, path, n, m)
 
         for i in range(n+m):
             if path[i] == -1:
@@ -1966,175 +1985,632 @@ cdef class HiddenMarkovModel( GraphModel ):
         free(path)
         return logp, vpath if logp > NEGINF else None
 
+    cpdef double viterbi_score( self, sequence, threshold=None, check_input=True ):
+        """Calculate the log probability of the sequence under the Viterbi path.
 
-    cdef double _viterbi(self, double* sequence, int* path, int n, int m) nogil:
-        cdef int p = self.silent_start
-        cdef int i, l, k, ki
-        cdef int dim = self.d
+        This returns the same log probability as `viterbi`, but the DP table
+        is reduced to two rolling columns and no traceback is stored, so it
+        takes O(m) instead of O(nm) memory. Use it when only the score of the
+        ML path is needed, for example to decide whether a sequence is worth
+        decoding with `viterbi`. The columns are always float64, whatever
+        `single_precision` is set to.
 
-        cdef void** distributions = <void**> self.distributions_ptr
+        If a threshold is given, the DP stops as soon as no path can reach
+        that score anymore, bounding the rest of the path by the best emission
+        of each remaining symbol. This is only done for univariate discrete
+        models.
 
-        cdef int* tracebackx = <int*> calloc( (n+1)*m, sizeof(int) )
-        cdef int* tracebacky = <int*> calloc( (n+1)*m, sizeof(int) )
-        cdef double* v = <double*> calloc( (n+1)*m, sizeof(double) )
-        cdef double* e = <double*> calloc( (n*self.silent_start), sizeof(double) )
+        Parameters
+        ----------
+        sequence : array-like
+            An array (or list) of observations.
 
-        cdef double state_log_probability
-        cdef int end_index
-        cdef double log_probability
-        cdef int* in_edges = self.in_edge_count
+        threshold : double or None, optional
+            The score the caller is interested in. Sequences which can not
+            reach it get a log probability of -inf. Default is None.
 
-        memset(path, -1, (n+m)*sizeof(int))
+        check_input : bool, optional
+            Check to make sure that all emissions fall under the support of
+            the emission distributions. Default is True.
 
-        # Fill in the emission table
-        for l in range( self.silent_start ):
-            for i in range( n ):
-                if self.multivariate:
-                    e[l*n + i] = ((<Model>distributions[l])._mv_log_probability( sequence+i*dim ) +
-                        self.state_weights[l])
+        Returns
+        -------
+        logp : double
+            The log probability of the sequence under the Viterbi path, or
+            -inf if it can not reach the threshold
+        """
+
+        if self.d == 0:
+            raise ValueError("must bake model before using Viterbi algorithm")
+
+        cdef numpy.ndarray sequence_ndarray
+        cdef double* sequence_data
+        cdef double logp
+        cdef double min_score = NEGINF if threshold is None else threshold
+        cdef int n = len(sequence)
+
+        if check_input:
+            sequence_ndarray = _check_input(sequence, self)
+        else:
+            sequence_ndarray = sequence
+
+        sequence_data = <double*> sequence_ndarray.data
+
+        with nogil:
+            logp = self._viterbi_score(sequence_data, n, min_score)
+
+        return logp
+
+    def viterbi_strands( self, sequence, dict complement, bint checkpoint=False ):
+        """Run the Viterbi algorithm on a sequence and its reverse complement.
+
+        The sequence is encoded once and its reverse complement is built from
+        the encoded symbols, so no reverse complemented copy of the input is
+        needed. The sequence as given is decoded and its reverse complement is
+        scored without traceback, and only decoded if it is the better strand.
+        Ties are resolved in favor of the sequence as given. The strands are
+        run one after the other and do not share emission lookups. Only
+        supported for univariate discrete models.
+
+        Parameters
+        ----------
+        sequence : array-like
+            An array (or list) of observations.
+
+        complement : dict
+            A mapping of each symbol of the model to its complement symbol,
+            e.g. {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'} for DNA.
+
+        checkpoint : bool, optional
+            Whether to decode the better strand with the checkpointed Viterbi
+            algorithm. See `viterbi`. Default is False.
+
+        Returns
+        -------
+        logp : double
+            The log probability of the better strand under its Viterbi path
+
+        path : list of tuples
+            Tuples of (state index, state object) of the states along the
+            Viterbi path of the better strand, or None if both strands are
+            impossible under the model.
+
+        reverse : bool
+            Whether the reverse complement was the better strand.
+        """
+
+        if self.d == 0:
+            raise ValueError("must bake model before using Viterbi algorithm")
+
+        cdef numpy.ndarray sequence_ndarray = _check_input(sequence, self)
+        cdef numpy.ndarray reverse_ndarray = self._reverse_complement(sequence_ndarray,
+            self._complement_codes(complement))
+        cdef double* sequence_data = <double*> sequence_ndarray.data
+        cdef double* reverse_data = <double*> reverse_ndarray.data
+        cdef int i, n = len(sequence), m = len(self.states)
+        cdef int* path = <int*> calloc(n+m, sizeof(int))
+        cdef bint reverse
+        cdef double logp
+        cdef list vpath = []
+
+        with nogil:
+            logp = self._viterbi_strands(sequence_data, reverse_data, path, n, m,
+                checkpoint, NEGINF, &reverse)
+
+        for i in range(n+m):
+            if path[i] == -1:
+                break
+
+            vpath.append((path[i], self.states[path[i]]))
+
+        free(path)
+        return logp, vpath if logp > NEGINF else None, reverse
+
+    def viterbi_batch( self, sequences, n_jobs=1, batch_size=None, path=True,
+        complement=None, threshold=None, check_input=True ):
+        """Run the Viterbi algorithm on many sequences at once.
+
+        The sequences are split into batches and each batch is decoded by the
+        nogil Viterbi kernel on a pool of threads, so the per-sequence Python
+        overhead of calling `viterbi` is only paid once per batch. Instead of
+        the list of (state index, state object) tuples returned by `viterbi`,
+        each path is returned as a compact numpy array of state indices.
+
+        Parameters
+        ----------
+        sequences : array-like
+            An array (or list) of sequences, each of which is an array (or list)
+            of observations.
+
+        n_jobs : int, optional
+            The number of threads to use when decoding the sequences. Default
+            is 1.
+
+        batch_size : int or None, optional
+            The number of sequences decoded by a thread in one call. If None,
+            the sequences are split evenly between the threads. Default is None.
+
+        path : bool, optional
+            Whether to return the Viterbi paths. If False, only the scores are
+            calculated, using `viterbi_score` instead of the full traceback.
+            Default is True.
+
+        complement : dict or None, optional
+            If given, a mapping of each symbol to its complement symbol, and
+            each sequence is decoded on both strands as in `viterbi_strands`.
+            Default is None.
+
+        threshold : double or None, optional
+            If given, sequences are first scored as in `viterbi_score` with
+            this threshold, and the ones which can not reach it are abandoned
+            with a log probability of -inf and no path. Default is None.
+
+        check_input : bool, optional
+            Check to make sure that all emissions fall under the support of
+            the emission distributions. Default is True.
+
+        Returns
+        -------
+        logp : numpy.ndarray, shape (n_sequences,)
+            The log probability of each sequence under its Viterbi path
+
+        paths : list of numpy.ndarray
+            The state indices along the Viterbi path of each sequence, or None
+            for the sequences which are impossible under the model. Only
+            returned if path is True.
+
+        reverse : numpy.ndarray, shape (n_sequences,)
+            Whether the reverse complement was the better strand of each
+            sequence. Only returned if complement is given.
+        """
+
+        if self.d == 0:
+            raise ValueError("must bake model before using Viterbi algorithm")
+
+        cdef list X
+        cdef int n_sequences = len(sequences)
+        cdef numpy.ndarray complement_codes = None
+        cdef double min_score = NEGINF if threshold is None else threshold
+
+        if check_input:
+            X = [ _check_input(sequence, self) for sequence in sequences ]
+        else:
+            X = list(sequences)
+
+        if complement is not None:
+            complement_codes = self._complement_codes(complement)
+
+        if n_sequences == 0:
+            results = [ (numpy.empty(0, dtype=numpy.float64), [],
+                numpy.empty(0, dtype=numpy.bool_)) ]
+        else:
+            if batch_size is None:
+                batch_size = max(1, int(math.ceil(float(n_sequences) / n_jobs)))
+
+            batches = [ X[i:i+batch_size] for i in xrange(0, n_sequences, batch_size) ]
+            with Parallel( n_jobs=n_jobs, backend='threading' ) as parallel:
+                results = parallel([ delayed( self._viterbi_batch, check_pickle=False )(
+                    batch, path, complement_codes, min_score ) for batch in batches ])
+
+        logp = numpy.concatenate([ batch_logp for batch_logp, batch_paths, batch_reverse in results ])
+        reverse = numpy.concatenate([ batch_reverse for batch_logp, batch_paths, batch_reverse in results ])
+        paths = [ p for batch_logp, batch_paths, batch_reverse in results for p in batch_paths ]
+
+        if path and complement is not None:
+            return logp, paths, reverse
+        elif path:
+            return logp, paths
+        elif complement is not None:
+            return logp, reverse
+        return logp
+
+    cpdef tuple _viterbi_batch( self, list X, bint path=True, numpy.ndarray complement_codes=None,
+        double threshold=NEGINF ):
+        """Python wrapper for decoding a batch of sequences.
+
+        This is done to ensure compatibility with joblib's multithreading
+        API. The GIL is only held between sequences, to wrap each decoded path
+        into a numpy array.
+        """
+
+        cdef int i, length, n, m = len(self.states)
+        cdef int n_sequences = len(X)
+        cdef bint strands = complement_codes is not None
+        cdef numpy.ndarray sequence_ndarray
+        cdef numpy.ndarray reverse_ndarray
+        cdef numpy.ndarray path_ndarray
+        cdef double* sequence_data
+        cdef double* reverse_data = NULL
+        cdef numpy.ndarray logp_ndarray = numpy.empty(n_sequences, dtype=numpy.float64)
+        cdef double* logp = <double*> logp_ndarray.data
+        cdef numpy.ndarray reverse_flags = numpy.zeros(n_sequences, dtype=numpy.bool_)
+        cdef bint reverse
+        cdef int* path_data = NULL
+        cdef list paths = []
+
+        for i in range(n_sequences):
+            sequence_ndarray = X[i]
+            sequence_data = <double*> sequence_ndarray.data
+            n = sequence_ndarray.shape[0]
+
+            if strands:
+                reverse_ndarray = self._reverse_complement(sequence_ndarray, complement_codes)
+                reverse_data = <double*> reverse_ndarray.data
+
+            if path:
+                path_data = <int*> calloc(n+m, sizeof(int))
+
+            with nogil:
+                if strands:
+                    logp[i] = self._viterbi_strands(sequence_data, reverse_data,
+                        path_data, n, m, 0, threshold, &reverse)
+                elif not path:
+                    logp[i] = self._viterbi_score(sequence_data, n, threshold)
+                elif threshold > NEGINF and self._viterbi_score(sequence_data, n, threshold) == NEGINF:
+                    logp[i] = NEGINF
                 else:
-                    e[l*n + i] = ((<Model>distributions[l])._log_probability( sequence[i] ) +
-                        self.state_weights[l])
+                    logp[i] = self._viterbi(sequence_data, path_data, n, m)
 
-        for i in range( m ):
-            v[i] = NEGINF
-        v[self.start_index] = 0
+            if strands:
+                reverse_flags[i] = reverse
 
-        for l in range( self.silent_start, m ):
-            # Handle transitions between silent states before the first symbol
-            # is emitted. No non-silent states have non-zero probability yet, so
-            # we can ignore them.
-            if l == self.start_index:
-                # Start state log-probability is already right. Don't touch it.
+            if not path:
                 continue
 
-            for k in range( in_edges[l], in_edges[l+1] ):
-                ki = self.in_transitions[k]
-                if ki < self.silent_start or ki >= l:
-                    continue
+            if logp[i] > NEGINF:
+                length = 0
+                while length < n+m and path_data[length] != -1:
+                    length += 1
 
-                # For each current-step preceeding silent state k
-                # This holds the log-probability coming that way
-                state_log_probability = v[ki] + self.in_transition_log_probabilities[k]
+                path_ndarray = numpy.empty(length, dtype=numpy.int32)
+                memcpy(<int*> path_ndarray.data, path_data, length*sizeof(int))
+                paths.append(path_ndarray)
+            else:
+                paths.append(None)
 
-                if state_log_probability > v[l]:
-                    v[l] = state_log_probability
-                    tracebackx[l] = 0
-                    tracebacky[l] = ki
+            free(path_data)
+
+        return logp_ndarray, paths, reverse_flags
+
+    cdef numpy.ndarray _complement_codes( self, dict complement ):
+        """Map the encoded value of each symbol to that of its complement."""
+
+        if not self.discrete or self.multivariate:
+            raise ValueError("reverse complement is only supported for univariate discrete models")
+
+        cdef dict keymap = self.keymap[0]
+        cdef numpy.ndarray complement_codes = numpy.empty(len(keymap), dtype=numpy.intp)
+
+        for symbol, code in keymap.items():
+            try:
+                complement_codes[code] = keymap[complement[symbol]]
+            except KeyError:
+                raise ValueError("Complement of symbol '{}' is not defined in a distribution".format(symbol))
+
+        return complement_codes
+
+    cdef numpy.ndarray _reverse_complement( self, numpy.ndarray sequence_ndarray,
+        numpy.ndarray complement_codes ):
+        """Return the reverse complement of an encoded sequence."""
+
+        return complement_codes[sequence_ndarray[::-1].astype(numpy.intp)].astype(numpy.float64)
+
+    cdef double _viterbi_strands(self, double* sequence, double* reverse_sequence,
+        int* path, int n, int m, bint checkpoint, double threshold, bint* reverse) nogil:
+        """Score both strands and decode the better one.
+
+        With a threshold, both strands are scored without traceback first, so
+        the strands which are abandoned early are never decoded. Without one,
+        the sequence as given is decoded right away and the reverse complement
+        is only decoded if it scores better, which saves a DP pass when the
+        given strand is the better one, as for reads aligned to the forward
+        strand of a reference.
+
+        The strands are run one after the other, and the emissions of a symbol
+        are looked up again for each strand. Running them in one sweep would
+        only share those lookups, which take silent_start operations per
+        column against the n_edges operations of the transitions.
+
+        If path is NULL, or neither strand can reach the threshold, only the
+        better score is returned.
+        """
+
+        cdef double logp, reverse_logp
+        cdef double* best_sequence = sequence
+
+        if path != NULL and threshold == NEGINF and not checkpoint:
+            logp = self._viterbi(sequence, path, n, m)
+            reverse_logp = self._viterbi_score(reverse_sequence, n, NEGINF)
+            reverse[0] = logp < reverse_logp
+            if reverse[0]:
+                return self._viterbi(reverse_sequence, path, n, m)
+            return logp
+
+        logp = self._viterbi_score(sequence, n, threshold)
+        reverse_logp = self._viterbi_score(reverse_sequence, n, threshold)
+        reverse[0] = logp < reverse_logp
+        if reverse[0]:
+            best_sequence = reverse_sequence
+
+        if path == NULL:
+            return reverse_logp if reverse[0] else logp
+        if threshold > NEGINF and logp == NEGINF and reverse_logp == NEGINF:
+            memset(path, -1, (n+m)*sizeof(int))
+            return NEGINF
+        if checkpoint:
+            return self._viterbi_checkpoint(best_sequence, path, n, m)
+        return self._viterbi(best_sequence, path, n, m)
+
+    cdef double _viterbi_score(self, double* sequence, int n, double threshold) nogil:
+        cdef int i, l, m = self.n_states
+        cdef double* v_prev = <double*> calloc( m, sizeof(double) )
+        cdef double* v = <double*> calloc( m, sizeof(double) )
+        cdef double* e = <double*> calloc( self.silent_start, sizeof(double) )
+        cdef double* remaining = NULL
+        cdef double* swap
+        cdef double log_probability, best
+
+        # remaining[i] bounds the log probability the path can still gain
+        # while emitting symbols i..n-1. The bound is summed in a different
+        # order than the path, so a sequence is only abandoned when the bound
+        # falls below the threshold by more than the rounding error, and one
+        # that scores exactly the threshold is kept.
+        if threshold > NEGINF and self.max_emissions_ptr != NULL:
+            remaining = <double*> calloc( n+1, sizeof(double) )
+            remaining[n] = 0
+            for i in range( n-1, -1, -1 ):
+                remaining[i] = remaining[i+1] + self.max_emissions_ptr[<int> sequence[i]]
+
+        self._viterbi_first_column(v_prev, NULL)
 
         for i in range( n ):
-            for l in range( self.silent_start ):
-                # Do the recurrence for non-silent states l
-                # Start out saying the best likelihood we have is -inf
-                v[(i+1)*m + l] = NEGINF
-
-                for k in range( in_edges[l], in_edges[l+1] ):
-                    ki = self.in_transitions[k]
-
-                    # For each previous state k
-                    # This holds the log-probability coming that way
-                    state_log_probability = v[i*m + ki] + \
-                        self.in_transition_log_probabilities[k] + e[i + l*n]
-
-                    if state_log_probability > v[(i+1)*m + l]:
-                        v[(i+1)*m + l] = state_log_probability
-                        tracebackx[(i+1)*m + l] = i
-                        tracebacky[(i+1)*m + l] = ki
-
-            for l in range( self.silent_start, m ):
-                # Now do the first pass over the silent states, finding the best
-                # current-step non-silent state they could come from.
-                # Start out saying the best likelihood we have is -inf
-                v[(i+1)*m + l] = NEGINF
-
-                for k in range( in_edges[l], in_edges[l+1] ):
-                    ki = self.in_transitions[k]
-                    if ki >= self.silent_start:
-                        continue
+            self._viterbi_column(sequence, i, v_prev, v, e, NULL)
+            swap = v_prev
+            v_prev = v
+            v = swap
+
+            if remaining != NULL:
+                best = NEGINF
+                for l in range( m ):
+                    if v_prev[l] > best:
+                        best = v_prev[l]
+
+                if best + remaining[i+1] < threshold - ABANDON_MARGIN * (1 + fabs(threshold)):
+                    free(v_prev)
+                    free(v)
+                    free(e)
+                    free(remaining)
+                    return NEGINF
+
+        free(remaining)
 
-                    # For each current-step non-silent state k
-                    # This holds the log-probability coming that way
-                    state_log_probability = v[(i+1)*m + ki] + \
-                        self.in_transition_log_probabilities[k]
+        if self.finite == 1:
+            log_probability = v_prev[self.end_index]
+        else:
+            log_probability = NEGINF
+            for i in range( m ):
+                if v_prev[i] > log_probability:
+                    log_probability = v_prev[i]
 
-                    if state_log_probability > v[(i+1)*m + l]:
-                        v[(i+1)*m + l] = state_log_probability
-                        tracebackx[(i+1)*m + l] = i+1
-                        tracebacky[(i+1)*m + l] = ki
+        free(v_prev)
+        free(v)
+        free(e)
+        return log_probability
 
-            for l in range( self.silent_start, m ):
-                # Now the second pass through silent states, where we check the
-                # silent states that could potentially reach here and see if
-                # they're better than the non-silent states we found.
+    cdef double _viterbi_checkpoint(self, double* sequence, int* path, int n, int m) nogil:
+        """Run the Viterbi algorithm storing only every k-th DP column.
 
-                for k in range( in_edges[l], in_edges[l+1] ):
-                    ki = self.in_transitions[k]
-                    if ki < self.silent_start or ki >= l:
-                        continue
+        The forward pass keeps a checkpoint of every k = sqrt(n) columns.
+        The traceback then goes over the segments between checkpoints from
+        the last to the first, recomputing the columns of each segment from
+        its checkpoint along with their traceback. Only one segment of
+        traceback is in memory at a time, so this takes O(m*sqrt(n)) memory
+        and returns the same path as `_viterbi`.
+        """
+
+        cdef int i, j, l, t
+        cdef int k = <int> sqrt(n)
+        cdef int n_segments, segment_start, segment_end
+        cdef int px = n, py, length = 0
+        cdef double log_probability
+        cdef double* swap
+        cdef double* v_prev = <double*> calloc( m, sizeof(double) )
+        cdef double* v = <double*> calloc( m, sizeof(double) )
+        cdef double* e = <double*> calloc( self.silent_start, sizeof(double) )
+        cdef double* checkpoints
+        cdef int* traceback
+
+        if k < 1:
+            k = 1
+
+        n_segments = (n + k - 1) / k
+        if n_segments == 0:
+            n_segments = 1
+
+        checkpoints = <double*> calloc( n_segments*m, sizeof(double) )
+        traceback = <int*> calloc( (k+1)*m, sizeof(int) )
+
+        memset(path, -1, (n+m)*sizeof(int))
+
+        # Forward pass, keeping the columns at the start of each segment
+        self._viterbi_first_column(v_prev, NULL)
+        memcpy(checkpoints, v_prev, m*sizeof(double))
 
-                    # For each current-step preceeding silent state k
-                    # This holds the log-probability coming that way
-                    state_log_probability = v[(i+1)*m + ki] + \
-                        self.in_transition_log_probabilities[k]
+        for i in range( n ):
+            self._viterbi_column(sequence, i, v_prev, v, e, NULL)
+            swap = v_prev
+            v_prev = v
+            v = swap
 
-                    if state_log_probability > v[(i+1)*m + l]:
-                        v[(i+1)*m + l] = state_log_probability
-                        tracebackx[(i+1)*m + l] = i+1
-                        tracebacky[(i+1)*m + l] = ki
+            if (i+1) % k == 0 and (i+1) / k < n_segments:
+                memcpy(checkpoints + ((i+1)/k)*m, v_prev, m*sizeof(double))
 
-        # Now the DP table is filled in. If this is a finite model, get the
-        # log likelihood of ending up in the end state after following the
-        # ML path through the model. If an infinite sequence, find the state
-        # which the ML path ends in, and begin there.
         if self.finite == 1:
-            log_probability = v[n*m + self.end_index]
-            end_index = self.end_index
+            log_probability = v_prev[self.end_index]
+            py = self.end_index
         else:
-            end_index = -1
+            py = -1
             log_probability = NEGINF
-            for i in range(m):
-                if v[n*m + i] > log_probability:
-                    log_probability = v[n*m + i]
-                    end_index = i
+            for l in range( m ):
+                if v_prev[l] > log_probability:
+                    log_probability = v_prev[l]
+                    py = l
 
         if log_probability == NEGINF:
-            free(tracebackx)
-            free(tracebacky)
+            free(v_prev)
             free(v)
             free(e)
+            free(checkpoints)
+            free(traceback)
             return log_probability
 
-        # Otherwise, do the traceback
-        # This holds the path, which we construct in reverse order
-        cdef int px = n, py = end_index, npx
-        cdef int length = 0
-
-        while px != 0 or py != self.start_index:
-            # Until we've traced back to the start...
-            # Put the position in the path, making sure to look up the state
-            # object to use instead of the state index.
-            path[length] = py
-            length += 1
-
-            # Go backwards
-            npx = tracebackx[px*m + py]
-            py = tracebacky[px*m + py]
-            px = npx
-
-        # We've now reached the start (if we didn't raise an exception because
-        # we messed up the traceback)
-        # Record that we start at the start
+        # Traceback, one segment at a time. Row r of the traceback holds the
+        # predecessors of the states in column segment_start + r.
+        for j in range( n_segments-1, -1, -1 ):
+            segment_start = j*k
+            segment_end = segment_start + k
+            if segment_end > n:
+                segment_end = n
+
+            memcpy(v_prev, checkpoints + j*m, m*sizeof(double))
+            if segment_start == 0:
+                self._viterbi_first_column(v_prev, traceback)
+
+            for i in range( segment_start, segment_end ):
+                self._viterbi_column(sequence, i, v_prev, v, e,
+                    traceback + (i-segment_start+1)*m)
+                swap = v_prev
+                v_prev = v
+                v = swap
+
+            while px > segment_start or (segment_start == 0 and py != self.start_index):
+                path[length] = py
+                length += 1
+
+                t = traceback[(px-segment_start)*m + py]
+                if t >= m:
+                    py = t - m
+                else:
+                    py = t
+                    px -= 1
+
         path[length] = py
 
         for i in range((length + 1) / 2):
-            path[i], path[length-i] = path[length-i], path[i] 
+            path[i], path[length-i] = path[length-i], path[i]
 
-        free(tracebackx)
-        free(tracebacky)
+        free(v_prev)
         free(v)
         free(e)
+        free(checkpoints)
+        free(traceback)
         return log_probability
 
+    cdef void _viterbi_first_column(self, double* v, int* traceback) nogil:
+        """Fill in the Viterbi column before the first symbol is emitted.
+
+        Only the start state and the silent states reachable from it have
+        non-zero probability. If traceback is not NULL, the best predecessor
+        of each state is stored in it, offset by m to mark a predecessor in
+        the same column.
+        """
+
+        cdef int k, ki, l, m = self.n_states
+        cdef double state_log_probability
+        cdef int* in_edges = self.in_edge_count
+
+        for l in range( m ):
+            v[l] = NEGINF
+        v[self.start_index] = 0
+
+        for l in range( self.silent_start, m ):
+            if l == self.start_index:
+                continue
+
+            for k in range( in_edges[l], in_edges[l+1] ):
+                ki = self.in_transitions[k]
+                if ki < self.silent_start or ki >= l:
+                    continue
+
+                state_log_probability = v[ki] + self.in_transition_log_probabilities[k]
+
+                if state_log_probability > v[l]:
+                    v[l] = state_log_probability
+                    if traceback != NULL:
+                        traceback[l] = ki + m
+
+    cdef void _viterbi_column(self, double* sequence, int i, double* v_prev,
+        double* v, double* e, int* traceback) nogil:
+        """Fill in the Viterbi column after emitting symbol i.
+
+        This is the same recurrence as `_viterbi`, computed from the previous
+        column alone, so that callers can keep as few columns in memory as
+        they need. e is a buffer of length silent_start for the emissions of
+        symbol i. If traceback is not NULL, the best predecessor of each state
+        is stored in it: a state index for a predecessor in the previous
+        column, or a state index offset by m for one in the same column.
+        """
+
+        cdef int k, ki, l, m = self.n_states
+        cdef int dim = self.d
+        cdef double state_log_probability
+        cdef void** distributions = <void**> self.distributions_ptr
+        cdef int* in_edges = self.in_edge_count
+
+        for l in range( self.silent_start ):
+            if self.multivariate:
+                e[l] = ((<Model>distributions[l])._mv_log_probability( sequence+i*dim ) +
+                    self.state_weights[l])
+            else:
+                e[l] = ((<Model>distributions[l])._log_probability( sequence[i] ) +
+                    self.state_weights[l])
+
+        for l in range( self.silent_start ):
+            v[l] = NEGINF
+
+            for k in range( in_edges[l], in_edges[l+1] ):
+                ki = self.in_transitions[k]
+                state_log_probability = v_prev[ki] + \
+                    self.in_transition_log_probabilities[k] + e[l]
+
+                if state_log_probability > v[l]:
+                    v[l] = state_log_probability
+                    if traceback != NULL:
+                        traceback[l] = ki
+
+        for l in range( self.silent_start, m ):
+            v[l] = NEGINF
+
+            for k in range( in_edges[l], in_edges[l+1] ):
+                ki = self.in_transitions[k]
+                if ki >= self.silent_start:
+                    continue
+
+                state_log_probability = v[ki] + self.in_transition_log_probabilities[k]
+
+                if state_log_probability > v[l]:
+                    v[l] = state_log_probability
+                    if traceback != NULL:
+                        traceback[l] = ki + m
+
+        for l in range( self.silent_start, m ):
+            for k in range( in_edges[l], in_edges[l+1] ):
+                ki = self.in_transitions[k]
+                if ki < self.silent_start or ki >= l:
+                    continue
+
+                state_log_probability = v[ki] + self.in_transition_log_probabilities[k]
+
+                if state_log_probability > v[l]:
+                    v[l] = state_log_probability
+                    if traceback != NULL:
+                        traceback[l] = ki + m
+
+    cdef double _viterbi(self, double* sequence, int* path, int n, int m) nogil:
+        if self.single_precision:
+            return _viterbi_table(self, sequence, path, n, m, <float*> NULL)
+        return _viterbi_table(self, sequence, path, n, m, <double*> NULL)
+
     def predict_proba( self, sequence ):
         """Calculate the state probabilities for each observation in the sequence.
 
@@ -2898,6 +3374,7 @@ cdef class HiddenMarkovModel( GraphModel ):
 
         self._from_summaries( transition_pseudocount, use_pseudocount,
             edge_inertia, distribution_inertia )
+        self._update_derived_tables()
 
         memset( self.expected_transitions, 0, self.n_edges*sizeof(double) )
         self.summaries = 0
@@ -3143,6 +3620,213 @@ cdef class HiddenMarkovModel( GraphModel ):
         model.bake( verbose=verbose )
         return model
 
+    def to_npz( self, file ):
+        """Write the baked model to a numpy .npz archive.
+
+        The archive holds the arrays that inference works on, so `from_npz`
+        can restore the model without building the graph and baking it
+        again. Only univariate discrete models can be written this way.
+
+        Parameters
+        ----------
+        file : str or file
+            The file name or an open file to write the archive to.
+
+        Returns
+        -------
+        None
+        """
+
+        if self.d == 0:
+            raise ValueError("must bake model before writing it")
+        if not self.discrete or self.multivariate:
+            raise ValueError("only univariate discrete models can be written to npz")
+
+        cdef int n = self.n_states, m = self.n_edges
+        cdef int n_tied = self.tied_state_count[self.silent_start]
+        cdef int n_groups = self.n_tied_edge_groups
+        cdef int n_grouped = self.tied_edge_group_size[n_groups-1]
+        cdef numpy.ndarray in_edge_count = numpy.empty(n+1, dtype=numpy.int32)
+        cdef numpy.ndarray in_transitions = numpy.empty(m, dtype=numpy.int32)
+        cdef numpy.ndarray in_log_probabilities = numpy.empty(m, dtype=numpy.float64)
+        cdef numpy.ndarray in_pseudocounts = numpy.empty(m, dtype=numpy.float64)
+        cdef numpy.ndarray out_edge_count = numpy.empty(n+1, dtype=numpy.int32)
+        cdef numpy.ndarray out_transitions = numpy.empty(m, dtype=numpy.int32)
+        cdef numpy.ndarray out_log_probabilities = numpy.empty(m, dtype=numpy.float64)
+        cdef numpy.ndarray out_pseudocounts = numpy.empty(m, dtype=numpy.float64)
+        cdef numpy.ndarray tied_state_count = numpy.empty(self.silent_start+1, dtype=numpy.int32)
+        cdef numpy.ndarray tied = numpy.empty(n_tied, dtype=numpy.int32)
+        cdef numpy.ndarray tied_edge_group_size = numpy.empty(n_groups, dtype=numpy.int32)
+        cdef numpy.ndarray tied_edges_starts = numpy.empty(n_grouped, dtype=numpy.int32)
+        cdef numpy.ndarray tied_edges_ends = numpy.empty(n_grouped, dtype=numpy.int32)
+
+        memcpy( in_edge_count.data, self.in_edge_count, (n+1)*sizeof(int) )
+        memcpy( in_transitions.data, self.in_transitions, m*sizeof(int) )
+        memcpy( in_log_probabilities.data, self.in_transition_log_probabilities, m*sizeof(double) )
+        memcpy( in_pseudocounts.data, self.in_transition_pseudocounts, m*sizeof(double) )
+        memcpy( out_edge_count.data, self.out_edge_count, (n+1)*sizeof(int) )
+        memcpy( out_transitions.data, self.out_transitions, m*sizeof(int) )
+        memcpy( out_log_probabilities.data, self.out_transition_log_probabilities, m*sizeof(double) )
+        memcpy( out_pseudocounts.data, self.out_transition_pseudocounts, m*sizeof(double) )
+        memcpy( tied_state_count.data, self.tied_state_count, (self.silent_start+1)*sizeof(int) )
+        memcpy( tied.data, self.tied, n_tied*sizeof(int) )
+        memcpy( tied_edge_group_size.data, self.tied_edge_group_size, n_groups*sizeof(int) )
+        memcpy( tied_edges_starts.data, self.tied_edges_starts, n_grouped*sizeof(int) )
+        memcpy( tied_edges_ends.data, self.tied_edges_ends, n_grouped*sizeof(int) )
+
+        # Tied states share one distribution object, so each distribution is
+        # written once and states refer to it by its row in the emission table.
+        keys = sorted( self.keymap[0], key=self.keymap[0].get )
+        rows = {}
+        emissions = []
+        distribution_indices = numpy.empty(self.silent_start, dtype=numpy.int32)
+        for i in range( self.silent_start ):
+            distribution = self.states[i].distribution
+            if id(distribution) not in rows:
+                rows[id(distribution)] = len(emissions)
+                parameters = distribution.parameters[0]
+                emissions.append( [ parameters.get(key, 0.) for key in keys ] )
+            distribution_indices[i] = rows[id(distribution)]
+
+        numpy.savez( file,
+            name=numpy.array(self.name),
+            state_names=numpy.array([ state.name for state in self.states ]),
+            state_weights=numpy.array([ state.weight for state in self.states[:self.silent_start] ]),
+            keys=numpy.array(keys),
+            emissions=numpy.array(emissions, dtype=numpy.float64),
+            distribution_indices=distribution_indices,
+            indices=numpy.array([ self.silent_start, self.start_index, self.end_index, self.finite ], dtype=numpy.int32),
+            in_edge_count=in_edge_count,
+            in_transitions=in_transitions,
+            in_transition_log_probabilities=in_log_probabilities,
+            in_transition_pseudocounts=in_pseudocounts,
+            out_edge_count=out_edge_count,
+            out_transitions=out_transitions,
+            out_transition_log_probabilities=out_log_probabilities,
+            out_transition_pseudocounts=out_pseudocounts,
+            tied_state_count=tied_state_count,
+            tied=tied,
+            tied_edge_group_size=tied_edge_group_size,
+            tied_edges_starts=tied_edges_starts,
+            tied_edges_ends=tied_edges_ends )
+
+    @classmethod
+    def from_npz( cls, file ):
+        """Read in a model written by `to_npz`.
+
+        The C arrays are filled straight from the archive and the model is
+        not baked again, so this is much faster than `from_json` for large
+        models. The graph is rebuilt from the stored edges, with tied edges
+        grouped by their group index, so the model can still be copied or
+        written to JSON.
+
+        Parameters
+        ----------
+        file : str or file
+            The file name or an open file holding the archive.
+
+        Returns
+        -------
+        model : HiddenMarkovModel
+            A baked model identical to the one that was written.
+        """
+
+        cdef HiddenMarkovModel model
+        cdef int i, n, m, n_tied, n_groups, n_grouped
+
+        with numpy.load( file ) as data:
+            arrays = { key: data[key] for key in data.files }
+
+        model = HiddenMarkovModel( str(arrays['name']) )
+        silent_start, start_index, end_index, finite = arrays['indices'].tolist()
+
+        keys = tuple( arrays['keys'].tolist() )
+        distributions = []
+        for row in arrays['emissions']:
+            distribution = DiscreteDistribution( dict( zip( keys, row.tolist() ) ) )
+            distribution.bake( keys )
+            distributions.append( distribution )
+
+        weights = arrays['state_weights'].tolist()
+        distribution_indices = arrays['distribution_indices'].tolist()
+        states = []
+        for i, name in enumerate( arrays['state_names'].tolist() ):
+            if i < silent_start:
+                states.append( State( distributions[distribution_indices[i]],
+                    name=str(name), weight=weights[i] ) )
+            else:
+                states.append( State( None, name=str(name) ) )
+
+        model.graph = networkx.DiGraph()
+        model.graph.add_nodes_from( states )
+        model.states = states
+        model.state_names = set( state.name for state in states )
+        model.start = states[start_index]
+        model.end = states[end_index]
+
+        n = len(states)
+        m = len(arrays['out_transitions'])
+        n_tied = len(arrays['tied'])
+        n_groups = len(arrays['tied_edge_group_size'])
+        n_grouped = len(arrays['tied_edges_starts'])
+
+        model.n_states = n
+        model.n_edges = m
+        model.d = 1
+        model.discrete = 1
+        model.multivariate = 0
+        model.silent_start = silent_start
+        model.start_index = start_index
+        model.end_index = end_index
+        model.finite = finite
+        model.n_tied_edge_groups = n_groups
+        model.summaries = 0
+
+        model.in_edge_count = <int*> _npz_copy( arrays['in_edge_count'], numpy.int32 )
+        model.in_transitions = <int*> _npz_copy( arrays['in_transitions'], numpy.int32 )
+        model.in_transition_log_probabilities = <double*> _npz_copy(
+            arrays['in_transition_log_probabilities'], numpy.float64 )
+        model.in_transition_pseudocounts = <double*> _npz_copy(
+            arrays['in_transition_pseudocounts'], numpy.float64 )
+        model.out_edge_count = <int*> _npz_copy( arrays['out_edge_count'], numpy.int32 )
+        model.out_transitions = <int*> _npz_copy( arrays['out_transitions'], numpy.int32 )
+        model.out_transition_log_probabilities = <double*> _npz_copy(
+            arrays['out_transition_log_probabilities'], numpy.float64 )
+        model.out_transition_pseudocounts = <double*> _npz_copy(
+            arrays['out_transition_pseudocounts'], numpy.float64 )
+        model.tied_state_count = <int*> _npz_copy( arrays['tied_state_count'], numpy.int32 )
+        model.tied = <int*> _npz_copy( arrays['tied'], numpy.int32 )
+        model.tied_edge_group_size = <int*> _npz_copy( arrays['tied_edge_group_size'], numpy.int32 )
+        model.tied_edges_starts = <int*> _npz_copy( arrays['tied_edges_starts'], numpy.int32 )
+        model.tied_edges_ends = <int*> _npz_copy( arrays['tied_edges_ends'], numpy.int32 )
+        model.in_transition_log_probabilities_float = <float*> calloc( m, sizeof(float) )
+        model.expected_transitions = <double*> calloc( m, sizeof(double) )
+
+        model.state_weights = numpy.log( numpy.array( weights, dtype=numpy.float64 ) )
+        model.keymap = [{ key: i for i, key in enumerate(keys) }]
+        model.distributions = numpy.empty( silent_start, dtype='object' )
+        for i in range( silent_start ):
+            model.distributions[i] = states[i].distribution
+        model.distributions_ptr = <void**> model.distributions.data
+
+        model._update_derived_tables()
+
+        groups = {}
+        for i in range( n_groups-1 ):
+            for k in range( model.tied_edge_group_size[i], model.tied_edge_group_size[i+1] ):
+                groups[( model.tied_edges_starts[k], model.tied_edges_ends[k] )] = i
+
+        edges = []
+        for i in range( n ):
+            for k in range( model.out_edge_count[i], model.out_edge_count[i+1] ):
+                j = model.out_transitions[k]
+                edges.append( ( states[i], states[j], {
+                    'probability' : model.out_transition_log_probabilities[k],
+                    'pseudocount' : model.out_transition_pseudocounts[k],
+                    'group' : groups.get( ( i, j ), None ) } ) )
+        model.graph.add_edges_from( edges )
+        return model
+
     @classmethod
     def from_matrix( cls, transition_probabilities, distributions, starts, ends=None,
         state_names=None, name=None, verbose=False, merge='All' ):
@@ -3236,3 +3920,317 @@ cdef class HiddenMarkovModel( GraphModel ):
 
         model.bake( verbose=verbose, merge=merge )
         return model
+
+
+cdef inline dp_t _dp_lse( dp_t x, dp_t y ) nogil:
+    if dp_t is float:
+        return pair_lse_float( x, y )
+    else:
+        return pair_lse( x, y )
+
+cdef inline dp_t* _dp_transitions( HiddenMarkovModel model, dp_t* precision ) nogil:
+    """Return the transition log probabilities stored in the precision of dp_t."""
+
+    if dp_t is float:
+        return model.in_transition_log_probabilities_float
+    else:
+        return model.in_transition_log_probabilities
+
+cdef dp_t* _forward_table( HiddenMarkovModel model, double* sequence, int n,
+    dp_t* emissions ) nogil:
+    """Fill in the forward DP table of the model in the precision of dp_t.
+
+    emissions is either NULL or a table of the same precision computed by
+    a previous call. The returned table must be freed by the caller.
+    """
+
+    cdef int i, k, ki, l, li
+    cdef int p = model.silent_start, m = model.n_states
+    cdef int dim = model.d
+
+    cdef void** distributions = <void**> model.distributions_ptr
+
+    cdef dp_t log_probability
+    cdef int* in_edges = model.in_edge_count
+    cdef dp_t* transitions = _dp_transitions(model, <dp_t*> NULL)
+
+    cdef dp_t* e = NULL
+    cdef dp_t* f = <dp_t*> calloc( m*(n+1), sizeof(dp_t) )
+
+    # Either fill in a new emissions matrix, or use the one which has
+    # been provided from a previous call.
+    if emissions is NULL:
+        e = <dp_t*> calloc( n*model.silent_start, sizeof(dp_t) )
+        for l in range( model.silent_start ):
+            for i in range( n ):
+                if model.multivariate:
+                    e[l*n + i] = (( <Model> distributions[l] )._mv_log_probability( sequence+i*dim ) +
+                        model.state_weights[l] )
+                else:
+                    e[l*n + i] = (( <Model> distributions[l] )._log_probability( sequence[i] ) +
+                        model.state_weights[l] )
+    else:
+        e = emissions
+
+    # We must start in the start state, having emitted 0 symbols
+    for i in range(m):
+        f[i] = NEGINF
+    f[model.start_index] = 0.
+
+    for l in range( model.silent_start, m ):
+        # Handle transitions between silent states before the first symbol
+        # is emitted. No non-silent states have non-zero probability yet, so
+        # we can ignore them.
+        if l == model.start_index:
+            # Start state log-probability is already right. Don't touch it.
+            continue
+
+        # This holds the log total transition probability in from
+        # all current-step silent states that can have transitions into
+        # this state.
+        log_probability = NEGINF
+        for k in range( in_edges[l], in_edges[l+1] ):
+            ki = model.in_transitions[k]
+            if ki < model.silent_start or ki >= l:
+                continue
+
+            # For each current-step preceeding silent state k
+            log_probability = _dp_lse( log_probability,
+                f[ki] + transitions[k] )
+
+        # Update the table entry
+        f[l] = log_probability
+
+    for i in range( n ):
+        for l in range( model.silent_start ):
+            # Do the recurrence for non-silent states l
+            # This holds the log total transition probability in from
+            # all previous states
+
+            log_probability = NEGINF
+            for k in range( in_edges[l], in_edges[l+1] ):
+                ki = model.in_transitions[k]
+
+                # For each previous state k
+                log_probability = _dp_lse( log_probability,
+                    f[i*m + ki] + transitions[k] )
+
+            # Now set the table entry for log probability of emitting
+            # index+1 characters and ending in state l
+            f[(i+1)*m + l] = log_probability + e[i + l*n]
+
+        for l in range( model.silent_start, m ):
+            # Now do the first pass over the silent states
+            # This holds the log total transition probability in from
+            # all current-step non-silent states
+            log_probability = NEGINF
+            for k in range( in_edges[l], in_edges[l+1] ):
+                ki = model.in_transitions[k]
+                if ki >= model.silent_start:
+                    continue
+
+                # For each current-step non-silent state k
+                log_probability = _dp_lse( log_probability,
+                    f[(i+1)*m + ki] + transitions[k] )
+
+            # Set the table entry to the partial result.
+            f[(i+1)*m + l] = log_probability
+
+        for l in range( model.silent_start, m ):
+            # Now the second pass through silent states, where we account
+            # for transitions between silent states.
+
+            # This holds the log total transition probability in from
+            # all current-step silent states that can have transitions into
+            # this state.
+            log_probability = NEGINF
+            for k in range( in_edges[l], in_edges[l+1] ):
+                ki = model.in_transitions[k]
+                if ki < model.silent_start or ki >= l:
+                    continue
+                # For each current-step preceeding silent state k
+                log_probability = _dp_lse( log_probability,
+                    f[(i+1)*m + ki] + transitions[k] )
+
+            # Add the previous partial result and update the table entry
+            f[(i+1)*m + l] = _dp_lse( f[(i+1)*m + l], log_probability )
+
+    if emissions is NULL:
+        free(e)
+    return f
+
+
+cdef double _viterbi_table( HiddenMarkovModel model, double* sequence, int* path,
+    int n, int m, dp_t* precision ) nogil:
+    """Run Viterbi with DP and emission tables in the precision of dp_t.
+
+    precision is only used to pick the specialization and may be NULL.
+    """
+
+    cdef int p = model.silent_start
+    cdef int i, l, k, ki
+    cdef int dim = model.d
+
+    cdef void** distributions = <void**> model.distributions_ptr
+
+    cdef int* tracebackx = <int*> calloc( (n+1)*m, sizeof(int) )
+    cdef int* tracebacky = <int*> calloc( (n+1)*m, sizeof(int) )
+    cdef dp_t* v = <dp_t*> calloc( (n+1)*m, sizeof(dp_t) )
+    cdef dp_t* e = <dp_t*> calloc( (n*model.silent_start), sizeof(dp_t) )
+
+    cdef dp_t state_log_probability
+    cdef int end_index
+    cdef double log_probability
+    cdef int* in_edges = model.in_edge_count
+    cdef dp_t* transitions = _dp_transitions(model, <dp_t*> NULL)
+
+    memset(path, -1, (n+m)*sizeof(int))
+
+    # Fill in the emission table
+    for l in range( model.silent_start ):
+        for i in range( n ):
+            if model.multivariate:
+                e[l*n + i] = ((<Model>distributions[l])._mv_log_probability( sequence+i*dim ) +
+                    model.state_weights[l])
+            else:
+                e[l*n + i] = ((<Model>distributions[l])._log_probability( sequence[i] ) +
+                    model.state_weights[l])
+
+    for i in range( m ):
+        v[i] = NEGINF
+    v[model.start_index] = 0
+
+    for l in range( model.silent_start, m ):
+        # Handle transitions between silent states before the first symbol
+        # is emitted. No non-silent states have non-zero probability yet, so
+        # we can ignore them.
+        if l == model.start_index:
+            # Start state log-probability is already right. Don't touch it.
+            continue
+
+        for k in range( in_edges[l], in_edges[l+1] ):
+            ki = model.in_transitions[k]
+            if ki < model.silent_start or ki >= l:
+                continue
+
+            # For each current-step preceeding silent state k
+            # This holds the log-probability coming that way
+            state_log_probability = v[ki] + transitions[k]
+
+            if state_log_probability > v[l]:
+                v[l] = state_log_probability
+                tracebackx[l] = 0
+                tracebacky[l] = ki
+
+    for i in range( n ):
+        for l in range( model.silent_start ):
+            # Do the recurrence for non-silent states l
+            # Start out saying the best likelihood we have is -inf
+            v[(i+1)*m + l] = NEGINF
+
+            for k in range( in_edges[l], in_edges[l+1] ):
+                ki = model.in_transitions[k]
+
+                # For each previous state k
+                # This holds the log-probability coming that way
+                state_log_probability = v[i*m + ki] + \
+                    transitions[k] + e[i + l*n]
+
+                if state_log_probability > v[(i+1)*m + l]:
+                    v[(i+1)*m + l] = state_log_probability
+                    tracebackx[(i+1)*m + l] = i
+                    tracebacky[(i+1)*m + l] = ki
+
+        for l in range( model.silent_start, m ):
+            # Now do the first pass over the silent states, finding the best
+            # current-step non-silent state they could come from.
+            # Start out saying the best likelihood we have is -inf
+            v[(i+1)*m + l] = NEGINF
+
+            for k in range( in_edges[l], in_edges[l+1] ):
+                ki = model.in_transitions[k]
+                if ki >= model.silent_start:
+                    continue
+
+                # For each current-step non-silent state k
+                # This holds the log-probability coming that way
+                state_log_probability = v[(i+1)*m + ki] + \
+                    transitions[k]
+
+                if state_log_probability > v[(i+1)*m + l]:
+                    v[(i+1)*m + l] = state_log_probability
+                    tracebackx[(i+1)*m + l] = i+1
+                    tracebacky[(i+1)*m + l] = ki
+
+        for l in range( model.silent_start, m ):
+            # Now the second pass through silent states, where we check the
+            # silent states that could potentially reach here and see if
+            # they're better than the non-silent states we found.
+
+            for k in range( in_edges[l], in_edges[l+1] ):
+                ki = model.in_transitions[k]
+                if ki < model.silent_start or ki >= l:
+                    continue
+
+                # For each current-step preceeding silent state k
+                # This holds the log-probability coming that way
+                state_log_probability = v[(i+1)*m + ki] + \
+                    transitions[k]
+
+                if state_log_probability > v[(i+1)*m + l]:
+                    v[(i+1)*m + l] = state_log_probability
+                    tracebackx[(i+1)*m + l] = i+1
+                    tracebacky[(i+1)*m + l] = ki
+
+    # Now the DP table is filled in. If this is a finite model, get the
+    # log likelihood of ending up in the end state after following the
+    # ML path through the model. If an infinite sequence, find the state
+    # which the ML path ends in, and begin there.
+    if model.finite == 1:
+        log_probability = v[n*m + model.end_index]
+        end_index = model.end_index
+    else:
+        end_index = -1
+        log_probability = NEGINF
+        for i in range(m):
+            if v[n*m + i] > log_probability:
+                log_probability = v[n*m + i]
+                end_index = i
+
+    if log_probability == NEGINF:
+        free(tracebackx)
+        free(tracebacky)
+        free(v)
+        free(e)
+        return log_probability
+
+    # Otherwise, do the traceback
+    # This holds the path, which we construct in reverse order
+    cdef int px = n, py = end_index, npx
+    cdef int length = 0
+
+    while px != 0 or py != model.start_index:
+        # Until we've traced back to the start...
+        # Put the position in the path, making sure to look up the state
+        # object to use instead of the state index.
+        path[length] = py
+        length += 1
+
+        # Go backwards
+        npx = tracebackx[px*m + py]
+        py = tracebacky[px*m + py]
+        px = npx
+
+    # We've now reached the start (if we didn't raise an exception because
+    # we messed up the traceback)
+    # Record that we start at the start
+    path[length] = py
+
+    for i in range((length + 1) / 2):
+        path[i], path[length-i] = path[length-i], path[i] 
+
+    free(tracebackx)
+    free(tracebacky)
+    free(v)
+    free(e)
+    return log_probability
@@ -4,5 +4,6 @@
 cdef void mdot(double* X, double* Y, double* A, int m, int n, int k) nogil
 cdef double _log (double x) nogil
 cdef double pair_lse(double x, double y) nogil
+cdef float pair_lse_float(float x, float y) nogil
 cdef double gamma(double x) nogil
 cdef double lgamma(double x) nogil
\ No newline at end of file
@@ -7,6 +7,10 @@ from libc.math cimport exp as cexp
 from libc.math cimport floor
 from libc.math cimport fabs
 
+cdef extern from "math.h" nogil:
+	float expf(float x)
+	float logf(float x)
+
 from libc.stdlib cimport calloc, free
 from scipy.linalg.cython_blas cimport dgemm
 
@@ -89,6 +93,21 @@ cdef double pair_lse(double x, double y) nogil:
 		return x + clog( cexp( y-x ) + 1 )
 	return y + clog( cexp( x-y ) + 1 )
 
+cdef float pair_lse_float(float x, float y) nogil:
+	'''
+	The same as pair_lse, in single precision.
+	'''
+
+	if x == INF or y == INF:
+		return INF
+	if x == NEGINF:
+		return y
+	if y == NEGINF:
+		return x
+	if x > y:
+		return x + logf( expf( y-x ) + 1 )
+	return y + logf( expf( x-y ) + 1 )
+
 cdef double gamma(double x) nogil:
 	"""Calculate the gamma function on a number."""
     
@@ -1,10 +1,14 @@
 from StringIO import StringIO
+import hashlib
+import json
+import os
 
 from Bio.Align.Applications import MuscleCommandline
 from Bio import AlignIO
 
 from profiler import time_usage
 import settings
+from utils import cache_entry_lock, write_file_atomically
 
 
 @time_usage
@@ -218,16 +222,85 @@ def print_emission_and_transition_matrices(emission, transition, alignment, alph
     print
 
 
+def get_ungapped_alignment_of_repeats(repeats):
+    """Return the repeats as their own alignment if they have the same length and differ in a few positions
+
+    MUSCLE does not put gaps in identical repeats, so with the default mismatch rate of 0 this is the alignment that
+    MUSCLE would return. Units with substitutions can still be gapped by MUSCLE with a compensating indel, so a larger
+    mismatch rate gives a different profile. Returns None for other repeats.
+    """
+    unit_length = len(repeats[0])
+    max_mismatches = settings.MAX_UNGAPPED_REPEATS_MISMATCH_RATE * unit_length
+    for repeat in repeats[1:]:
+        if len(repeat) != unit_length:
+            return None
+        if sum([1 for a, b in zip(repeats[0], repeat) if a != b]) > max_mismatches:
+            return None
+    return list(repeats)
+
+
+def align_repeats_with_muscle(repeats):
+    muscle_cline = MuscleCommandline(settings.MUSCLE_DIR, clwstrict=True)
+    data = '\n'.join(['>%s\n' % str(i) + repeats[i] for i in range(len(repeats))])
+    stdout, stderr = muscle_cline(stdin=data)
+    alignment = AlignIO.read(StringIO(stdout), "clustal")
+    return [str(aligned.seq) for aligned in alignment]
+
+
+def get_profile_hmm_cache_file(repeats, error_rate):
+    key = hashlib.sha1('%s %r %r' % (','.join(repeats), error_rate,
+                                     settings.MAX_UNGAPPED_REPEATS_MISMATCH_RATE)).hexdigest()
+    return settings.PROFILE_HMMS_DIR + key + '.json'
+
+
+def load_profile_hmm(cache_file):
+    with open(cache_file) as infile:
+        matrices = json.load(infile)
+    return tuple([{str(key): {str(sub_key): value for sub_key, value in row.items()} for key, row in matrix.items()}
+                  for matrix in matrices])
+
+
+def save_profile_hmm(cache_file, transition, emission):
+    write_file_atomically(cache_file, lambda outfile: json.dump([transition, emission], outfile))
+
+
 @time_usage
 def build_profile_hmm_for_repeats(repeats, error_rate):
+    """Build the profile HMM of the repeat units, or load it from the cache of profiles built before
+
+    A missing profile is built under a lock of its cache file, so concurrent runs build it once.
+    """
+    if not settings.USE_TRAINED_HMMS:
+        return build_profile_hmm_of_alignment(repeats, error_rate)
+    cache_file = get_profile_hmm_cache_file(repeats, error_rate)
+    if os.path.isfile(cache_file):
+        return load_profile_hmm(cache_file)
+
+    if not os.path.isdir(os.path.dirname(cache_file)):
+        try:
+            os.makedirs(os.path.dirname(cache_file))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                raise
+    with cache_entry_lock(cache_file):
+        if os.path.isfile(cache_file):
+            return load_profile_hmm(cache_file)
+        transition, emission = build_profile_hmm_of_alignment(repeats, error_rate)
+        save_profile_hmm(cache_file, transition, emission)
+    return transition, emission
+
+
+def build_profile_hmm_of_alignment(repeats, error_rate):
+    """Build the profile HMM of the repeat units
+
+    Repeats that are nearly identical are used as their own alignment, and MUSCLE aligns the others.
+    """
     alphabet = 'ACGT'
     pseudocounts = (len(repeats) / 4.0) * (error_rate / 10)
     threshold = 0.5
 
-    muscle_cline = MuscleCommandline(settings.MUSCLE_DIR, clwstrict=True)
-    data = '\n'.join(['>%s\n' % str(i) + repeats[i] for i in range(len(repeats))])
-    stdout, stderr = muscle_cline(stdin=data)
-    alignment = AlignIO.read(StringIO(stdout), "clustal")
-    aligned_repeats = [str(aligned.seq) for aligned in alignment]
+    aligned_repeats = get_ungapped_alignment_of_repeats(repeats)
+    if aligned_repeats is None:
+        aligned_repeats = align_repeats_with_muscle(repeats)
 
     return build_profile_hmm_pseudocounts_for_alignment(threshold, pseudocounts, alphabet, aligned_repeats)
@@ -1,10 +1,13 @@
+import logging
 import os
+import sqlite3
 
 from multiprocessing import Process, Semaphore, Manager
 from Bio import pairwise2
 from Bio import Seq, SeqRecord
 
-from hmm_utils import build_reference_repeat_finder_hmm, get_repeat_segments_from_visited_states_and_region
+from hmm_utils import build_reference_repeat_finder_hmm, get_repeat_segments_from_vpath_and_region, \
+    get_state_indices_from_vpath, StateTable
 from utils import *
 from vntr_annotation import get_gene_name_and_annotation_of_vntr, is_vntr_close_to_gene, get_genes_info
 import settings
@@ -61,8 +64,8 @@ class ReferenceVNTR:
         patterns = [self.pattern]
         model = build_reference_repeat_finder_hmm(patterns, copies=self.estimated_repeats)
         logp, path = model.viterbi(region_in_ref)
-        visited_states = [state.name for idx, state in path[1:-1]]
-        repeat_segments = get_repeat_segments_from_visited_states_and_region(visited_states, region_in_ref)
+        vpath = get_state_indices_from_vpath(path)
+        repeat_segments = get_repeat_segments_from_vpath_and_region(vpath, StateTable(model), region_in_ref)
 
         return repeat_segments
 
@@ -86,6 +89,30 @@ class ReferenceVNTR:
         return left_flanking, right_flanking
 
 
+class LazyReferenceVNTR(ReferenceVNTR):
+    """Reference VNTR of the catalog whose flanking regions and repeat segments are read on first access"""
+
+    lazy_attributes = ('repeat_segments', 'left_flanking_region', 'right_flanking_region')
+
+    def __init__(self, db_file, vntr_id, pattern, start_point, chromosome, gene_name, annotation, estimated_repeats):
+        ReferenceVNTR.__init__(self, vntr_id, pattern, start_point, chromosome, gene_name, annotation, estimated_repeats)
+        self.db_file = db_file
+        for attribute in self.lazy_attributes:
+            delattr(self, attribute)
+
+    def __getattr__(self, name):
+        if name not in LazyReferenceVNTR.lazy_attributes:
+            raise AttributeError(name)
+        cursor = get_catalog_connection(self.db_file).execute(
+            'SELECT left_flanking, right_flanking, repeats FROM vntrs WHERE id = ?', (self.id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError('VNTR %s is not in the catalog %s' % (self.id, self.db_file))
+        left_flank, right_flank, segments = [str(element) for element in row]
+        self.init_from_xml(segments.split(','), left_flank, right_flank)
+        return getattr(self, name)
+
+
 def load_unprocessed_vntrseek_data(vntrseek_output, chromosome=None):
     vntrs = []
     genes_info = get_genes_info()
@@ -204,6 +231,101 @@ def load_unique_vntrs_data(db_file='vntr_data/hg19_VNTRs.db'):
     return vntrs
 
 
+def add_vntr_database_indices(db_file):
+    """Index the VNTR catalog by id and by position
+
+    This writes to the catalog, so it is only done when the catalog is made or by the indexdb command, and never by
+    the commands that read the catalog.
+    """
+    db = sqlite3.connect(db_file)
+    db.execute('CREATE INDEX IF NOT EXISTS vntrs_id ON vntrs (id)')
+    db.execute('CREATE INDEX IF NOT EXISTS vntrs_position ON vntrs (chromosome, ref_start)')
+    db.commit()
+    db.close()
+
+
+def has_vntr_database_indices(db):
+    cursor = db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'vntrs'")
+    index_names = set([row[0] for row in cursor])
+    return 'vntrs_id' in index_names and 'vntrs_position' in index_names
+
+
+opened_catalogs = {}
+
+
+def get_catalog_connection(db_file):
+    """Return the read-only connection of this process to the catalog"""
+    key = (db_file, os.getpid())
+    if key not in opened_catalogs:
+        db = sqlite3.connect(db_file)
+        db.execute('PRAGMA query_only = 1')
+        opened_catalogs[key] = db
+    return opened_catalogs[key]
+
+
+def load_vntrs_from_catalog(vntr_ids=None, chromosome=None, start=None, end=None, db_file='vntr_data/hg19_VNTRs.db'):
+    """Load the VNTRs with the given ids, or the VNTRs that overlap a region, from the catalog
+
+    Only the rows of the requested VNTRs are read, using the indices of the catalog, so loading a few VNTRs does not
+    depend on the catalog size once it is indexed by add_vntr_database_indices. Without the indices the lookups scan
+    the catalog, and a warning is logged. If neither ids nor a region are given, all VNTRs are loaded, and their
+    flanking regions and repeat segments are only read when they are first used.
+    """
+    db = get_catalog_connection(db_file)
+    if (vntr_ids is not None or chromosome is not None) and not has_vntr_database_indices(db):
+        logging.warning('%s is not indexed, so loading VNTRs scans the whole catalog. Index it with the indexdb '
+                        'command to load a few VNTRs quickly' % db_file)
+    columns = 'id, nonoverlapping, chromosome, ref_start, gene_name, annotation, pattern, left_flanking, ' \
+              'right_flanking, repeats'
+    rows = []
+    if vntr_ids is not None:
+        vntr_ids = list(vntr_ids)
+        chunk_size = 500
+        for i in range(0, len(vntr_ids), chunk_size):
+            chunk = vntr_ids[i:i + chunk_size]
+            query = 'SELECT %s FROM vntrs WHERE id IN (%s)' % (columns, ','.join('?' * len(chunk)))
+            rows += db.execute(query, chunk).fetchall()
+    elif chromosome is not None:
+        query = 'SELECT %s FROM vntrs WHERE chromosome = ?' % columns
+        parameters = [chromosome]
+        if end is not None:
+            query += ' AND ref_start < ?'
+            parameters.append(end)
+        if start is not None:
+            query += " AND ref_start + LENGTH(REPLACE(repeats, ',', '')) > ?"
+            parameters.append(start)
+        rows = db.execute(query, parameters).fetchall()
+    else:
+        return load_lazy_vntrs_from_catalog(db_file)
+
+    vntrs = []
+    for row in rows:
+        row = [str(element) if type(element) == unicode else element for element in row]
+        vntr_id, overlap, vntr_chromosome, ref_start, gene, annotation, pattern, left_flank, right_flank, segments = row
+        repeat_segments = segments.split(',')
+        vntr = ReferenceVNTR(int(vntr_id), pattern, int(ref_start), vntr_chromosome, gene, annotation,
+                             len(repeat_segments))
+        vntr.init_from_xml(repeat_segments, left_flank, right_flank)
+        vntr.non_overlapping = True if overlap == 'True' else False
+        vntrs.append(vntr)
+    return sorted(vntrs, key=lambda vntr: vntr.id)
+
+
+def load_lazy_vntrs_from_catalog(db_file):
+    """Load all VNTRs of the catalog without their flanking regions and repeat segments"""
+    columns = "id, nonoverlapping, chromosome, ref_start, gene_name, annotation, pattern, " \
+              "LENGTH(repeats) - LENGTH(REPLACE(repeats, ',', '')) + 1"
+    vntrs = []
+    for row in get_catalog_connection(db_file).execute('SELECT %s FROM vntrs' % columns).fetchall():
+        row = [str(element) if type(element) == unicode else element for element in row]
+        vntr_id, overlap, vntr_chromosome, ref_start, gene, annotation, pattern, repeats_count = row
+        vntr = LazyReferenceVNTR(db_file, int(vntr_id), pattern, int(ref_start), vntr_chromosome, gene, annotation,
+                                 repeats_count)
+        vntr.non_overlapping = True if overlap == 'True' else False
+        vntrs.append(vntr)
+    return sorted(vntrs, key=lambda vntr: vntr.id)
+
+
 def save_vntrs_to_database(processed_vntrs, db_file):
     import sqlite3
     with open(processed_vntrs) as input_file:
@@ -225,6 +347,7 @@ def save_vntrs_to_database(processed_vntrs, db_file):
             paired += 1
     db.commit()
     db.close()
+    add_vntr_database_indices(db_file)
     print('%s %s %s' % (processed_vntrs, singles, paired))
 
 
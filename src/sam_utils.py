@@ -3,19 +3,63 @@ import os
 import settings
 
 from profiler import time_usage
+from utils import Read, get_reverse_complement, write_file_atomically
+
+
+def get_unmapped_reads_file_name(alignment_file, working_directory='./'):
+    base_name = os.path.basename(alignment_file).rsplit('.', 1)[0]
+    return working_directory + base_name + '.unmapped.fasta'
+
+
+def iterate_unmapped_reads(alignment_file, threads=None):
+    """Yield the unmapped reads of the alignment file as they are decompressed
+
+    Reads are named and oriented like samtools bam2fq does, with /1 or /2 for paired reads and the sequence reverse
+    complemented if the read is on the reverse strand. Records without a sequence are skipped, and reads marked as
+    duplicates are skipped if SKIP_DUPLICATE_UNMAPPED_READS is set.
+    """
+    threads = threads if threads is not None else settings.ALIGNMENT_FILE_THREADS
+    read_mode = 'r' if alignment_file.endswith('sam') else 'rb'
+    samfile = pysam.AlignmentFile(alignment_file, read_mode, threads=threads)
+    for read in samfile.fetch(until_eof=True):
+        if not read.is_unmapped or read.is_secondary or read.is_supplementary or not read.query_sequence:
+            continue
+        if read.is_duplicate and settings.SKIP_DUPLICATE_UNMAPPED_READS:
+            continue
+        name = read.query_name
+        if read.is_read1:
+            name += '/1'
+        elif read.is_read2:
+            name += '/2'
+        sequence = read.query_sequence
+        if read.is_reverse:
+            sequence = get_reverse_complement(sequence)
+        yield Read(name, sequence)
+    samfile.close()
+
+
+def get_read_length_of_alignment_file(alignment_file, number_of_reads=1000):
+    """Return the length of the longest of the first mapped reads of the alignment file"""
+    read_mode = 'r' if alignment_file.endswith('sam') else 'rb'
+    samfile = pysam.AlignmentFile(alignment_file, read_mode)
+    read_length = 0
+    for i, read in enumerate(samfile.fetch(until_eof=True)):
+        if i >= number_of_reads:
+            break
+        if not read.is_unmapped and read.query_length:
+            read_length = max(read_length, read.query_length)
+    samfile.close()
+    return read_length
 
 
 @time_usage
 def extract_unmapped_reads_to_fasta_file(alignment_file, working_directory='./', use_existing_computed_files=True):
-    base_name = os.path.basename(alignment_file).rsplit('.', 1)[0]
-    unmapped_bam_file = working_directory + base_name + '.unmapped.bam'
-    unmapped_read_file = working_directory + base_name + '.unmapped.fasta'
-    fastq_to_fasta_command = "paste - - - - | sed 's/^@/>/g'| cut -f1-2 | tr '\t' '\n'"
+    unmapped_read_file = get_unmapped_reads_file_name(alignment_file, working_directory)
     if not use_existing_computed_files or not os.path.exists(unmapped_read_file):
-        if not use_existing_computed_files or not os.path.exists(unmapped_bam_file):
-            os.system('samtools view -b -f4 %s | samtools rmdup -S - %s' % (alignment_file, unmapped_bam_file))
-        os.system('samtools bam2fq %s | %s > %s' % (unmapped_bam_file, fastq_to_fasta_command, unmapped_read_file))
-        os.system('rm -f %s' % unmapped_bam_file)
+        def write_reads(outfile):
+            for read in iterate_unmapped_reads(alignment_file):
+                outfile.write('>%s\n%s\n' % (read.id, read.seq))
+        write_file_atomically(unmapped_read_file, write_reads)
     return unmapped_read_file
 
 
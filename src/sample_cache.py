@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+
+import pysam
+
+from blast_wrapper import get_blast_database
+from sam_utils import extract_unmapped_reads_to_fasta_file, get_unmapped_reads_file_name, iterate_unmapped_reads
+from utils import atomic_output_file, cache_entry_lock, read_fasta_file, write_file_atomically
+import settings
+
+
+# Changing how unmapped reads are extracted must change this, so that earlier extractions are not reused
+UNMAPPED_READS_EXTRACTION = {'method': 'pysam', 'skip_reads_without_sequence': True}
+
+
+def get_sha1(text):
+    return hashlib.sha1(text).hexdigest()
+
+
+def make_directory(directory):
+    """Make directory unless it exists, also when another process makes it at the same time"""
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+
+def get_input_file_signature(input_file):
+    """Return the size, modification time and a checksum of the header of an alignment file or of the head of a file"""
+    stat = os.stat(input_file)
+    if input_file.endswith('bam') or input_file.endswith('sam'):
+        read_mode = 'r' if input_file.endswith('sam') else 'rb'
+        header = pysam.AlignmentFile(input_file, read_mode).text
+    else:
+        with open(input_file) as infile:
+            header = infile.read(1 << 20)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'header_sha1': get_sha1(header)}
+
+
+class SampleCache:
+    """Files made from the input file of a sample that are reused by later runs on the same sample
+
+    The directory of a sample is named by a hash of the size, modification time and header of its input file and of
+    the extraction parameters, so a changed input file never reuses stale files, and runs in different working
+    directories share it. It keeps the unmapped reads, their BLAST database and the reads selected for each VNTR,
+    and a manifest that lists the files that are complete.
+    """
+
+    def __init__(self, input_file, cache_dir):
+        self.input_file = input_file
+        signature = get_input_file_signature(input_file)
+        signature['extraction'] = dict(UNMAPPED_READS_EXTRACTION, skip_duplicates=settings.SKIP_DUPLICATE_UNMAPPED_READS)
+        self.directory = cache_dir + get_sha1(json.dumps(signature, sort_keys=True))[:20] + '/'
+        self.manifest_file = self.directory + 'manifest.json'
+        make_directory(self.directory)
+        manifest = {'input_file': os.path.abspath(input_file), 'signature': signature, 'recruitments': {}}
+        self.update_manifest(lambda stored_manifest: stored_manifest or manifest)
+
+    def get_manifest(self):
+        if not os.path.isfile(self.manifest_file):
+            return None
+        with open(self.manifest_file) as infile:
+            return json.load(infile)
+
+    def update_manifest(self, update):
+        """Replace the manifest with update(manifest), holding the lock of the manifest"""
+        with cache_entry_lock(self.manifest_file):
+            manifest = update(self.get_manifest())
+            write_file_atomically(self.manifest_file, lambda outfile: json.dump(manifest, outfile, indent=2))
+
+    def add_to_manifest(self, key, value):
+        def add(manifest):
+            manifest[key] = value
+            return manifest
+        self.update_manifest(add)
+
+    def get_unmapped_reads_file(self):
+        """Return the unmapped reads of the alignment file, extracting them if an earlier run has not"""
+        with cache_entry_lock(self.directory + 'unmapped_reads'):
+            unmapped_reads_file = self.get_manifest().get('unmapped_reads')
+            if unmapped_reads_file is not None and os.path.isfile(self.directory + unmapped_reads_file):
+                return self.directory + unmapped_reads_file
+            unmapped_reads_file = extract_unmapped_reads_to_fasta_file(self.input_file, self.directory, False)
+            self.add_to_manifest('unmapped_reads', os.path.basename(unmapped_reads_file))
+        return unmapped_reads_file
+
+    def get_unmapped_reads(self):
+        """Return an iterator over the unmapped reads of the alignment file
+
+        If an earlier run has not extracted them, the reads are streamed from the alignment file and written to the
+        sample directory as they pass, so the caller starts on the first reads and later runs read the smaller file.
+        The extraction holds the lock of the unmapped reads, so concurrent runs wait for it and then read the file.
+        """
+        unmapped_reads_file = self.get_manifest().get('unmapped_reads')
+        if unmapped_reads_file is not None and os.path.isfile(self.directory + unmapped_reads_file):
+            return read_fasta_file(self.directory + unmapped_reads_file)
+        return self.stream_unmapped_reads()
+
+    def stream_unmapped_reads(self):
+        with cache_entry_lock(self.directory + 'unmapped_reads'):
+            unmapped_reads_file = self.get_manifest().get('unmapped_reads')
+            if unmapped_reads_file is not None and os.path.isfile(self.directory + unmapped_reads_file):
+                for read in read_fasta_file(self.directory + unmapped_reads_file):
+                    yield read
+                return
+            unmapped_reads_file = get_unmapped_reads_file_name(self.input_file, self.directory)
+            with atomic_output_file(unmapped_reads_file) as outfile:
+                for read in iterate_unmapped_reads(self.input_file):
+                    outfile.write('>%s\n%s\n' % (read.id, read.seq))
+                    yield read
+            self.add_to_manifest('unmapped_reads', os.path.basename(unmapped_reads_file))
+
+    def get_blast_database(self, read_file):
+        """Return the name of the BLAST database of read_file in the sample directory, and whether it is empty"""
+        with cache_entry_lock(self.directory + 'blast_db'):
+            blast_db_name, empty_db = get_blast_database(self.directory, read_file)
+            if not empty_db:
+                self.add_to_manifest('blast_db', os.path.basename(blast_db_name))
+        return blast_db_name, empty_db
+
+    def get_recruitment_directory(self, recruitment):
+        recruitment_key = get_sha1(json.dumps(recruitment, sort_keys=True))[:20]
+
+        def add_recruitment(manifest):
+            manifest['recruitments'][recruitment_key] = recruitment
+            return manifest
+        if recruitment_key not in self.get_manifest()['recruitments']:
+            self.update_manifest(add_recruitment)
+        directory = self.directory + 'recruitments/' + recruitment_key + '/'
+        make_directory(directory)
+        return directory
+
+    @staticmethod
+    def get_read_ids_file_name(directory, vntr_finder, short_reads):
+        queries = vntr_finder.get_keyword_matching_queries(short_reads)
+        return directory + '%s_%s.txt' % (vntr_finder.reference_vntr.id, get_sha1(json.dumps(queries))[:12])
+
+    def load_read_ids(self, recruitment, vntr_finders, short_reads=True):
+        """Return the read ids that an earlier run selected with these recruitment parameters for each of the VNTRs"""
+        directory = self.get_recruitment_directory(recruitment)
+        vntr_read_ids = {}
+        for vntr_id, vntr_finder in vntr_finders.items():
+            read_ids_file = self.get_read_ids_file_name(directory, vntr_finder, short_reads)
+            if os.path.isfile(read_ids_file):
+                with open(read_ids_file) as infile:
+                    vntr_read_ids[vntr_id] = set([line.strip() for line in infile if line.strip() != ''])
+        return vntr_read_ids
+
+    def save_read_ids(self, recruitment, vntr_finders, vntr_read_ids, short_reads=True):
+        directory = self.get_recruitment_directory(recruitment)
+        for vntr_id, read_ids in vntr_read_ids.items():
+            read_ids_file = self.get_read_ids_file_name(directory, vntr_finders[vntr_id], short_reads)
+            lines = ['%s\n' % read_id for read_id in sorted(read_ids)]
+            write_file_atomically(read_ids_file, lambda outfile: outfile.writelines(lines))
@@ -7,13 +7,57 @@ GENOME_LENGTH = 3100000000
 MAX_INSERT_SIZE = 1000
 
 USE_TRAINED_HMMS = True
+# Match the repeats by looping over one repeat unit profile instead of unrolling it for every copy
+USE_CYCLIC_REPEAT_MATCHER = False
 TRAINED_HMMS_DIR = 'vntr_data/'
+# Prebuilt read matcher models, written by the buildmodels command and opened read-only for genotyping
+MODEL_STORE_FILE = TRAINED_HMMS_DIR + 'models.db'
+# Profile HMMs of the repeat units, keyed by a hash of the repeat units and the error rate
+PROFILE_HMMS_DIR = TRAINED_HMMS_DIR + 'profiles/'
+# Read matcher models built in a process are kept in memory until their total number of states passes this
+MAX_CACHED_MODEL_STATES = 50000
+# Minimum scores to select a read, keyed by VNTR, read length, sampling fraction and error rate
+THRESHOLD_STORE_FILE = TRAINED_HMMS_DIR + 'thresholds.db'
 SCORE_FINDING_READS_FRACTION = 0.0001
+# Stored scores are only used for a sampling fraction within this ratio of their own, otherwise scores are found again
+SCORE_FRACTION_TOLERANCE = 0.1
 SCORE_SELECTION_PERCENTILE = 0
 SAVE_SCORE_DISTRIBUTION = False
 SCALE_SCORES = True
+# Models are built for read lengths rounded up to a multiple of this, and a stored model of a longer length is reused
+READ_LENGTH_BUCKET_SIZE = 50
 
 BLAST_TMP_DIR = 'blast_tmp/'
+# Directory shared by runs for the unmapped reads, BLAST databases and selected reads of each sample,
+# sample_cache/ in the working directory if None
+SAMPLE_CACHE_DIR = None
+# Select the unmapped reads of all VNTRs in one pass over the reads with a k-mer index instead of BLAST searches.
+# Enable it once compare_kmer_recruitment_with_blast of compare_read_recruitments finds no read that it misses
+USE_KMER_RECRUITMENT = False
+# Number of k-mers that a read must share with the repeat segments of a VNTR
+RECRUITMENT_MIN_KMER_HITS = 3
+# Smaller BLAST word sizes of the keyword matching are raised to this k-mer size, or kept if None
+RECRUITMENT_MIN_KMER_SIZE = None
+# Number of reads that are looked up in the k-mer index together
+RECRUITMENT_CHUNK_SIZE = 10000
+# Threads that decompress an alignment file while its unmapped reads are read
+ALIGNMENT_FILE_THREADS = 4
+# Skip unmapped reads that are flagged as duplicates, which the samtools extraction used to keep
+SKIP_DUPLICATE_UNMAPPED_READS = False
+# Discard short reads without a window close in nucleotide composition to the repeats of a target VNTR,
+# and k-mers of the repeats of the same VNTR, before the BLAST database of the reads is made.
+# The defaults reject more than 99% of random 150bp reads for 200 random target VNTRs, and keep reads with 45bp of
+# repeats at 2% substitutions. They drop reads with shorter parts of the repeats, which BLAST recruits with word
+# sizes down to 5, so the filter is off. Enable it once compare_prefilter_with_blast of compare_read_recruitments
+# finds no BLAST-recruited read that it misses.
+# The prefiltered reads and their BLAST database are named by the target VNTRs, so every new set of target VNTRs
+# writes them again instead of reusing the BLAST database of the unmapped reads.
+USE_READ_PREFILTER = False
+PREFILTER_WINDOW_SIZE = 30
+# Largest L1 distance between the A, C, G and T counts of a read window and of a window of the repeats
+PREFILTER_MAX_COMPOSITION_DISTANCE = 4
+PREFILTER_KMER_SIZE = 13
+PREFILTER_MIN_KMER_HITS = 3
 
 GC_CONTENT_WINDOW_SIZE = 100
 GC_CONTENT_BINS = 10
@@ -24,6 +68,14 @@ LOW_QUALITY_BP_TO_DISCARD_READ = 0.10
 MAPQ_CUTOFF = 0
 
 MAX_ERROR_RATE = 0.05
+# Repeat units of one length that differ from the first unit in at most this fraction of positions are not aligned.
+# With 0 only identical units skip MUSCLE; larger values are faster but MUSCLE may have gapped such units
+MAX_UNGAPPED_REPEATS_MISMATCH_RATE = 0
+
+# Reads whose Viterbi DP table (read length * model states) is larger than this are decoded with checkpointing
+MAX_VITERBI_DP_CELLS = 50000000
+# Decode reads with float32 instead of float64 DP tables, see compare_dp_precisions.py to validate it on the VNTRs
+USE_SINGLE_PRECISION_DP = False
 
 hostname = socket.gethostname()
 if hostname.startswith('genome'):
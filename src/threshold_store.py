@@ -0,0 +1,119 @@
+import math
+import os
+import sqlite3
+
+import numpy
+
+import settings
+
+
+class ThresholdStore:
+    """Minimum scores to select a read of many VNTRs in one sqlite table
+
+    A score is keyed by VNTR id, read length of the model, fraction of reads sampled to find it and error rate of the
+    model, and it is stored with a summary of the score distribution of the sampled false reads. Scores of many VNTRs
+    can be loaded with one query and are kept in memory afterwards.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.db = sqlite3.connect(db_file, timeout=600)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS thresholds (vntr_id INTEGER, read_length INTEGER, fraction REAL,
+        error_rate REAL, score REAL, false_reads INTEGER, mean REAL, std REAL, min REAL, max REAL,
+        PRIMARY KEY (vntr_id, read_length, fraction, error_rate))''')
+        self.db.commit()
+        self.thresholds = {}
+
+    def load_thresholds(self, vntr_ids):
+        """Read the stored scores of all these VNTRs into memory"""
+        vntr_ids = list(vntr_ids)
+        for vntr_id in vntr_ids:
+            self.thresholds[vntr_id] = []
+        chunk_size = 500
+        for i in range(0, len(vntr_ids), chunk_size):
+            chunk = vntr_ids[i:i + chunk_size]
+            query = 'SELECT vntr_id, read_length, fraction, error_rate, score FROM thresholds WHERE vntr_id IN (%s)'
+            cursor = self.db.execute(query % ','.join('?' * len(chunk)), chunk)
+            for vntr_id, read_length, fraction, error_rate, score in cursor:
+                self.thresholds[vntr_id].append((read_length, fraction, error_rate, score))
+
+    def get_thresholds(self, vntr_id):
+        if vntr_id not in self.thresholds:
+            self.load_thresholds([vntr_id])
+        return self.thresholds[vntr_id]
+
+    def get_score(self, vntr_id, read_length, fraction, error_rate, scale=True):
+        """Return the score for this read length, or None if there is no score for this error rate and fraction
+
+        Scores found with the sampling fraction closest to the given fraction are used, if their fractions differ by
+        at most settings.SCORE_FRACTION_TOLERANCE of the given fraction. If the read length is not stored, the score
+        is interpolated between the stored read lengths around it, or scaled from the closest stored read length
+        when scale is set.
+        """
+        max_distance = math.log(1 + settings.SCORE_FRACTION_TOLERANCE)
+        rows = [(length, row_fraction, score) for length, row_fraction, row_error_rate, score in
+                self.get_thresholds(vntr_id) if row_error_rate == error_rate and
+                get_fraction_distance(row_fraction, fraction) <= max_distance]
+        if not len(rows):
+            return None
+        closest_fraction = min(set([row[1] for row in rows]), key=lambda f: get_fraction_distance(f, fraction))
+        scores = sorted([(length, score) for length, row_fraction, score in rows if row_fraction == closest_fraction])
+        return interpolate_score(scores, read_length, scale)
+
+    def save_score(self, vntr_id, read_length, fraction, error_rate, score, false_scores):
+        summary = (None, None, None, None)
+        if len(false_scores):
+            summary = (float(numpy.mean(false_scores)), float(numpy.std(false_scores)), float(min(false_scores)),
+                       float(max(false_scores)))
+        self.db.execute('INSERT OR REPLACE INTO thresholds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (vntr_id, read_length, fraction, error_rate, float(score), len(false_scores)) + summary)
+        self.db.commit()
+        self.load_thresholds([vntr_id])
+
+    def import_scores_file(self, vntr_id, scores_file, error_rate):
+        """Add the scores of a per-VNTR .scores file with lines of read length, fraction and score"""
+        with open(scores_file) as infile:
+            lines = [line.split() for line in infile.readlines() if line.strip() != '']
+        for read_length, fraction, score in lines:
+            self.db.execute('INSERT OR IGNORE INTO thresholds (vntr_id, read_length, fraction, error_rate, score) '
+                            'VALUES (?, ?, ?, ?, ?)', (vntr_id, int(read_length), float(fraction), error_rate,
+                                                       float(score)))
+        self.db.commit()
+        self.load_thresholds([vntr_id])
+
+
+def get_fraction_distance(stored_fraction, fraction):
+    """Return how far apart two sampling fractions are by their ratio, or infinity if one of them is not positive"""
+    if stored_fraction <= 0 or fraction <= 0:
+        return 0 if stored_fraction == fraction else float('inf')
+    return abs(math.log(float(stored_fraction) / fraction))
+
+
+def interpolate_score(scores, read_length, scale=True):
+    """Return the score of read_length from the sorted (read length, score) pairs of a VNTR"""
+    for length, score in scores:
+        if length == read_length:
+            return score
+    if not scale:
+        return None
+    shorter = [(length, score) for length, score in scores if length < read_length]
+    longer = [(length, score) for length, score in scores if length > read_length]
+    if len(shorter) and len(longer):
+        (short_length, short_score), (long_length, long_score) = shorter[-1], longer[0]
+        weight = (read_length - short_length) / float(long_length - short_length)
+        return short_score + (long_score - short_score) * weight
+    length, score = shorter[-1] if len(shorter) else longer[0]
+    return score * read_length / float(length)
+
+
+opened_threshold_stores = {}
+
+
+def get_threshold_store():
+    """Return the threshold store of this process"""
+    db_file = settings.THRESHOLD_STORE_FILE
+    if db_file not in opened_threshold_stores:
+        if not os.path.isdir(os.path.dirname(db_file) or '.'):
+            os.makedirs(os.path.dirname(db_file))
+        opened_threshold_stores[db_file] = ThresholdStore(db_file)
+    return opened_threshold_stores[db_file]
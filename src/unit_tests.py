@@ -1,5 +1,188 @@
+import io
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
 import unittest
+from multiprocessing import Process
+
+import numpy
+
+from acgt_filter import ReadPrefilter
+from hmm_utils import DNA_COMPLEMENT, StateTable, VpathSummary, add_prefix_matcher_to_model, \
+    add_repeat_unit_loop_matcher_to_model, add_repeat_unit_profile_to_model, add_suffix_matcher_to_model, \
+    get_read_matcher_model, get_reverse_complement, get_state_indices_from_vpath
+from kmer_recruiter import BASE_CODES, KmerRecruiter, get_kmer_codes, get_rolling_kmer_codes
+from model_store import ModelCache, ModelStore
+from pomegranate import HiddenMarkovModel as Model
+from pomegranate import DiscreteDistribution, State
+from profile_hmm import build_profile_hmm_for_repeats
+from reference_vntr import ReferenceVNTR, add_vntr_database_indices, load_vntrs_from_catalog
 from sam_utils import get_related_reads_and_read_count_in_samfile
+from threshold_store import ThresholdStore, interpolate_score
+from utils import atomic_output_file, cache_entry_lock, get_read_length_bucket, write_file_atomically
+from vntr_finder import VNTRFinder
+import settings
+
+
+TEST_LEFT_FLANK = 'GATTACAGGCCTTAAGCTAGCATCGATTGACCGTAGGCAT'
+TEST_RIGHT_FLANK = 'TTGACCGTAGGCATGCAAGTCCTAGGAGATCGGATCCAAT'
+TEST_UNIT = 'ACGGTTCAGGA'
+
+
+def get_test_read_matcher_model(cyclic=False):
+    """Build a small read matcher of identical repeat units, without adding its profile to the cache"""
+    use_trained_hmms = settings.USE_TRAINED_HMMS
+    settings.USE_TRAINED_HMMS = False
+    try:
+        return get_read_matcher_model(TEST_LEFT_FLANK[-30:], TEST_RIGHT_FLANK[:30], [TEST_UNIT] * 4, 8, cyclic)
+    finally:
+        settings.USE_TRAINED_HMMS = use_trained_hmms
+
+
+def get_flank_matcher_hmm(add_flank_matcher_to_model, pattern, name):
+    model = Model(name=name)
+    flank_start, flank_end = add_flank_matcher_to_model(model, pattern)
+    model.add_transition(model.start, flank_start, 1)
+    model.add_transition(flank_end, model.end, 1)
+    model.bake(merge=None)
+    return model
+
+
+def get_dense_repeats_matcher_hmm(patterns, copies, cyclic):
+    """Build the repeats matcher the way the read matcher was built before it was added to one model"""
+    transitions, emissions = build_profile_hmm_for_repeats(patterns, settings.MAX_ERROR_RATE)
+    if cyclic:
+        model = Model(name='Repeat Matcher HMM Model')
+        repeats_start, repeats_end, _ = add_repeat_unit_loop_matcher_to_model(model, transitions, emissions, None, 0)
+        model.add_transition(model.start, repeats_start, 1)
+        model.add_transition(repeats_end, model.end, 1)
+        model.bake(merge=None)
+        return model
+
+    model = Model(name='Repeating Pattern Matcher HMM Model')
+    last_end = model.start
+    for repeat in range(copies):
+        unit_start, unit_end, _, _ = add_repeat_unit_profile_to_model(model, transitions, emissions, repeat)
+        model.add_transition(last_end, unit_start, 1)
+        last_end = unit_end
+    model.add_transition(last_end, model.end, 1)
+    model.bake(merge=None)
+
+    mat = model.dense_transition_matrix()
+    states_count = len(mat)
+    start_repeats_ind, end_repeats_ind = states_count, states_count + 1
+    mat = numpy.c_[mat, numpy.zeros(states_count), numpy.zeros(states_count)]
+    mat = numpy.r_[mat, [numpy.zeros(states_count + 2)], [numpy.zeros(states_count + 2)]]
+    first_unit_start = numpy.flatnonzero(mat[model.start_index])[-1]
+    mat[model.start_index][first_unit_start] = 0
+    mat[model.start_index][start_repeats_ind] = 1
+    mat[start_repeats_ind][first_unit_start] = 1
+    for i, state in enumerate(model.states):
+        if state.name.startswith('unit_end'):
+            mat[i][numpy.flatnonzero(mat[i])[-1]] = 0.5
+            mat[i][end_repeats_ind] = 0.5
+    mat[end_repeats_ind][model.end_index] = 1
+    states = model.states + [State(None, name='start_repeating_pattern_match'),
+                             State(None, name='end_repeating_pattern_match')]
+    # from_matrix connected the last state, end_repeating_pattern_match, to the end of the model
+    return get_model_from_dense_matrix(mat, states, model.start_index, 'end_repeating_pattern_match',
+                                       'Repeat Matcher HMM Model')
+
+
+def get_model_from_dense_matrix(mat, states, start_index, end_name, name):
+    """Rebuild a model with from_matrix and connect the state named end_name to the end of the new model"""
+    starts = numpy.zeros(len(states))
+    starts[start_index] = 1.0
+    model = Model.from_matrix(mat, [state.distribution for state in states], starts, name=name,
+                              state_names=[state.name for state in states], merge=None)
+    end = [state for state in model.states if state.name == end_name][0]
+    model.add_transition(end, model.end, 1)
+    model.bake(merge=None)
+    return model
+
+
+def get_dense_read_matcher_model(left_flanking_region, right_flanking_region, patterns, copies, cyclic=False):
+    """Build the read matcher by concatenating its parts and editing their dense transition matrix, as
+    get_read_matcher_model did before it added all states and edges to one model
+
+    Unlike from_matrix in the old builder, the end of the right flank is always connected to the end of the model.
+    """
+    model = get_flank_matcher_hmm(add_suffix_matcher_to_model, left_flanking_region, 'Suffix Matcher HMM Model')
+    model.concatenate(get_dense_repeats_matcher_hmm(patterns, copies, cyclic))
+    model.concatenate(get_flank_matcher_hmm(add_prefix_matcher_to_model, right_flanking_region,
+                                            'Prefix Matcher HMM Model'))
+    model.bake(merge=None)
+
+    mat = model.dense_transition_matrix()
+    first_repeat_matches = []
+    repeat_match_states = []
+    suffix_start = None
+    for i, state in enumerate(model.states):
+        if state.name[0] == 'M' and state.name.split('_')[-1] == '0':
+            first_repeat_matches.append(i)
+        if state.name[0] == 'M' and state.name.split('_')[-1] not in ['prefix', 'suffix']:
+            repeat_match_states.append(i)
+        if state.name == 'suffix_start_suffix':
+            suffix_start = i
+
+    mat[model.start_index][suffix_start] = 0.3
+    for first_repeat_match in first_repeat_matches:
+        mat[model.start_index][first_repeat_match] = 0.7 / len(first_repeat_matches)
+    repeat_units = copies if cyclic else 1
+    for match_state in repeat_match_states:
+        to_end = 0.7 / (len(repeat_match_states) * repeat_units)
+        mat[match_state] /= 1 + to_end
+        mat[match_state][model.end_index] = to_end
+    return get_model_from_dense_matrix(mat, model.states, model.start_index, model.end.name, 'Read Matcher')
+
+
+def get_test_reads(count=20, read_length=60):
+    """Return reads of the test VNTR with a few substitutions, half of them reverse complemented, and random reads"""
+    random_generator = random.Random(0)
+    haplotype = TEST_LEFT_FLANK[-30:] + TEST_UNIT * 6 + TEST_RIGHT_FLANK[:30]
+    reads = []
+    for i in range(count):
+        start = random_generator.randint(0, len(haplotype) - read_length)
+        read = ''.join([random_generator.choice('ACGT') if random_generator.random() < 0.03 else base
+                        for base in haplotype[start:start + read_length]])
+        reads.append(get_reverse_complement(read) if i % 2 else read)
+    reads += [''.join([random_generator.choice('ACGT') for _ in range(read_length)]) for _ in range(count / 4)]
+    return reads
+
+
+def get_test_chain_model():
+    """Build a model of two states which only emit A, so AA is the only sequence that is possible under it"""
+    model = Model(name='Chain')
+    first = State(DiscreteDistribution({'A': 1.0, 'C': 0.0, 'G': 0.0, 'T': 0.0}), name='first')
+    second = State(DiscreteDistribution({'A': 1.0, 'C': 0.0, 'G': 0.0, 'T': 0.0}), name='second')
+    model.add_states([first, second])
+    model.add_transition(model.start, first, 1)
+    model.add_transition(first, second, 1)
+    model.add_transition(second, model.end, 1)
+    model.bake(merge=None)
+    return model
+
+
+class ReadMatcherTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model = get_test_read_matcher_model()
+        cls.reads = get_test_reads()
+
+    def assertSamePath(self, vpath, path):
+        self.assertEqual([state_index for state_index, state in vpath], list(path))
+
+    def assertSameDecoding(self, expected, logp, path):
+        expected_logp, expected_vpath = expected
+        self.assertEqual(logp, expected_logp)
+        if expected_vpath is None:
+            self.assertIsNone(path)
+        else:
+            self.assertSamePath(expected_vpath, path)
 
 
 class TestBlastFilteringMethod(unittest.TestCase):
@@ -19,5 +202,655 @@ class TestBlastFilteringMethod(unittest.TestCase):
                 print('FN in filtering')
 
 
+def build_cache_entry(file_name, log_file_name, attempts=20):
+    """Build the cache entry in file_name unless it exists, logging when the lock of the entry is held"""
+    for _ in range(attempts):
+        with cache_entry_lock(file_name):
+            with open(log_file_name, 'a') as log_file:
+                log_file.write('lock %s\n' % os.getpid())
+            time.sleep(0.001)
+            if not os.path.isfile(file_name):
+                write_file_atomically(file_name, lambda outfile: outfile.write('%s\n' % os.getpid() * 10000))
+                with open(log_file_name, 'a') as log_file:
+                    log_file.write('build %s\n' % os.getpid())
+            with open(log_file_name, 'a') as log_file:
+                log_file.write('unlock %s\n' % os.getpid())
+
+
+class TestCacheEntryLock(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'entry')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_concurrent_writers(self):
+        log_file_name = os.path.join(self.directory, 'log')
+        processes = [Process(target=build_cache_entry, args=(self.file_name, log_file_name)) for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual([process.exitcode for process in processes], [0] * 4)
+        with open(log_file_name) as log_file:
+            events = [line.split() for line in log_file]
+        holders = [pid for event, pid in events if event == 'lock']
+        self.assertEqual([pid for event, pid in events if event == 'unlock'], holders)
+        self.assertEqual([event for event, pid in events if event != 'build'], ['lock', 'unlock'] * len(holders))
+        builders = [pid for event, pid in events if event == 'build']
+        self.assertEqual(len(builders), 1)
+        with open(self.file_name) as entry_file:
+            self.assertEqual(entry_file.read(), '%s\n' % builders[0] * 10000)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['entry', 'log'])
+
+    def test_failed_write_keeps_previous_file(self):
+        write_file_atomically(self.file_name, lambda outfile: outfile.write('previous'))
+        with self.assertRaises(KeyboardInterrupt):
+            with atomic_output_file(self.file_name) as outfile:
+                outfile.write('partial')
+                raise KeyboardInterrupt()
+        with open(self.file_name) as entry_file:
+            self.assertEqual(entry_file.read(), 'previous')
+        self.assertEqual(os.listdir(self.directory), ['entry'])
+
+
+class TestCatalogLoading(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.directory, 'vntrs.db')
+        db = sqlite3.connect(self.db_file)
+        db.execute('''CREATE TABLE vntrs (id INTEGER, nonoverlapping TEXT, chromosome TEXT, ref_start INTEGER,
+        gene_name TEXT, annotation TEXT, pattern TEXT, left_flanking TEXT, right_flanking TEXT, repeats TEXT)''')
+        for vntr_id, chromosome, start in [(1, 'chr1', 1000), (2, 'chr1', 5000), (3, 'chr2', 1000)]:
+            db.execute('INSERT INTO vntrs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (vntr_id, 'True', chromosome, start, 'GENE', 'Coding', TEST_UNIT, TEST_LEFT_FLANK,
+                        TEST_RIGHT_FLANK, ','.join([TEST_UNIT] * vntr_id)))
+        db.commit()
+        db.close()
+        add_vntr_database_indices(self.db_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_select_ids(self):
+        vntrs = load_vntrs_from_catalog([3, 1], db_file=self.db_file)
+        self.assertEqual([vntr.id for vntr in vntrs], [1, 3])
+        self.assertEqual(vntrs[1].get_repeat_segments(), [TEST_UNIT] * 3)
+        self.assertEqual(vntrs[1].left_flanking_region, TEST_LEFT_FLANK)
+        self.assertEqual(vntrs[1].chromosome, 'chr2')
+        self.assertEqual(load_vntrs_from_catalog([4], db_file=self.db_file), [])
+
+    def test_select_region(self):
+        vntrs = load_vntrs_from_catalog(chromosome='chr1', start=1010, end=6000, db_file=self.db_file)
+        self.assertEqual([vntr.id for vntr in vntrs], [1, 2])
+        vntrs = load_vntrs_from_catalog(chromosome='chr1', start=1000 + len(TEST_UNIT), db_file=self.db_file)
+        self.assertEqual([vntr.id for vntr in vntrs], [2])
+        vntrs = load_vntrs_from_catalog(chromosome='chr1', end=5000, db_file=self.db_file)
+        self.assertEqual([vntr.id for vntr in vntrs], [1])
+
+    def test_lazy_loading(self):
+        vntrs = load_vntrs_from_catalog(db_file=self.db_file)
+        self.assertEqual([vntr.id for vntr in vntrs], [1, 2, 3])
+        self.assertEqual(vntrs[1].estimated_repeats, 2)
+        self.assertNotIn('repeat_segments', vars(vntrs[1]))
+        self.assertEqual(vntrs[1].get_repeat_segments(), [TEST_UNIT] * 2)
+        self.assertEqual(vntrs[1].right_flanking_region, TEST_RIGHT_FLANK)
+
+    def test_lazy_loading_of_missing_vntr(self):
+        vntrs = load_vntrs_from_catalog(db_file=self.db_file)
+        db = sqlite3.connect(self.db_file)
+        db.execute('DELETE FROM vntrs WHERE id = 3')
+        db.commit()
+        db.close()
+        self.assertRaises(ValueError, vntrs[2].get_repeat_segments)
+
+
+class TestThresholdStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ThresholdStore(':memory:')
+        for read_length, score in [(100, -20.0), (150, -30.0)]:
+            self.store.save_score(1, read_length, 0.0001, 0.05, score, [score - 1, score - 2])
+        self.store.save_score(1, 150, 0.01, 0.05, -50.0, [])
+
+    def test_exact_read_length(self):
+        self.assertEqual(self.store.get_score(1, 150, 0.0001, 0.05), -30.0)
+        self.assertEqual(self.store.get_score(1, 150, 0.01, 0.05), -50.0)
+
+    def test_interpolated_read_length(self):
+        self.assertAlmostEqual(self.store.get_score(1, 125, 0.0001, 0.05), -25.0)
+        self.assertIsNone(self.store.get_score(1, 125, 0.0001, 0.05, scale=False))
+
+    def test_extrapolated_read_length(self):
+        self.assertAlmostEqual(self.store.get_score(1, 300, 0.0001, 0.05), -60.0)
+        self.assertAlmostEqual(self.store.get_score(1, 50, 0.0001, 0.05), -10.0)
+
+    def test_close_fraction(self):
+        self.assertEqual(self.store.get_score(1, 150, 0.000105, 0.05), -30.0)
+        self.assertEqual(self.store.get_score(1, 150, 0.0095, 0.05), -50.0)
+
+    def test_far_fraction(self):
+        self.assertIsNone(self.store.get_score(1, 150, 0.0002, 0.05))
+        self.assertIsNone(self.store.get_score(1, 150, 0.005, 0.05))
+
+    def test_missing_error_rate_or_vntr(self):
+        self.assertIsNone(self.store.get_score(1, 150, 0.0001, 0.3))
+        self.assertIsNone(self.store.get_score(2, 150, 0.0001, 0.05))
+
+    def test_non_positive_fraction(self):
+        self.store.save_score(3, 150, 0, 0.05, -10.0, [])
+        self.store.save_score(3, 150, 0.0001, 0.05, -40.0, [])
+        self.assertEqual(self.store.get_score(3, 150, 0.0001, 0.05), -40.0)
+        self.assertEqual(self.store.get_score(3, 150, 0, 0.05), -10.0)
+
+    def test_interpolate_score(self):
+        scores = [(100, -20.0), (200, -40.0)]
+        self.assertEqual(interpolate_score(scores, 100), -20.0)
+        self.assertAlmostEqual(interpolate_score(scores, 150), -30.0)
+        self.assertAlmostEqual(interpolate_score(scores, 250), -50.0)
+
+
+class KeywordMatchingQueries:
+    def __init__(self, short_read_queries, long_read_queries):
+        self.short_read_queries = short_read_queries
+        self.long_read_queries = long_read_queries
+
+    def get_keyword_matching_queries(self, short_reads=True):
+        if short_reads:
+            return self.short_read_queries, 11, 0
+        return self.long_read_queries, 11, 70
+
+
+class TestKmerRecruiter(unittest.TestCase):
+
+    def setUp(self):
+        self.left_flank = 'GATTACAGGCCTTAAGCTAGCATCGAT'
+        self.right_flank = 'TTGACCGTAGGCATGCAAGTCCTAGGA'
+        self.unit = 'CAGTTGACCTAGGA'
+        self.vntr = KeywordMatchingQueries([self.unit * 2], [self.left_flank, self.right_flank])
+        self.other_vntr = KeywordMatchingQueries(['ACACGTGTTTCCGGAA' * 2], ['ACACGTGTTTCCGGAAT', 'GGGCCCAATTATCGCG'])
+
+    def test_rolling_kmer_codes(self):
+        bases = BASE_CODES[numpy.frombuffer('ACGTNAC', dtype=numpy.uint8)]
+        codes, valid = get_rolling_kmer_codes(bases, 2)
+        self.assertEqual(list(valid), [True, True, True, False, False, True])
+        self.assertEqual(list(codes[valid]), [0 * 4 + 1, 1 * 4 + 2, 2 * 4 + 3, 0 * 4 + 1])
+        self.assertEqual(list(get_kmer_codes('ACGTNAC', 2)), [1, 6, 11, 1])
+        self.assertEqual(len(get_kmer_codes('ACG', 4)), 0)
+
+    def test_short_reads_are_selected_by_repeats(self):
+        recruiter = KmerRecruiter({1: self.vntr, 2: self.other_vntr}, True, min_hits=3, min_kmer_size=11)
+        read = 'TTTTTTTTTT' + self.unit * 3 + 'AAAAAAAAAA'
+        reverse_read = get_reverse_complement(read)
+        unrelated_read = 'ACGTTGCA' * 10
+        self.assertEqual(recruiter.find_vntrs_of_sequences([read, reverse_read, unrelated_read]), [[1], [1], []])
+
+    def test_long_reads_need_both_flanks(self):
+        recruiter = KmerRecruiter({1: self.vntr, 2: self.other_vntr}, False, min_hits=3, min_kmer_size=11)
+        spanning_read = self.left_flank + self.unit * 10 + self.right_flank
+        left_read = self.left_flank + self.unit * 10
+        right_read = self.unit * 10 + self.right_flank
+        self.assertEqual(recruiter.find_vntrs_of_sequences([spanning_read, left_read, right_read]), [[1], [], []])
+
+
+def get_random_sequence(random_generator, length):
+    return ''.join([random_generator.choice('ACGT') for _ in range(length)])
+
+
+def add_substitutions(random_generator, sequence, error_rate):
+    return ''.join([random_generator.choice([b for b in 'ACGT' if b != base])
+                    if random_generator.random() < error_rate else base for base in sequence])
+
+
+class SimulatedVNTRsTestCase(unittest.TestCase):
+    """Two VNTRs of random repeat units and flanking regions, and reads of them with sequencing errors"""
+
+    def setUp(self):
+        self.random_generator = random.Random(1)
+        self.vntr_finders = {}
+        self.haplotypes = {}
+        for vntr_id, unit_length, copies in [(1, 33, 8), (2, 36, 6)]:
+            unit = get_random_sequence(self.random_generator, unit_length)
+            left_flank = get_random_sequence(self.random_generator, 200)
+            right_flank = get_random_sequence(self.random_generator, 200)
+            reference_vntr = ReferenceVNTR(vntr_id, unit, 1000, 'chr1', None, None, copies)
+            reference_vntr.init_from_xml([unit] * copies, left_flank, right_flank)
+            self.vntr_finders[vntr_id] = VNTRFinder(reference_vntr)
+            self.haplotypes[vntr_id] = left_flank + unit * copies + right_flank
+
+    def get_reads(self, vntr_id, read_length, starts, error_rate):
+        reads = []
+        for i, start in enumerate(starts):
+            read = add_substitutions(self.random_generator, self.haplotypes[vntr_id][start:start + read_length],
+                                     error_rate)
+            reads.append(get_reverse_complement(read) if i % 2 else read)
+        return reads
+
+    def get_repeat_reads(self, vntr_id, min_repeat_bps, error_rate=0.02, read_length=150):
+        """Return reads with at least min_repeat_bps base pairs of the repeats of the VNTR"""
+        repeats_length = len(self.haplotypes[vntr_id]) - 400
+        starts = range(200 + min_repeat_bps - read_length, 200 + repeats_length - min_repeat_bps + 1, 7)
+        return self.get_reads(vntr_id, read_length, starts, error_rate)
+
+
+class TestKmerRecruitmentOfSimulatedReads(SimulatedVNTRsTestCase):
+    """Reads which the BLAST keyword matching of their VNTRs selects"""
+
+    def test_short_reads(self):
+        recruiter = KmerRecruiter(self.vntr_finders, True)
+        reads = {vntr_id: self.get_repeat_reads(vntr_id, 60) for vntr_id in self.haplotypes.keys()}
+        random_reads = [get_random_sequence(self.random_generator, 150) for _ in range(50)]
+        for vntr_id in self.vntr_finders.keys():
+            self.assertEqual(recruiter.find_vntrs_of_sequences(reads[vntr_id]), [[vntr_id]] * len(reads[vntr_id]))
+        self.assertEqual(recruiter.find_vntrs_of_sequences(random_reads), [[]] * len(random_reads))
+
+    def test_long_reads(self):
+        recruiter = KmerRecruiter(self.vntr_finders, False)
+        for vntr_id, haplotype in self.haplotypes.items():
+            spanning_reads = self.get_reads(vntr_id, len(haplotype) - 100, [0, 50, 100], 0.1)
+            self.assertEqual(recruiter.find_vntrs_of_sequences(spanning_reads), [[vntr_id]] * 3)
+            flank_reads = [haplotype[:len(haplotype) - 200], haplotype[200:]]
+            self.assertEqual(recruiter.find_vntrs_of_sequences(flank_reads), [[], []])
+
+
+class TestReadLengthBucketedModel(SimulatedVNTRsTestCase):
+    """Reads scored by the model of their read length bucket and by a model built for their exact length"""
+
+    def get_scores(self, model, reads):
+        return model.viterbi_batch(reads, path=False, complement=DNA_COMPLEMENT)[0]
+
+    def test_same_selection_as_exact_read_length_model(self):
+        read_length = 110
+        model_read_length = get_read_length_bucket(read_length)
+        self.assertGreater(model_read_length, read_length)
+        vntr_finder = self.vntr_finders[1]
+        false_reads = [get_random_sequence(self.random_generator, read_length) for _ in range(100)]
+        repeat_reads = self.get_repeat_reads(1, 45, read_length=read_length)
+        reads = repeat_reads + [get_random_sequence(self.random_generator, read_length) for _ in range(50)]
+        selections = []
+        for length in [read_length, model_read_length]:
+            model = vntr_finder.build_vntr_matcher_hmm_for_read_length(length)
+            min_score = VNTRFinder.calculate_min_score_to_select_a_read(list(self.get_scores(model, false_reads)))
+            selections.append([score >= min_score for score in self.get_scores(model, reads)])
+        self.assertEqual(selections[0], selections[1])
+        self.assertEqual(selections[1][:len(repeat_reads)], [True] * len(repeat_reads))
+
+
+class TestVpathSummary(unittest.TestCase):
+
+    def test_insertions_of_cyclic_units(self):
+        model = get_test_read_matcher_model(cyclic=True)
+        sequence = TEST_LEFT_FLANK[-30:] + TEST_UNIT * 2 + TEST_UNIT[:5] + 'A' + TEST_UNIT[5:] + TEST_UNIT[:5] + 'G' + \
+            TEST_UNIT[5:] + TEST_UNIT + TEST_RIGHT_FLANK[:30]
+        logp, vpath = model.viterbi(sequence)
+        summary = VpathSummary(get_state_indices_from_vpath(vpath), StateTable(model), sequence)
+        self.assertEqual(summary.repeats, 5)
+        self.assertEqual(summary.indels, [(2, 'I5A'), (3, 'I5G')])
+
+
+class TestReadMatcherModel(ReadMatcherTestCase):
+
+    def assertSameAsDenseModel(self, cyclic):
+        use_trained_hmms = settings.USE_TRAINED_HMMS
+        settings.USE_TRAINED_HMMS = False
+        try:
+            model = get_read_matcher_model(TEST_LEFT_FLANK[-30:], TEST_RIGHT_FLANK[:30], [TEST_UNIT] * 4, 8, cyclic)
+            dense_model = get_dense_read_matcher_model(TEST_LEFT_FLANK[-30:], TEST_RIGHT_FLANK[:30], [TEST_UNIT] * 4,
+                                                       8, cyclic)
+        finally:
+            settings.USE_TRAINED_HMMS = use_trained_hmms
+        for read in self.reads + [get_reverse_complement(read) for read in self.reads]:
+            logp, vpath = model.viterbi(read)
+            dense_logp, dense_vpath = dense_model.viterbi(read)
+            self.assertAlmostEqual(logp, dense_logp, places=9)
+            self.assertAlmostEqual(model.log_probability(read), dense_model.log_probability(read), places=9)
+            if logp > float('-inf'):
+                self.assertEqual([state.name for index, state in vpath if not state.is_silent()],
+                                 [state.name for index, state in dense_vpath if not state.is_silent()])
+
+    def test_same_as_dense_model(self):
+        self.assertSameAsDenseModel(cyclic=False)
+
+    def test_same_as_dense_cyclic_model(self):
+        self.assertSameAsDenseModel(cyclic=True)
+
+
+class TestViterbiBatch(ReadMatcherTestCase):
+
+    def test_same_as_viterbi(self):
+        logps, paths = self.model.viterbi_batch(self.reads, n_jobs=2, batch_size=3)
+        for read, logp, path in zip(self.reads, logps, paths):
+            expected_logp, expected_vpath = self.model.viterbi(read)
+            self.assertEqual(logp, expected_logp)
+            self.assertSamePath(expected_vpath, path)
+
+    def test_no_sequences(self):
+        logps, paths = self.model.viterbi_batch([])
+        self.assertEqual(len(logps), 0)
+        self.assertEqual(paths, [])
+
+    def test_empty_sequence(self):
+        logps, paths = self.model.viterbi_batch(['', self.reads[0], ''], n_jobs=2, batch_size=1)
+        self.assertSameDecoding(self.model.viterbi(''), logps[0], paths[0])
+        self.assertSameDecoding(self.model.viterbi(self.reads[0]), logps[1], paths[1])
+        self.assertSameDecoding(self.model.viterbi(''), logps[2], paths[2])
+
+
+class TestViterbiScore(ReadMatcherTestCase):
+
+    def test_same_as_viterbi(self):
+        for read in self.reads:
+            self.assertEqual(self.model.viterbi_score(read), self.model.viterbi(read)[0])
+
+    def test_batch_without_path(self):
+        logps = self.model.viterbi_batch(self.reads, path=False)
+        self.assertEqual(list(logps), [self.model.viterbi(read)[0] for read in self.reads])
+
+    def test_empty_sequence(self):
+        self.assertEqual(self.model.viterbi_score(''), self.model.viterbi('')[0])
+        self.assertEqual(list(self.model.viterbi_batch([''], path=False)), [self.model.viterbi('')[0]])
+
+
+class TestCheckpointedViterbi(ReadMatcherTestCase):
+
+    def test_same_as_viterbi(self):
+        for read in self.reads:
+            expected_logp, expected_vpath = self.model.viterbi(read)
+            logp, vpath = self.model.viterbi(read, checkpoint=True)
+            self.assertEqual(logp, expected_logp)
+            self.assertSamePath(expected_vpath, [state_index for state_index, state in vpath])
+
+    def test_segment_boundaries(self):
+        # segments are sqrt(n) columns long, so square lengths end on a segment boundary and the lengths around
+        # them leave a short last segment or one of a single column
+        haplotype = TEST_LEFT_FLANK[-30:] + TEST_UNIT * 6 + TEST_RIGHT_FLANK[:30]
+        for root in range(1, 12):
+            for length in [root * root - 1, root * root, root * root + 1]:
+                expected_logp, expected_vpath = self.model.viterbi(haplotype[:length])
+                logp, vpath = self.model.viterbi(haplotype[:length], checkpoint=True)
+                self.assertSameDecoding((expected_logp, expected_vpath), logp,
+                                        None if vpath is None else [state_index for state_index, state in vpath])
+
+    def test_empty_sequence(self):
+        expected_logp, expected_vpath = self.model.viterbi('')
+        logp, vpath = self.model.viterbi('', checkpoint=True)
+        self.assertSameDecoding((expected_logp, expected_vpath), logp,
+                                None if vpath is None else [state_index for state_index, state in vpath])
+
+
+class TestViterbiStrands(ReadMatcherTestCase):
+
+    def get_better_strand(self, read):
+        logp, vpath = self.model.viterbi(read)
+        reverse_logp, reverse_vpath = self.model.viterbi(get_reverse_complement(read))
+        if reverse_logp > logp:
+            return reverse_logp, reverse_vpath, True
+        return logp, vpath, False
+
+    def test_same_as_viterbi_of_better_strand(self):
+        for read in self.reads:
+            expected_logp, expected_vpath, expected_reverse = self.get_better_strand(read)
+            logp, vpath, reverse = self.model.viterbi_strands(read, DNA_COMPLEMENT)
+            self.assertEqual((logp, reverse), (expected_logp, expected_reverse))
+            self.assertSamePath(expected_vpath, [state_index for state_index, state in vpath])
+
+    def test_batch_of_strands(self):
+        logps, paths, reverse = self.model.viterbi_batch(self.reads, n_jobs=2, complement=DNA_COMPLEMENT)
+        for i, read in enumerate(self.reads):
+            expected_logp, expected_vpath, expected_reverse = self.get_better_strand(read)
+            self.assertEqual((logps[i], reverse[i]), (expected_logp, expected_reverse))
+            self.assertSamePath(expected_vpath, paths[i])
+
+    def test_batch_of_strands_with_threshold(self):
+        better_strands = [self.get_better_strand(read) for read in self.reads]
+        threshold = sorted([logp for logp, vpath, reverse in better_strands])[len(self.reads) / 2]
+        logps, paths, reverse = self.model.viterbi_batch(self.reads, complement=DNA_COMPLEMENT, threshold=threshold)
+        for i, (expected_logp, expected_vpath, expected_reverse) in enumerate(better_strands):
+            if expected_logp >= threshold:
+                self.assertEqual((logps[i], reverse[i]), (expected_logp, expected_reverse))
+                self.assertSamePath(expected_vpath, paths[i])
+            elif logps[i] == float('-inf'):
+                self.assertIsNone(paths[i])
+
+    def test_empty_sequence(self):
+        expected_logp, expected_vpath = self.model.viterbi('')
+        logp, vpath, reverse = self.model.viterbi_strands('', DNA_COMPLEMENT)
+        self.assertEqual((logp, reverse), (expected_logp, False))
+        self.assertEqual(vpath, expected_vpath)
+        logps, paths, reverse = self.model.viterbi_batch([''], complement=DNA_COMPLEMENT)
+        self.assertSameDecoding((expected_logp, expected_vpath), logps[0], paths[0])
+        self.assertFalse(reverse[0])
+
+
+class TestByteKeymap(ReadMatcherTestCase):
+
+    def test_same_as_keymap(self):
+        for read in self.reads:
+            logp, vpath = self.model.viterbi(read)
+            expected_logp, expected_vpath = self.model.viterbi(list(read))
+            self.assertEqual(logp, expected_logp)
+            self.assertSamePath(expected_vpath, [state_index for state_index, state in vpath])
+            byte_array = numpy.frombuffer(read, dtype=numpy.uint8)
+            self.assertEqual(self.model.viterbi_score(byte_array), expected_logp)
+
+    def test_undefined_symbol(self):
+        self.assertRaises(ValueError, self.model.viterbi, self.reads[0][:10] + 'N' + self.reads[0][10:])
+
+
+class TestEarlyAbandon(ReadMatcherTestCase):
+
+    def test_no_false_negatives(self):
+        logps = [self.model.viterbi(read)[0] for read in self.reads]
+        threshold = sorted(logps)[len(logps) / 2]
+        for read, logp in zip(self.reads, logps):
+            score = self.model.viterbi_score(read, threshold)
+            if logp >= threshold:
+                self.assertEqual(score, logp)
+            else:
+                self.assertLess(score, threshold)
+            # a read that scores exactly the threshold is kept
+            self.assertEqual(self.model.viterbi_score(read, logp), logp)
+
+    def test_batch_with_threshold(self):
+        logps = [self.model.viterbi(read)[0] for read in self.reads]
+        threshold = sorted(logps)[len(logps) / 2]
+        batch_logps, paths = self.model.viterbi_batch(self.reads, threshold=threshold)
+        for read, logp, batch_logp, path in zip(self.reads, logps, batch_logps, paths):
+            if logp >= threshold or batch_logp > float('-inf'):
+                # reads below the threshold are only abandoned once the bound shows that they can not reach it
+                self.assertEqual(batch_logp, logp)
+                self.assertSamePath(self.model.viterbi(read)[1], path)
+            else:
+                self.assertIsNone(path)
+
+    def test_threshold_at_score(self):
+        for read in self.reads:
+            expected_logp, expected_vpath = self.model.viterbi(read)
+            logps, paths = self.model.viterbi_batch([read], threshold=expected_logp)
+            self.assertSameDecoding((expected_logp, expected_vpath), logps[0], paths[0])
+            self.assertEqual(list(self.model.viterbi_batch([read], path=False, threshold=expected_logp)),
+                             [expected_logp])
+            logp = max(expected_logp, self.model.viterbi(get_reverse_complement(read))[0])
+            logps, paths, reverse = self.model.viterbi_batch([read], complement=DNA_COMPLEMENT, threshold=logp)
+            self.assertEqual(logps[0], logp)
+            self.assertIsNotNone(paths[0])
+
+
+class TestImpossibleSequences(unittest.TestCase):
+
+    def setUp(self):
+        self.model = get_test_chain_model()
+
+    def test_possible_sequence(self):
+        logp, vpath = self.model.viterbi('AA')
+        self.assertEqual(logp, 0)
+        self.assertEqual([state.name for state_index, state in vpath], ['Chain-start', 'first', 'second', 'Chain-end'])
+        self.assertEqual(self.model.viterbi_score('AA', 0.0), 0)
+
+    def test_viterbi(self):
+        for sequence in ['', 'A', 'AC', 'AAA']:
+            self.assertEqual(self.model.viterbi(sequence), (float('-inf'), None))
+            self.assertEqual(self.model.viterbi(sequence, checkpoint=True), (float('-inf'), None))
+
+    def test_viterbi_score(self):
+        for sequence in ['', 'A', 'AC', 'AAA']:
+            self.assertEqual(self.model.viterbi_score(sequence), float('-inf'))
+            self.assertEqual(self.model.viterbi_score(sequence, -1000.0), float('-inf'))
+
+    def test_viterbi_strands(self):
+        # the reverse complement of AC is GT, which is impossible too
+        self.assertEqual(self.model.viterbi_strands('AC', DNA_COMPLEMENT), (float('-inf'), None, False))
+        self.assertEqual(self.model.viterbi_strands('TT', DNA_COMPLEMENT)[::2], (0, True))
+
+    def test_viterbi_batch(self):
+        sequences = ['AC', 'AA', 'AAA']
+        for threshold in [None, -1000.0]:
+            logps, paths = self.model.viterbi_batch(sequences, threshold=threshold)
+            self.assertEqual(list(logps), [float('-inf'), 0, float('-inf')])
+            self.assertEqual([path is None for path in paths], [True, False, True])
+            logps, paths, reverse = self.model.viterbi_batch(sequences, complement=DNA_COMPLEMENT, threshold=threshold)
+            self.assertEqual(list(logps), [float('-inf'), 0, float('-inf')])
+            self.assertEqual([path is None for path in paths], [True, False, True])
+
+
+class TestSinglePrecision(unittest.TestCase):
+
+    def setUp(self):
+        self.model = get_test_read_matcher_model()
+        self.reads = get_test_reads()[:20]
+
+    def decode_reads(self, single_precision):
+        self.model.single_precision = single_precision
+        logps, paths, reverse = self.model.viterbi_batch(self.reads, complement=DNA_COMPLEMENT)
+        state_table = StateTable(self.model)
+        strands = [get_reverse_complement(read) if rev else read for read, rev in zip(self.reads, reverse)]
+        return logps, [VpathSummary(path, state_table, strand) for path, strand in zip(paths, strands)]
+
+    def test_same_as_double_precision(self):
+        double_logps, double_summaries = self.decode_reads(False)
+        single_logps, single_summaries = self.decode_reads(True)
+        for double_logp, single_logp in zip(double_logps, single_logps):
+            self.assertLess(abs(single_logp - double_logp), 1e-3)
+        self.assertEqual([summary.repeats for summary in single_summaries],
+                         [summary.repeats for summary in double_summaries])
+        self.assertEqual([summary.repeat_bps for summary in single_summaries],
+                         [summary.repeat_bps for summary in double_summaries])
+
+    def test_forward(self):
+        double_logps = [self.model.log_probability(read) for read in self.reads]
+        self.model.single_precision = True
+        for read, double_logp in zip(self.reads, double_logps):
+            self.assertLess(abs(self.model.log_probability(read) - double_logp), 1e-3)
+
+
+class TestModelCache(ReadMatcherTestCase):
+
+    def test_same_scores_as_new_model(self):
+        cache = ModelCache()
+        cache.add_model(1, 8, 30, False, self.model)
+        model = cache.get_model(1, 8, 30)
+        self.assertEqual(list(model.viterbi_batch(self.reads, path=False)),
+                         list(get_test_read_matcher_model().viterbi_batch(self.reads, path=False)))
+
+    def test_only_same_copies(self):
+        cache = ModelCache()
+        cache.add_model(1, 8, 30, False, self.model)
+        self.assertIsNone(cache.get_model(1, 6, 30))
+        self.assertIsNone(cache.get_model(1, 8, 30, cyclic=True))
+        self.assertIsNone(cache.get_model(2, 8, 30))
+
+
+class TestNpzArchive(ReadMatcherTestCase):
+
+    def test_round_trip(self):
+        archive = io.BytesIO()
+        self.model.to_npz(archive)
+        archive.seek(0)
+        model = Model.from_npz(archive)
+        self.assertEqual([state.name for state in model.states], [state.name for state in self.model.states])
+        logps, paths = model.viterbi_batch(self.reads)
+        expected_logps, expected_paths = self.model.viterbi_batch(self.reads)
+        self.assertEqual(list(logps), list(expected_logps))
+        for path, expected_path in zip(paths, expected_paths):
+            self.assertEqual(list(path), list(expected_path))
+
+
+class TestModelStore(ReadMatcherTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.directory, 'models.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_and_load(self):
+        ModelStore(self.db_file, read_only=False).save_model(1, 150, False, self.model)
+        model_store = ModelStore(self.db_file)
+        self.assertEqual(model_store.get_read_lengths(1), [150])
+        self.assertTrue(model_store.has_model(1, 150))
+        self.assertFalse(model_store.has_model(1, 150, cyclic=True))
+        self.assertIsNone(model_store.load_model(1, 100))
+        model = model_store.load_model(1, 150)
+        self.assertEqual(list(model.viterbi_batch(self.reads, path=False)),
+                         list(self.model.viterbi_batch(self.reads, path=False)))
+
+    def test_read_only(self):
+        ModelStore(self.db_file, read_only=False).save_model(1, 150, False, self.model)
+        self.assertRaises(sqlite3.OperationalError, ModelStore(self.db_file).save_model, 2, 150, False, self.model)
+
+
+class TestReadPrefilter(unittest.TestCase):
+
+    def setUp(self):
+        self.vntr = ReferenceVNTR(1, 'AATTCATTAGTAT', 1000, 'chr1', None, None)
+        self.vntr.repeat_segments = ['AATTCATTAGTAT'] * 6
+        self.other_vntr = ReferenceVNTR(2, 'GCCGAGGCGCTCG', 1000, 'chr1', None, None)
+        self.other_vntr.repeat_segments = ['GCCGAGGCGCTCG'] * 6
+        self.prefilter = ReadPrefilter([self.vntr, self.other_vntr], window_size=30, max_distance=4, k=13,
+                                       min_kmer_hits=3)
+
+    def test_repeat_read_passes(self):
+        read = TEST_LEFT_FLANK + 'AATTCATTAGTAT' * 5 + TEST_RIGHT_FLANK
+        self.assertEqual(self.prefilter.find_vntrs_of_sequences([read, get_reverse_complement(read)]), [[1], [1]])
+
+    def test_random_read_is_discarded(self):
+        random_generator = random.Random(0)
+        read = ''.join([random_generator.choice('ACGT') for _ in range(150)])
+        self.assertEqual(list(self.prefilter.filter_sequences([read])), [False])
+
+    def test_composition_and_kmers_of_the_same_vntr(self):
+        random_generator = random.Random(0)
+        shuffled_repeats = list('AATTCATTAGTAT' * 10)
+        random_generator.shuffle(shuffled_repeats)
+        read = 'GCCGAGGCGCTCGGC' + ''.join(shuffled_repeats)
+        self.assertEqual(self.prefilter.find_vntrs_of_sequences([read]), [[]])
+
+
+
+class TestReadPrefilterOfSimulatedReads(SimulatedVNTRsTestCase):
+
+    def setUp(self):
+        SimulatedVNTRsTestCase.setUp(self)
+        self.prefilter = ReadPrefilter([vntr_finder.reference_vntr for vntr_finder in self.vntr_finders.values()])
+        self.recruiter = KmerRecruiter(self.vntr_finders, True)
+
+    def test_recruited_reads_pass(self):
+        for vntr_id in self.vntr_finders.keys():
+            reads = self.get_repeat_reads(vntr_id, 45)
+            recruited_vntrs = self.recruiter.find_vntrs_of_sequences(reads)
+            self.assertEqual(recruited_vntrs, [[vntr_id]] * len(reads))
+            self.assertEqual(self.prefilter.find_vntrs_of_sequences(reads), recruited_vntrs)
+
+    def test_reads_without_repeats_are_discarded(self):
+        reads = [get_random_sequence(self.random_generator, 150) for _ in range(200)]
+        for haplotype in self.haplotypes.values():
+            reads += [haplotype[start:start + 150] for start in [0, 50, len(haplotype) - 200, len(haplotype) - 150]]
+        self.assertEqual(sum(self.prefilter.filter_sequences(reads)), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
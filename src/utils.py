@@ -1,12 +1,82 @@
 from settings import *
 from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from collections import namedtuple
+from contextlib import contextmanager
+import fcntl
 import logging
+import math
+import os
+from string import maketrans
+import tempfile
+
+
+COMPLEMENT_TRANSLATION = maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+
+def get_reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT_TRANSLATION)[::-1]
 
 
 def get_min_number_of_copies_to_span_read(pattern, read_length=150):
     return int(round(float(read_length) / len(pattern) + 0.499))
 
 
+def get_read_length_bucket(read_length):
+    return int(math.ceil(float(read_length) / READ_LENGTH_BUCKET_SIZE)) * READ_LENGTH_BUCKET_SIZE
+
+
+@contextmanager
+def cache_entry_lock(file_name):
+    """Hold an exclusive lock on building the cache entry in file_name, so other processes wait until it is built
+
+    The lock file is removed when the lock is released. A process that got the lock of a removed lock file opens the
+    lock file again, so only one process holds the lock of file_name at a time.
+    """
+    lock_file_name = file_name + '.lock'
+    while True:
+        lock_file = open(lock_file_name, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_file_name)):
+                break
+        except OSError:
+            pass
+        lock_file.close()
+    try:
+        yield
+    finally:
+        os.remove(lock_file_name)
+        lock_file.close()
+
+
+@contextmanager
+def atomic_output_file(file_name):
+    """Yield a temporary file next to file_name and rename it to file_name when the block completes
+
+    Readers see either the previous file or the complete new one, never a partially written file. The temporary file
+    is removed if the block raises.
+    """
+    directory = os.path.dirname(file_name) or '.'
+    descriptor, temp_file_name = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(file_name))
+    try:
+        with os.fdopen(descriptor, 'wb') as temp_file:
+            yield temp_file
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.chmod(temp_file_name, 0o644)
+        os.rename(temp_file_name, file_name)
+    except BaseException:
+        os.remove(temp_file_name)
+        raise
+
+
+def write_file_atomically(file_name, write):
+    """Call write with a temporary file next to file_name and rename it to file_name"""
+    with atomic_output_file(file_name) as outfile:
+        write(outfile)
+
+
 def get_gc_content(s):
     res = 0
     for e in s:
@@ -36,6 +106,18 @@ def is_low_quality_read(read):
     return False
 
 
+# Id and sequence of a read, without the annotations that a SeqRecord keeps
+Read = namedtuple('Read', ['id', 'seq'])
+
+
+def read_fasta_file(fasta_file):
+    """Yield the reads of fasta_file as Read tuples, which is much faster than making a SeqRecord of each read"""
+    with open(fasta_file) as infile:
+        for title, sequence in SimpleFastaParser(infile):
+            read_id = title.split(None, 1)[0] if title.strip() else ''
+            yield Read(read_id, sequence)
+
+
 def get_chromosome_reference_sequence(chromosome):
     ref_file_name = HG19_DIR + chromosome + '.fa'
     fasta_sequences = SeqIO.parse(open(ref_file_name), 'fasta')
@@ -1,7 +1,8 @@
 import logging
 import numpy
 import os
-from multiprocessing import Process, Manager, Value, Semaphore
+import re
+from multiprocessing import Process, Manager, Semaphore
 from random import random
 from uuid import uuid4
 
@@ -9,23 +10,25 @@ import pysam
 from Bio import pairwise2
 from Bio.Seq import Seq
 
-from blast_wrapper import get_blast_matched_ids, make_blast_database
+from blast_wrapper import get_blast_database, get_blast_matched_ids
 from coverage_bias import CoverageBiasDetector, CoverageCorrector
 from hmm_utils import *
+from model_store import get_model_store, read_matcher_cache
 from pacbio_haplotyper import PacBioHaplotyper
 from pomegranate import HiddenMarkovModel as Model
 from profiler import time_usage
 from sam_utils import get_reference_genome_of_alignment_file
 from sam_utils import get_related_reads_and_read_count_in_samfile
 import settings
-from utils import is_low_quality_read
+from threshold_store import get_threshold_store
+from utils import cache_entry_lock, get_read_length_bucket, is_low_quality_read, write_file_atomically
 
 
 class SelectedRead:
-    def __init__(self, sequence, logp, vpath, mapq=None, reference_start=None):
+    def __init__(self, sequence, logp, vpath_summary, mapq=None, reference_start=None):
         self.sequence = sequence
         self.logp = logp
-        self.vpath = vpath
+        self.vpath_summary = vpath_summary
         self.mapq = mapq
         self.is_mapped = reference_start is not None
 
@@ -55,62 +58,135 @@ class VNTRFinder:
         left_flanking_region = self.reference_vntr.left_flanking_region[-flanking_region_size:]
         right_flanking_region = self.reference_vntr.right_flanking_region[:flanking_region_size]
 
-        vntr_matcher = get_read_matcher_model(left_flanking_region, right_flanking_region, patterns, copies)
+        vntr_matcher = get_read_matcher_model(left_flanking_region, right_flanking_region, patterns, copies,
+                                              cyclic=settings.USE_CYCLIC_REPEAT_MATCHER)
+        vntr_matcher.single_precision = settings.USE_SINGLE_PRECISION_DP
         return vntr_matcher
 
+    def get_cached_vntr_matcher_hmm(self, copies, flanking_region_size=100):
+        """Return the model with this many copies from the models built in this process, or build it"""
+        vntr_id = self.reference_vntr.id
+        cyclic = settings.USE_CYCLIC_REPEAT_MATCHER
+        vntr_matcher = read_matcher_cache.get_model(vntr_id, copies, flanking_region_size, cyclic)
+        if vntr_matcher is None:
+            vntr_matcher = self.build_vntr_matcher_hmm(copies, flanking_region_size)
+            read_matcher_cache.add_model(vntr_id, copies, flanking_region_size, cyclic, vntr_matcher)
+        vntr_matcher.single_precision = settings.USE_SINGLE_PRECISION_DP
+        return vntr_matcher
+
+    def build_vntr_matcher_hmm_for_read_length(self, read_length):
+        copies = int(round(float(read_length) / len(self.reference_vntr.pattern) + 0.5))
+        flanking_region_size = read_length
+        return self.build_vntr_matcher_hmm(copies, flanking_region_size)
+
+    def get_stored_hmm_file_name(self, read_length):
+        base_name = str(self.reference_vntr.id) + '_' + str(read_length)
+        if settings.USE_CYCLIC_REPEAT_MATCHER:
+            base_name += '_cyclic'
+        return settings.TRAINED_HMMS_DIR + base_name
+
+    def get_stored_hmm_read_lengths(self):
+        """Return the read lengths of the stored models of this VNTR in the model store and in separate files"""
+        if not settings.USE_TRAINED_HMMS:
+            return []
+        read_lengths = []
+        model_store = get_model_store()
+        if model_store is not None:
+            read_lengths += model_store.get_read_lengths(self.reference_vntr.id, settings.USE_CYCLIC_REPEAT_MATCHER)
+        if os.path.isdir(settings.TRAINED_HMMS_DIR):
+            suffix = '_cyclic' if settings.USE_CYCLIC_REPEAT_MATCHER else ''
+            file_name_pattern = re.compile(r'^%s_(\d+)%s\.(npz|json)$' % (self.reference_vntr.id, suffix))
+            matches = [file_name_pattern.match(file_name) for file_name in os.listdir(settings.TRAINED_HMMS_DIR)]
+            read_lengths += [int(match.group(1)) for match in matches if match]
+        return sorted(set(read_lengths))
+
+    def get_model_read_length(self, read_length):
+        """Return the read length of the model that scores reads of this length
+
+        A model built for longer reads also aligns shorter reads, so the shortest stored model that fits the read is
+        used. If there is none, the model is built for the read length bucket of the read.
+        Its longer flanks and extra copies lower the probabilities of a read starting in the left flank and of it
+        ending in the repeats, each by about model_read_length / read_length. A read scores up to about twice the log
+        of that ratio lower than under a model of its exact length, or higher if it has more repeats than the copies
+        of that model. Only reads that score this close to the minimum score can be selected differently.
+        """
+        longer_stored_lengths = [length for length in self.get_stored_hmm_read_lengths() if length >= read_length]
+        if len(longer_stored_lengths):
+            return longer_stored_lengths[0]
+        return get_read_length_bucket(read_length)
+
     def get_vntr_matcher_hmm(self, read_length):
         """Try to load trained HMM for this VNTR
         If there was no trained HMM, it will build one and store it for later usage
         """
-        logging.info('Using read length %s' % read_length)
-        copies = int(round(float(read_length) / len(self.reference_vntr.pattern) + 0.5))
-
-        base_name = str(self.reference_vntr.id) + '_' + str(read_length) + '.json'
-        stored_hmm_file = settings.TRAINED_HMMS_DIR + base_name
+        read_length = self.get_model_read_length(read_length)
+        logging.info('Using model for read length %s' % read_length)
+
+        model_store = get_model_store()
+        if settings.USE_TRAINED_HMMS and model_store is not None:
+            model = model_store.load_model(self.reference_vntr.id, read_length, settings.USE_CYCLIC_REPEAT_MATCHER)
+            if model is not None:
+                model.single_precision = settings.USE_SINGLE_PRECISION_DP
+                return model
+
+        stored_hmm_file = self.get_stored_hmm_file_name(read_length) + '.npz'
+        legacy_hmm_file = self.get_stored_hmm_file_name(read_length) + '.json'
         if settings.USE_TRAINED_HMMS and os.path.isfile(stored_hmm_file):
-            model = Model()
-            model = model.from_json(stored_hmm_file)
+            model = Model.from_npz(stored_hmm_file)
+            model.single_precision = settings.USE_SINGLE_PRECISION_DP
             return model
 
-        flanking_region_size = read_length
-        vntr_matcher = self.build_vntr_matcher_hmm(copies, flanking_region_size)
-
-        json_str = vntr_matcher.to_json()
-        with open(stored_hmm_file, 'w') as outfile:
-            outfile.write(json_str)
+        # jobs of the same VNTR wait here for the one that builds the model instead of building it again
+        with cache_entry_lock(stored_hmm_file):
+            if settings.USE_TRAINED_HMMS and os.path.isfile(stored_hmm_file):
+                model = Model.from_npz(stored_hmm_file)
+                model.single_precision = settings.USE_SINGLE_PRECISION_DP
+                return model
+            if settings.USE_TRAINED_HMMS and os.path.isfile(legacy_hmm_file):
+                logging.info('Converting %s to %s' % (legacy_hmm_file, stored_hmm_file))
+                model = Model.from_json(legacy_hmm_file)
+                write_file_atomically(stored_hmm_file, model.to_npz)
+                model.single_precision = settings.USE_SINGLE_PRECISION_DP
+                return model
+
+            vntr_matcher = self.build_vntr_matcher_hmm_for_read_length(read_length)
+            write_file_atomically(stored_hmm_file, vntr_matcher.to_npz)
         return vntr_matcher
 
-    @time_usage
-    def filter_reads_with_keyword_matching(self, working_directory, read_file, short_reads=True):
-        db_name = 'blast_db__' + os.path.basename(read_file)
-        blast_db_name = working_directory + db_name
-        empty_db = False
-        if not os.path.exists(blast_db_name + '.nsq') and not os.path.exists(blast_db_name + '.nal'):
-            empty_db = make_blast_database(read_file, blast_db_name)
+    def get_keyword_matching_queries(self, short_reads=True):
+        """Return the sequences that select reads of this VNTR, their word size and identity cutoff
 
+        Short reads are selected by matching any repeat segment, and long reads by matching both flanking regions.
+        """
         word_size = int(len(self.reference_vntr.pattern)/3)
         if word_size > 11:
             word_size = 11
         if word_size < 5:
             word_size = 5
-        word_size = str(word_size)
 
-        search_results = []
-        blast_ids = set([])
-        search_id = str(uuid4()) + str(self.reference_vntr.id)
         queries = self.reference_vntr.get_repeat_segments()
         if len(self.reference_vntr.pattern) < 10:
             min_copies = int(10 / len(self.reference_vntr.pattern))
             queries = [self.reference_vntr.pattern * min_copies]
-        identity_cutoff = '0'
+        identity_cutoff = 0
         if not short_reads:
             queries = [self.reference_vntr.left_flanking_region[-80:], self.reference_vntr.right_flanking_region[:80]]
-            word_size = str('10')
-            identity_cutoff = '70'
+            word_size = 10
+            identity_cutoff = 70
+        return queries, word_size, identity_cutoff
+
+    @time_usage
+    def filter_reads_with_keyword_matching(self, working_directory, read_file, short_reads=True):
+        blast_db_name, empty_db = get_blast_database(working_directory, read_file)
+        queries, word_size, identity_cutoff = self.get_keyword_matching_queries(short_reads)
+        search_results = []
+        blast_ids = set([])
+        search_id = str(uuid4()) + str(self.reference_vntr.id)
         if not empty_db:
             for query in queries:
-                search_result = get_blast_matched_ids(query, blast_db_name, max_seq='50000', word_size=word_size,
-                                                      evalue=10, search_id=search_id, identity_cutoff=identity_cutoff)
+                search_result = get_blast_matched_ids(query, blast_db_name, max_seq='50000', word_size=str(word_size),
+                                                      evalue=10, search_id=search_id,
+                                                      identity_cutoff=str(identity_cutoff))
                 search_results.append(search_result)
 
             if short_reads:
@@ -126,13 +202,16 @@ class VNTRFinder:
 
     @staticmethod
     def add_hmm_score_to_list(sema, hmm, read, result_scores):
-        logp, vpath = hmm.viterbi(str(read.seq))
-        rev_logp, rev_vpath = hmm.viterbi(str(Seq(str(read.seq)).reverse_complement()))
-        if logp < rev_logp:
-            logp = rev_logp
-        result_scores.append(logp)
+        logp, reverse = hmm.viterbi_batch([str(read.seq)], path=False, complement=DNA_COMPLEMENT)
+        result_scores.append(logp[0])
         sema.release()
 
+    @staticmethod
+    def get_hmm_scores_of_sequences(hmm, sequences, n_jobs=1):
+        """Score both strands of the sequences without traceback and return the better score of each sequence"""
+        logps, reverse = hmm.viterbi_batch(sequences, n_jobs=n_jobs, path=False, complement=DNA_COMPLEMENT)
+        return list(logps)
+
     def is_true_read(self, read):
         read_start = read.reference_start
         reference_name = read.reference_name
@@ -143,8 +222,8 @@ class VNTRFinder:
         return False
 
     def find_score_distribution_of_ref(self, samfile, reference, hmm, false_scores, true_scores):
-        process_list = []
-        sema = Semaphore(settings.CORES)
+        true_sequences = []
+        false_sequences = []
         for read in samfile.fetch(reference, multiple_iterators=True):
             if read.is_unmapped:
                 continue
@@ -152,17 +231,13 @@ class VNTRFinder:
                 continue
 
             if self.is_true_read(read):
-                sema.acquire()
-                p = Process(target=VNTRFinder.add_hmm_score_to_list, args=(sema, hmm, read, true_scores))
+                true_sequences.append(str(read.seq))
             else:
                 if random() > settings.SCORE_FINDING_READS_FRACTION:
                     continue
-                sema.acquire()
-                p = Process(target=VNTRFinder.add_hmm_score_to_list, args=(sema, hmm, read, false_scores))
-            process_list.append(p)
-            p.start()
-        for p in process_list:
-            p.join()
+                false_sequences.append(str(read.seq))
+        true_scores.extend(self.get_hmm_scores_of_sequences(hmm, true_sequences, settings.CORES))
+        false_scores.extend(self.get_hmm_scores_of_sequences(hmm, false_sequences, settings.CORES))
 
     def save_scores(self, true_scores, false_scores, alignment_file):
         with open('true_scores_dist_%s_%s' % (self.reference_vntr.id, os.path.basename(alignment_file)), 'w') as out:
@@ -173,10 +248,8 @@ class VNTRFinder:
                 out.write('%.4f\n' % score)
 
     @time_usage
-    def calculate_min_score_to_select_a_read(self, hmm, alignment_file):
-        """Calculate the score distribution of false positive reads
-        and return score to select the 1e-8 percentile of the distribution
-        """
+    def find_false_read_scores(self, hmm, alignment_file):
+        """Calculate the score distribution of false positive reads"""
         process_list = []
         manager = Manager()
         false_scores = manager.list()
@@ -193,84 +266,132 @@ class VNTRFinder:
 
         if settings.SAVE_SCORE_DISTRIBUTION:
             self.save_scores(true_scores, false_scores, alignment_file)
+        return list(false_scores)
 
-        score = numpy.percentile(false_scores, 100 - settings.SCORE_SELECTION_PERCENTILE)
-        return score
+    @staticmethod
+    def calculate_min_score_to_select_a_read(false_scores):
+        """Return score to select the 1e-8 percentile of the score distribution of false positive reads"""
+        return numpy.percentile(false_scores, 100 - settings.SCORE_SELECTION_PERCENTILE)
 
     def get_min_score_to_select_a_read(self, hmm, alignment_file, read_length):
         """Try to load the minimum score for this VNTR
 
         If the score is not stored, it will compute the score and write it for this VNTR in precomputed data.
         """
-        base_name = str(self.reference_vntr.id) + '.scores'
-        stored_scores_file = settings.TRAINED_HMMS_DIR + base_name
-        if settings.USE_TRAINED_HMMS and os.path.isfile(stored_scores_file):
-            with open(stored_scores_file, 'r') as infile:
-                lines = [line.split() for line in infile.readlines() if line.strip() != '']
-                for stored_length, fraction, score in lines:
-                    if int(stored_length) == read_length and settings.SCORE_FINDING_READS_FRACTION == float(fraction):
-                        return float(score)
-                    elif settings.SCALE_SCORES and settings.SCORE_FINDING_READS_FRACTION == float(fraction):
-                        return float(score) * (read_length / int(stored_length))
-
-        logging.debug('Minimum score is not precomputed for vntr id: %s' % self.reference_vntr.id)
-        score = self.calculate_min_score_to_select_a_read(hmm, alignment_file)
-        logging.debug('computed score: %s' % score)
-        with open(stored_scores_file, 'a') as outfile:
-            outfile.write('%s %s %s\n' % (read_length, settings.SCORE_FINDING_READS_FRACTION, score))
+        threshold_store = get_threshold_store()
+        score = self.load_min_score_to_select_a_read(threshold_store, read_length)
+        if score is not None:
+            return score
+
+        with cache_entry_lock(settings.TRAINED_HMMS_DIR + str(self.reference_vntr.id) + '.scores'):
+            threshold_store.load_thresholds([self.reference_vntr.id])
+            score = self.load_min_score_to_select_a_read(threshold_store, read_length)
+            if score is not None:
+                return score
+            logging.debug('Minimum score is not precomputed for vntr id: %s' % self.reference_vntr.id)
+            false_scores = self.find_false_read_scores(hmm, alignment_file)
+            score = self.calculate_min_score_to_select_a_read(false_scores)
+            logging.debug('computed score: %s' % score)
+            threshold_store.save_score(self.reference_vntr.id, read_length, settings.SCORE_FINDING_READS_FRACTION,
+                                       settings.MAX_ERROR_RATE, score, false_scores)
 
         return score
 
-    def process_unmapped_read(self, sema, read_segment, hmm, min_score_to_count_read,
-                              vntr_bp_in_unmapped_reads, selected_reads, best_seq):
-        if read_segment.seq.count('N') <= 0:
-            sequence = str(read_segment.seq)
-            logp, vpath = hmm.viterbi(sequence)
-            rev_logp, rev_vpath = hmm.viterbi(str(read_segment.seq.reverse_complement()))
-            if logp < rev_logp:
-                sequence = str(read_segment.seq.reverse_complement())
-                logp = rev_logp
-                vpath = rev_vpath
-            if logp > best_seq['logp']:
-                best_seq['logp'] = logp
-                best_seq['seq'] = sequence
-                best_seq['vpath'] = vpath
-            repeat_bps = get_number_of_repeat_bp_matches_in_vpath(vpath)
-            if logp > min_score_to_count_read:
-                if repeat_bps > self.min_repeat_bp_to_count_repeats:
-                    vntr_bp_in_unmapped_reads.value += repeat_bps
-                if repeat_bps > self.min_repeat_bp_to_add_read:
-                    selected_reads.append(SelectedRead(sequence, logp, vpath))
-        sema.release()
+    def load_min_score_to_select_a_read(self, threshold_store, read_length):
+        """Return the stored minimum score for this read length, or None if it is not stored
+
+        Scores of the legacy per-VNTR .scores file are added to the threshold store the first time they are needed.
+        """
+        if not settings.USE_TRAINED_HMMS:
+            return None
+        legacy_scores_file = settings.TRAINED_HMMS_DIR + str(self.reference_vntr.id) + '.scores'
+        if not len(threshold_store.get_thresholds(self.reference_vntr.id)) and os.path.isfile(legacy_scores_file):
+            logging.info('Adding %s to the threshold store' % legacy_scores_file)
+            threshold_store.import_scores_file(self.reference_vntr.id, legacy_scores_file, settings.MAX_ERROR_RATE)
+        return threshold_store.get_score(self.reference_vntr.id, read_length, settings.SCORE_FINDING_READS_FRACTION,
+                                         settings.MAX_ERROR_RATE, settings.SCALE_SCORES)
+
+    @staticmethod
+    def get_min_scores_of_sequences(min_score_to_count_read, calibration_read_length, sequences):
+        """Scale the minimum score of reads of the calibration read length to the length of each sequence"""
+        if not settings.SCALE_SCORES:
+            return numpy.array([min_score_to_count_read] * len(sequences))
+        return numpy.array([min_score_to_count_read * len(sequence) / float(calibration_read_length)
+                            for sequence in sequences])
+
+    @staticmethod
+    def get_better_strands(sequences, reverse):
+        return [get_reverse_complement(sequence) if rev else sequence for sequence, rev in zip(sequences, reverse)]
+
+    def process_unmapped_reads(self, hmm, state_table, sequences, min_scores):
+        """Decode the better strand of the unmapped reads in one batch and select the reads that pass
+
+        min_scores holds the minimum score of each read. Reads which can not reach the lowest of them are abandoned
+        during scoring and get no path, so best_seq is the best of the reads that pass, or an arbitrary read with logp
+        of -inf and no vpath if none of them does.
+        """
+        logps, paths, reverse = hmm.viterbi_batch(sequences, n_jobs=settings.CORES, complement=DNA_COMPLEMENT,
+                                                  threshold=min(min_scores))
+        strands = self.get_better_strands(sequences, reverse)
+        best_read = int(numpy.argmax(logps))
+        best_seq = {'logp': logps[best_read], 'vpath': paths[best_read], 'seq': strands[best_read]}
+        selected_reads = []
+        vntr_bp_in_unmapped_reads = 0
+        for i in range(len(sequences)):
+            if logps[i] <= min_scores[i]:
+                continue
+            vpath_summary = VpathSummary(paths[i], state_table, strands[i])
+            repeat_bps = vpath_summary.repeat_bps
+            if repeat_bps > self.min_repeat_bp_to_count_repeats:
+                vntr_bp_in_unmapped_reads += repeat_bps
+            if repeat_bps > self.min_repeat_bp_to_add_read:
+                selected_reads.append(SelectedRead(strands[i], logps[i], vpath_summary))
+        return selected_reads, vntr_bp_in_unmapped_reads, best_seq
+
+    def process_mapped_reads(self, hmm, state_table, mapped_reads, min_scores):
+        """Decode the better strand of the mapped reads in one batch and select the reads that pass
+
+        min_scores holds the minimum score of each read, which is only used to reject low quality reads.
+        """
+        sequences = [str(read.seq) for read in mapped_reads]
+        logps = numpy.empty(len(sequences))
+        paths = [None] * len(sequences)
+        reverse = numpy.empty(len(sequences), dtype=bool)
+        low_quality = numpy.array([is_low_quality_read(read) for read in mapped_reads], dtype=bool)
+        # only low quality reads are rejected by their score, so the other reads are decoded without early abandoning
+        for mask, rejected_by_score in [(low_quality, True), (~low_quality, False)]:
+            if mask.any():
+                indices = numpy.flatnonzero(mask)
+                threshold = min(min_scores[mask]) if rejected_by_score else None
+                logps[mask], mask_paths, reverse[mask] = hmm.viterbi_batch([sequences[i] for i in indices],
+                                                                           n_jobs=settings.CORES,
+                                                                           complement=DNA_COMPLEMENT,
+                                                                           threshold=threshold)
+                for i, vpath in zip(indices, mask_paths):
+                    paths[i] = vpath
+        strands = self.get_better_strands(sequences, reverse)
+        selected_reads = []
+        for i, read in enumerate(mapped_reads):
+            if low_quality[i] and logps[i] < min_scores[i]:
+                logging.debug('Rejected Read: %s' % strands[i])
+                continue
+            vpath_summary = VpathSummary(paths[i], state_table, strands[i])
+            selected_reads.append(SelectedRead(strands[i], logps[i], vpath_summary, read.mapq, read.reference_start))
+        return selected_reads
 
     def find_frameshift_from_selected_reads(self, selected_reads):
         mutations = {}
         repeating_bps_in_data = 0
         repeats_lengths_distribution = []
         for read in selected_reads:
-            visited_states = [state.name for idx, state in read.vpath[1:-1]]
-            repeats_lengths = get_repeating_pattern_lengths(visited_states)
+            repeats_lengths = read.vpath_summary.unit_lengths
             repeats_lengths_distribution += repeats_lengths
-            current_repeat = None
-            repeating_bps_in_data += get_number_of_repeat_bp_matches_in_vpath(read.vpath)
-            for i in range(len(visited_states)):
-                if visited_states[i].endswith('fix') or visited_states[i].startswith('M'):
-                    continue
-                if visited_states[i].startswith('unit_start'):
-                    if current_repeat is None:
-                        current_repeat = 0
-                    else:
-                        current_repeat += 1
-                if current_repeat is None or current_repeat >= len(repeats_lengths):
-                    continue
-                if not visited_states[i].startswith('I') and not visited_states[i].startswith('D'):
-                    continue
-                if repeats_lengths[current_repeat] == len(self.reference_vntr.pattern):
+            repeating_bps_in_data += read.vpath_summary.repeat_bps
+            for current_repeat, state in read.vpath_summary.indels:
+                repeat_length = repeats_lengths[current_repeat]
+                if repeat_length == len(self.reference_vntr.pattern):
                     continue
-                state = visited_states[i].split('_')[0]
-                if state.startswith('I'):
-                    state += get_emitted_basepair_from_visited_states(visited_states[i], visited_states, read.sequence)
-                if abs(repeats_lengths[current_repeat] - len(self.reference_vntr.pattern)) <= 2:
+                if abs(repeat_length - len(self.reference_vntr.pattern)) <= 2:
                     if state not in mutations.keys():
                         mutations[state] = 0
                     mutations[state] += 1
@@ -287,7 +408,7 @@ class VNTRFinder:
             return frameshift_candidate[0]
         return None
 
-    def read_flanks_repeats_with_confidence(self, vpath):
+    def read_flanks_repeats_with_confidence(self, vpath_summary):
         minimum_left_flanking = 5
         minimum_right_flanking = 5
         if self.reference_vntr.id in self.minimum_left_flanking_size:
@@ -295,8 +416,8 @@ class VNTRFinder:
         if self.reference_vntr.id in self.minimum_right_flanking_size:
             minimum_right_flanking = self.minimum_right_flanking_size[self.reference_vntr.id]
 
-        if get_left_flanking_region_size_in_vpath(vpath) > minimum_left_flanking:
-            if get_right_flanking_region_size_in_vpath(vpath) > minimum_right_flanking:
+        if vpath_summary.left_flanking_size > minimum_left_flanking:
+            if vpath_summary.right_flanking_size > minimum_right_flanking:
                 return True
         return False
 
@@ -474,6 +595,10 @@ class VNTRFinder:
         logging.info('Maximum probability for genotyping: %s' % max_prob)
         return result
 
+    @staticmethod
+    def needs_checkpointed_viterbi(hmm, sequence):
+        return len(sequence) * len(hmm.states) > settings.MAX_VITERBI_DP_CELLS
+
     def get_dominant_copy_numbers_from_spanning_reads(self, spanning_reads):
         if len(spanning_reads) < 1:
             logging.info('There is no spanning read')
@@ -484,14 +609,14 @@ class VNTRFinder:
                 max_length = len(read) - 100
         max_copies = int(round(max_length / float(len(self.reference_vntr.pattern))))
         # max_copies = min(max_copies, 2 * len(self.reference_vntr.get_repeat_segments()))
-        vntr_matcher = self.build_vntr_matcher_hmm(max_copies)
+        vntr_matcher = self.get_cached_vntr_matcher_hmm(max_copies)
+        state_table = StateTable(vntr_matcher)
         observed_copy_numbers = []
         for haplotype in spanning_reads:
-            logp, vpath = vntr_matcher.viterbi(haplotype)
-            rev_logp, rev_vpath = vntr_matcher.viterbi(str(Seq(haplotype).reverse_complement()))
-            if logp < rev_logp:
-                vpath = rev_vpath
-            observed_copy_numbers.append(get_number_of_repeats_in_vpath(vpath))
+            checkpoint = self.needs_checkpointed_viterbi(vntr_matcher, haplotype)
+            logp, vpath, reverse = vntr_matcher.viterbi_strands(haplotype, DNA_COMPLEMENT, checkpoint)
+            vpath = get_state_indices_from_vpath(vpath)
+            observed_copy_numbers.append(get_number_of_repeats_in_vpath(vpath, state_table))
 
         logging.info('flanked repeats: %s' % observed_copy_numbers)
         return self.find_genotype_based_on_observed_repeats(observed_copy_numbers)
@@ -507,17 +632,17 @@ class VNTRFinder:
                 max_length = len(read) - 100
         max_copies = int(round(max_length / float(len(self.reference_vntr.pattern))))
         max_copies = min(max_copies, 2 * len(self.reference_vntr.get_repeat_segments()))
-        vntr_matcher = self.build_vntr_matcher_hmm(max_copies)
+        vntr_matcher = self.get_cached_vntr_matcher_hmm(max_copies)
+        state_table = StateTable(vntr_matcher)
         haplotyper = PacBioHaplotyper(spanning_reads)
         haplotypes = haplotyper.get_error_corrected_haplotypes()
         copy_numbers = []
         for haplotype in haplotypes:
             # print('haplotype: %s' % haplotype)
-            logp, vpath = vntr_matcher.viterbi(haplotype)
-            rev_logp, rev_vpath = vntr_matcher.viterbi(str(Seq(haplotype).reverse_complement()))
-            if logp < rev_logp:
-                vpath = rev_vpath
-            copy_numbers.append(get_number_of_repeats_in_vpath(vpath))
+            checkpoint = self.needs_checkpointed_viterbi(vntr_matcher, haplotype)
+            logp, vpath, reverse = vntr_matcher.viterbi_strands(haplotype, DNA_COMPLEMENT, checkpoint)
+            vpath = get_state_indices_from_vpath(vpath)
+            copy_numbers.append(get_number_of_repeats_in_vpath(vpath, state_table))
         return copy_numbers
 
     @time_usage
@@ -547,46 +672,17 @@ class VNTRFinder:
 
     @time_usage
     def select_illumina_reads(self, alignment_file, unmapped_filtered_reads):
-        hmm = None
-        min_score_to_count_read = None
-        sema = Semaphore(settings.CORES)
-        manager = Manager()
-        selected_reads = manager.list()
-        vntr_bp_in_unmapped_reads = Value('d', 0.0)
-
-        number_of_reads = 0
-        read_length = 150
-
-        process_list = []
-
-        best_seq = manager.dict()
-        best_seq['logp'] = -10e8
-        best_seq['vpath'] = ''
-        best_seq['seq'] = ''
+        """Select the reads of this VNTR from unmapped reads and the reads mapped to it
 
+        Reads of any length are scored by one model sized for the longest read, and the minimum score of each read is
+        scaled to its length. The minimum score is calibrated on the reads of the alignment file, so it is stored and
+        scaled for the length of those reads, not for the read length of the model.
+        """
+        unmapped_sequences = []
         for read_segment in unmapped_filtered_reads:
-            if number_of_reads == 0:
-                read_length = len(str(read_segment.seq))
-            number_of_reads += 1
-            if not hmm:
-                hmm = self.get_vntr_matcher_hmm(read_length=read_length)
-                min_score_to_count_read = self.get_min_score_to_select_a_read(hmm, alignment_file, read_length)
-
-            if len(read_segment.seq) < read_length:
+            if read_segment.seq.count('N') > 0:
                 continue
-
-            sema.acquire()
-            p = Process(target=self.process_unmapped_read, args=(sema, read_segment, hmm, min_score_to_count_read,
-                                                                 vntr_bp_in_unmapped_reads, selected_reads, best_seq))
-            process_list.append(p)
-            p.start()
-        for p in process_list:
-            p.join()
-
-        logging.debug('vntr base pairs in unmapped reads: %s' % vntr_bp_in_unmapped_reads.value)
-        logging.debug('highest logp in unmapped reads: %s' % best_seq['logp'])
-        logging.debug('best sequence %s' % best_seq['seq'])
-        logging.debug('best vpath: %s' % [state.name for idx, state in list(best_seq['vpath'])[1:-1]])
+            unmapped_sequences.append(str(read_segment.seq))
 
         vntr_bp_in_mapped_reads = 0
         vntr_start = self.reference_vntr.start_point
@@ -595,36 +691,44 @@ class VNTRFinder:
         samfile = pysam.AlignmentFile(alignment_file, read_mode)
         reference = get_reference_genome_of_alignment_file(samfile)
         chromosome = self.reference_vntr.chromosome if reference == 'HG19' else self.reference_vntr.chromosome[3:]
+        mapped_reads = []
         for read in samfile.fetch(chromosome, vntr_start, vntr_end):
-            if not hmm:
-                read_length = len(read.seq)
-                hmm = self.get_vntr_matcher_hmm(read_length=read_length)
-                min_score_to_count_read = self.get_min_score_to_select_a_read(hmm, alignment_file, read_length)
-
             if read.is_unmapped:
                 continue
-            if len(read.seq) < int(read_length * 0.9):
-                logging.debug('Rejecting read for short length: %s' % read.seq)
-                continue
             read_end = read.reference_end if read.reference_end else read.reference_start + len(read.seq)
-            if vntr_start - read_length < read.reference_start < vntr_end or vntr_start < read_end < vntr_end:
+            if vntr_start - len(read.seq) < read.reference_start < vntr_end or vntr_start < read_end < vntr_end:
                 if read.seq.count('N') <= 0:
-                    sequence = str(read.seq)
-                    logp, vpath = hmm.viterbi(sequence)
-                    rev_logp, rev_vpath = hmm.viterbi(str(Seq(read.seq).reverse_complement()))
-                    if logp < rev_logp:
-                        sequence = str(Seq(read.seq).reverse_complement())
-                        logp = rev_logp
-                        vpath = rev_vpath
-                    if is_low_quality_read(read) and logp < min_score_to_count_read:
-                        logging.debug('Rejected Read: %s' % sequence)
-                        continue
-                    selected_reads.append(SelectedRead(sequence, logp, vpath, read.mapq, read.reference_start))
+                    mapped_reads.append(read)
                 end = min(read_end, vntr_end)
                 start = max(read.reference_start, vntr_start)
                 vntr_bp_in_mapped_reads += end - start
         logging.debug('vntr base pairs in mapped reads: %s' % vntr_bp_in_mapped_reads)
 
+        mapped_sequences = [str(read.seq) for read in mapped_reads]
+        if not len(unmapped_sequences) and not len(mapped_sequences):
+            return []
+        read_length = max([len(sequence) for sequence in unmapped_sequences + mapped_sequences])
+        model_read_length = self.get_model_read_length(read_length)
+        hmm = self.get_vntr_matcher_hmm(read_length=model_read_length)
+        state_table = StateTable(hmm)
+        min_score_to_count_read = self.get_min_score_to_select_a_read(hmm, alignment_file, read_length)
+
+        selected_reads = []
+        if len(unmapped_sequences):
+            min_scores = self.get_min_scores_of_sequences(min_score_to_count_read, read_length, unmapped_sequences)
+            selected_reads, vntr_bp_in_unmapped_reads, best_seq = self.process_unmapped_reads(hmm, state_table,
+                                                                                             unmapped_sequences,
+                                                                                             min_scores)
+            logging.debug('vntr base pairs in unmapped reads: %s' % vntr_bp_in_unmapped_reads)
+            logging.debug('highest logp in unmapped reads: %s' % best_seq['logp'])
+            logging.debug('best sequence %s' % best_seq['seq'])
+            if best_seq['vpath'] is not None:
+                logging.debug('best vpath: %s' % [state_table.names[idx] for idx in best_seq['vpath'][1:-1]])
+
+        if len(mapped_reads):
+            min_scores = self.get_min_scores_of_sequences(min_score_to_count_read, read_length, mapped_sequences)
+            selected_reads += self.process_mapped_reads(hmm, state_table, mapped_reads, min_scores)
+
         return selected_reads
 
     @time_usage
@@ -644,15 +748,15 @@ class VNTRFinder:
         flanking_repeats = []
         total_counted_vntr_bp = 0
         for selected_read in selected_reads:
-            repeats = get_number_of_repeats_in_vpath(selected_read.vpath)
-            total_counted_vntr_bp += get_number_of_repeat_bp_matches_in_vpath(selected_read.vpath)
+            vpath_summary = selected_read.vpath_summary
+            repeats = vpath_summary.repeats
+            total_counted_vntr_bp += vpath_summary.repeat_bps
             logging.debug('logp of read: %s' % str(selected_read.logp))
-            logging.debug('left flankign size: %s' % get_left_flanking_region_size_in_vpath(selected_read.vpath))
-            logging.debug('right flanking size: %s' % get_right_flanking_region_size_in_vpath(selected_read.vpath))
+            logging.debug('left flankign size: %s' % vpath_summary.left_flanking_size)
+            logging.debug('right flanking size: %s' % vpath_summary.right_flanking_size)
             logging.debug(selected_read.sequence)
-            visited_states = [state.name for idx, state in selected_read.vpath[1:-1]]
-            if self.read_flanks_repeats_with_confidence(selected_read.vpath):
-                logging.debug('spanning read visited states :%s' % visited_states)
+            if self.read_flanks_repeats_with_confidence(vpath_summary):
+                logging.debug('spanning read repeat unit lengths :%s' % vpath_summary.unit_lengths)
                 logging.debug('repeats: %s' % repeats)
                 covered_repeats.append(repeats)
             else: